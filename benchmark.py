@@ -0,0 +1,250 @@
+"""Микробенчмарки горячих путей бота: каждый сравнивает прежний способ с текущим.
+
+Запускается на временной базе во временном каталоге, сеть не нужна.
+
+    python benchmark.py db --users 20000 --updates 5000 --concurrency 20
+    python benchmark.py storage --users 20000 --updates 20000
+    python benchmark.py callbacks --updates 3000
+    python benchmark.py replies --updates 20000
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+BOT_TOKEN = "123456:BENCHMARK"
+ADMIN_ID = 1
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def print_latencies(name: str, samples: list, elapsed: float):
+    print(f"{name:32s} p50 {percentile(samples, 0.5) * 1e6:8.1f} мкс  p95 {percentile(samples, 0.95) * 1e6:8.1f} мкс"
+          f"  {len(samples) / elapsed:8.0f} обн/с")
+
+
+async def run_updates(action, updates: int, concurrency: int):
+    """Прогоняет updates вызовов action(), не больше concurrency одновременно; возвращает задержки и время"""
+    samples = []
+    remaining = iter(range(updates))
+
+    async def worker():
+        for _ in remaining:
+            started = time.perf_counter()
+            await action()
+            samples.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return samples, time.perf_counter() - started
+
+
+async def bench_db(args):
+    """Задержка обращения к базе на одно обновление: новое соединение на каждое обновление против пула"""
+    import aiosqlite
+    import database
+
+    await database.setup_database()
+    async with database.get_db_connection() as conn:
+        await conn.executemany("INSERT INTO users (user_id, role, name, phone, route_id) VALUES (?, 'passenger', ?, ?, ?)",
+                               [(user_id, f"P{user_id}", str(user_id), user_id % 2 + 1)
+                                for user_id in range(1, args.users + 1)])
+        await conn.commit()
+    rng = random.Random(1)
+
+    async def point_query(conn):
+        async with conn.execute("SELECT role, route_id, available FROM users WHERE user_id=?",
+                                (rng.randint(1, args.users),)) as cursor:
+            await cursor.fetchone()
+
+    async def connect_per_update():  # Как было до пула: aiosqlite.connect в каждом обработчике
+        conn = await aiosqlite.connect(database.DB_PATH)
+        try:
+            await point_query(conn)
+        finally:
+            await conn.close()
+
+    async def pooled():
+        async with database.get_db_connection() as conn:
+            await point_query(conn)
+
+    await run_updates(connect_per_update, min(args.updates, 200), args.concurrency)  # Прогрев кэша страниц
+    samples, elapsed = await run_updates(connect_per_update, args.updates, args.concurrency)
+    print_latencies("соединение на обновление", samples, elapsed)
+    await database.init_db_pool()
+    try:
+        await run_updates(pooled, min(args.updates, 200), args.concurrency)
+        samples, elapsed = await run_updates(pooled, args.updates, args.concurrency)
+        print_latencies(f"пул ({database.DB_POOL_SIZE} соединения)", samples, elapsed)
+    finally:
+        await database.close_db_pool()
+
+
+async def bench_storage(args):
+    """FSM на одно обновление (set_state, set_data, get_state, get_data): MemoryStorage против SQLiteStorage"""
+    from aiogram.fsm.storage.base import StorageKey
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from storage import SQLiteStorage
+
+    keys = [StorageKey(bot_id=1, chat_id=user_id, user_id=user_id) for user_id in range(1, args.users + 1)]
+
+    async def cycles(storage):
+        rng = random.Random(1)
+        started = time.perf_counter()
+        for step in range(args.updates):
+            key = rng.choice(keys)
+            await storage.set_state(key, "PassengerReg:phone")
+            await storage.set_data(key, {"name": f"P{key.user_id}", "step": step})
+            await storage.get_state(key)
+            await storage.get_data(key)
+        return (time.perf_counter() - started) / args.updates
+
+    memory = MemoryStorage()
+    print(f"{'MemoryStorage':32s} {await cycles(memory) * 1e6:8.1f} мкс/обн")
+    await memory.close()
+    sqlite = SQLiteStorage()
+    await sqlite.open()
+    try:
+        per_update = await cycles(sqlite)
+        dirty = len(sqlite._dirty)
+        started = time.perf_counter()
+        await sqlite.flush()
+        flushed = time.perf_counter() - started
+    finally:
+        await sqlite.close()
+    print(f"{'SQLiteStorage':32s} {per_update * 1e6:8.1f} мкс/обн, сброс {dirty} ключей за {flushed * 1000:.1f} мс")
+
+
+async def bench_callbacks(args):
+    """feed_update нажатия последней зарегистрированной кнопки: лямбда-фильтры против CallbackDispatcher"""
+    from aiogram import Bot, Dispatcher, Router
+    from aiogram.types import Update
+    from callbacks import CallbackDispatcher
+
+    async def handler(callback):
+        return None
+
+    bot = Bot(BOT_TOKEN)
+    try:
+        for count in (10, 25, 50, 100, 200):
+            filtered = Router()  # Как было: обработчик на кнопку с lambda-фильтром по callback.data
+            for index in range(count):
+                filtered.callback_query.register(handler, lambda callback, data=f"k{index}": callback.data == data)
+            callbacks = CallbackDispatcher()
+            for index in range(count):
+                callbacks.handler(f"k{index}")(handler)
+            routed = Router()
+            routed.callback_query.register(callbacks.dispatch)
+
+            update = Update.model_validate({"update_id": 1, "callback_query": {
+                "id": "1", "from": {"id": 5, "is_bot": False, "first_name": "User"}, "chat_instance": "1",
+                "data": f"k{count - 1}"}}, context={"bot": bot})  # Худший случай для перебора фильтров
+            results = []
+            for router in (filtered, routed):
+                dp = Dispatcher()
+                dp.include_router(router)
+                for _ in range(min(args.updates, 200)):
+                    await dp.feed_update(bot, update)
+                started = time.perf_counter()
+                for _ in range(args.updates):
+                    await dp.feed_update(bot, update)
+                results.append((time.perf_counter() - started) / args.updates)
+            print(f"{count:4d} обработчиков: фильтры {results[0] * 1e6:8.1f} мкс  словарь {results[1] * 1e6:6.1f} мкс")
+    finally:
+        await bot.session.close()
+
+
+async def bench_replies(args):
+    """Сборка и сериализация ответа с меню пассажира: клавиатура на каждый ответ против реестра replies"""
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.methods import EditMessageText
+    from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    import replies
+
+    route = "🛫 Ташкент ➡️ Нукус 🛬"
+    plain, prebuilt = AiohttpSession(), replies.PrebuiltSession()
+    bot = Bot(BOT_TOKEN, session=plain)
+
+    def built_per_reply():  # Как было: клавиатура и текст собираются в обработчике
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="✏ Изменить маршрут", callback_data="change_passenger_route")],
+            [InlineKeyboardButton(text="🔄 Найти водителей", callback_data="find_drivers")],
+        ])
+        method = EditMessageText(chat_id=1, message_id=2, reply_markup=keyboard, text=(
+            f"🧑‍💼 Вы зарегистрированы как пассажир.\n"
+            f"🛣 Ваш маршрут: {route}\n\n"
+            f"Выберите действие:"))
+        return plain.build_form_data(bot, method)
+
+    def from_registry(session):
+        def reply():
+            method = EditMessageText(chat_id=1, message_id=2, reply_markup=replies.keyboard("passenger_menu"),
+                                     text=replies.text("passenger_menu", route=route))
+            return session.build_form_data(bot, method)
+        return reply
+
+    def fields(form):
+        return sorted((options["name"], value) for options, _, value in form._fields)
+
+    try:
+        for name, reply in (("клавиатура на каждый ответ", built_per_reply),
+                            ("реестр, обычная сессия", from_registry(plain)),
+                            ("реестр + PrebuiltSession", from_registry(prebuilt))):
+            assert fields(reply()) == fields(built_per_reply()), f"{name}: поля формы отличаются"
+            per_reply = min(timeit.repeat(reply, number=args.updates, repeat=5)) / args.updates
+            tracemalloc.start()
+            peaks = []
+            for _ in range(200):
+                current = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                reply()
+                peaks.append(tracemalloc.get_traced_memory()[1] - current)
+            tracemalloc.stop()
+            print(f"{name:32s} {per_reply * 1e6:8.1f} мкс/ответ, пик памяти {percentile(peaks, 0.5)} Б/ответ")
+    finally:
+        await plain.close()
+        await prebuilt.close()
+
+
+BENCHMARKS = {
+    "db": bench_db,
+    "storage": bench_storage,
+    "callbacks": bench_callbacks,
+    "replies": bench_replies,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=list(BENCHMARKS), nargs="?", help="по умолчанию — все по очереди")
+    parser.add_argument("--users", type=int, default=20000, help="пользователей в базе")
+    parser.add_argument("--updates", type=int, default=5000, help="обновлений на замер")
+    parser.add_argument("--concurrency", type=int, default=20, help="одновременно обрабатываемых обновлений")
+    return parser.parse_args()
+
+
+async def run(args):
+    for name, bench in BENCHMARKS.items():
+        if args.benchmark in (None, name):
+            print(f"== {name}: {bench.__doc__}")
+            await bench(args)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    os.environ.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "ADMIN_ID": str(ADMIN_ID),
+        "DB_PATH": os.path.join(workdir, "database.db"),
+        "FSM_DB_PATH": os.path.join(workdir, "fsm.db"),
+    })
+    asyncio.run(run(args))
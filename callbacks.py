@@ -0,0 +1,140 @@
+import logging
+
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import CallbackQuery
+
+from routes import route_catalog
+
+
+# Форматы callback_data: короткий префикс и типизированные поля через ":" (лимит Telegram — 64 байта).
+# Маршрут передаётся номером route_id из таблицы routes, а не текстом с эмодзи.
+class BookDriver(CallbackData, prefix="bd"):
+    driver_id: int
+
+
+class ApproveDriver(CallbackData, prefix="ap"):
+    driver_id: int
+
+
+class RejectDriver(CallbackData, prefix="rj"):
+    driver_id: int
+
+
+class DriverRoute(CallbackData, prefix="rd"):
+    route: int  # route_id
+
+
+class PassengerRoute(CallbackData, prefix="rp"):
+    route: int
+
+
+class ConfirmRoute(CallbackData, prefix="rc"):
+    route: int
+
+
+class DriverSearch(CallbackData, prefix="ds"):
+    sort: str  # код порядка из database.DRIVER_SORTS
+    page: int  # номер страницы с нуля
+
+
+class DriversPage(CallbackData, prefix="ld"):
+    view: str  # код фильтра списка
+    direction: str  # n — вперёд от cursor, p — назад
+    cursor: int
+
+
+class PassengersPage(CallbackData, prefix="lp"):
+    view: str
+    direction: str
+    cursor: int
+
+
+_ROUTE_SLUGS = {"tashkent_nukus": 1, "nukus_tashkent": 2}
+_ROUTE_POSITIONS = (1, 2)  # route_id по номеру маршрута в прежнем кортеже ROUTES
+
+
+def _route_by_label(label: str) -> int:
+    return next(route.route_id for route in route_catalog.active() if route.label == label)
+
+
+# Кнопки старого формата, оставшиеся в уже отправленных сообщениях
+_LEGACY = (
+    ("book_driver_", lambda rest: BookDriver(driver_id=int(rest))),
+    ("approve_", lambda rest: ApproveDriver(driver_id=int(rest))),
+    ("reject_", lambda rest: RejectDriver(driver_id=int(rest))),
+    ("driver_route_", lambda rest: DriverRoute(route=_ROUTE_SLUGS[rest])),
+    ("passenger_route_", lambda rest: PassengerRoute(route=_ROUTE_SLUGS[rest])),
+    ("confirm_route_", lambda rest: ConfirmRoute(route=_route_by_label(rest))),
+    # Номер в ROUTES вместо route_id (до появления таблицы routes)
+    ("dr:", lambda rest: DriverRoute(route=_ROUTE_POSITIONS[int(rest)])),
+    ("pr:", lambda rest: PassengerRoute(route=_ROUTE_POSITIONS[int(rest)])),
+    ("cr:", lambda rest: ConfirmRoute(route=_ROUTE_POSITIONS[int(rest)])),
+)
+
+
+class CallbackDispatcher:
+    """Маршрутизация callback-запросов одним поиском в словаре по префиксу callback_data.
+
+    Обработчики регистрируются на точную строку (кнопки без параметров) или на класс
+    CallbackData; во втором случае обработчик получает разобранный callback_data.
+    В aiogram регистрируется единственный обработчик dispatch, так что стоимость
+    маршрутизации не зависит от числа кнопок.
+    """
+
+    def __init__(self):
+        self._routes = {}  # префикс или точная строка -> (класс CallbackData или None, обработчик)
+
+    def handler(self, key):
+        """Декоратор: key — строка callback_data или класс CallbackData"""
+        prefix = key if isinstance(key, str) else key.__prefix__
+        cls = None if isinstance(key, str) else key
+
+        def register(callback):
+            if prefix in self._routes:
+                raise ValueError(f"Префикс callback_data уже занят: {prefix}")
+            self._routes[prefix] = (cls, CallableObject(callback))
+            return callback
+        return register
+
+    def resolve(self, data: str):
+        """Возвращает (обработчик, разобранный callback_data) или None"""
+        prefix, separator, _ = data.partition(":")
+        route = self._routes.get(prefix)
+        if route is None:
+            return self._resolve_legacy(data)
+        cls, handler = route
+        if cls is None:
+            return (handler, None) if not separator else None
+        try:
+            return handler, cls.unpack(data)
+        except (TypeError, ValueError):
+            return None
+
+    def _resolve_legacy(self, data: str):
+        for prefix, convert in _LEGACY:
+            if data.startswith(prefix):
+                try:
+                    return self.resolve(convert(data[len(prefix):]).pack())
+                except (KeyError, IndexError, StopIteration, ValueError):
+                    return None
+        return None
+
+    def resolve_name(self, callback: CallbackQuery) -> str:
+        """Имя конечного обработчика для метрик"""
+        resolved = self.resolve(callback.data or "")
+        return resolved[0].callback.__name__ if resolved else "unknown_callback"
+
+    async def dispatch(self, callback: CallbackQuery, **kwargs):
+        resolved = self.resolve(callback.data or "")
+        if resolved is None:
+            logging.warning(f"Неизвестный callback_data от {callback.from_user.id}: {callback.data!r}")
+            await callback.answer()
+            return
+        handler, callback_data = resolved
+        if callback_data is not None:
+            kwargs["callback_data"] = callback_data
+        return await handler.call(callback, **kwargs)
+
+
+callbacks = CallbackDispatcher()
@@ -0,0 +1,422 @@
+"""Запуск бота несколькими процессами.
+
+Главный процесс получает обновления (long polling или вебхук) и раскладывает их по спискам
+Redis bot:updates:<n> по user_id, так что все события одного пользователя обрабатывает один
+воркер и в порядке поступления. Воркеры — отдельные процессы с общими FSM-хранилищем,
+блокировками пользователей и сроками тайм-аутов в Redis. Изменения в users расходятся
+по процессам через канал bot:events. Фоновые задачи (подписки, outbox, проверка тайм-аутов,
+восстановление отложенных действий, сверка статистики) выполняет только главный процесс.
+
+    BOT_WORKERS=4 REDIS_URL=redis://127.0.0.1:6379/0 python main.py
+
+Нужен пакет redis (pip install redis); без него или без сервера Redis бот работает
+одним процессом с SQLite-хранилищем FSM.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+
+from aiogram import Bot
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.methods import GetUpdates
+from aiogram.types import Update
+from aiohttp import web
+
+import metrics
+from database import init_db_pool, close_db_pool, driver_index, load_banned_users, reload_user, change_listeners
+from delayed import delayed_actions
+from outbox import admin_outbox
+from route_watch import route_notifier
+from routes import route_catalog
+from send_scheduler import send_scheduler, TokenBucket, SEND_GLOBAL_RATE
+from subscriptions import SubscriptionEnforcer
+from stats import StatsReconciler
+from webhook import WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))  # на процесс
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "64"))  # событий в работе на воркер
+WORKER_BACKLOG = int(os.getenv("WORKER_BACKLOG", "1000"))  # событий, взятых из очереди и ещё не обработанных
+POLLING_TIMEOUT = 10
+QUEUE_WAIT = 5  # секунд на BLPOP, чтобы соединение не висело бесконечно
+
+QUEUE_PREFIX = "bot:updates:"
+EVENTS_CHANNEL = "bot:events"
+DEADLINES_KEY = "bot:fsm:deadlines"
+
+
+async def connect_redis():
+    """Клиент Redis или None, если пакет redis не установлен или сервер недоступен"""
+    try:
+        from redis.asyncio import Redis, BlockingConnectionPool
+    except ImportError:
+        logging.warning("Пакет redis не установлен")
+        return None
+    # Блокирующий пул: при всплеске запросы ждут свободное соединение, а не падают с «Too many connections»
+    redis = Redis(connection_pool=BlockingConnectionPool.from_url(REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS))
+    try:
+        await redis.ping()
+    except Exception as e:
+        logging.warning(f"Redis {REDIS_URL} недоступен: {e}")
+        await redis.aclose()
+        return None
+    return redis
+
+
+def update_user_id(update: dict) -> int:
+    """user_id отправителя из сырого обновления Telegram (0, если его нет)"""
+    for value in update.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("user") or value.get("chat")
+            if isinstance(sender, dict) and "id" in sender:
+                return sender["id"]
+    return 0
+
+
+def _share_send_rate(processes: int):
+    # Лимит Telegram общий на бота: делим его между процессами поровну
+    rate = SEND_GLOBAL_RATE / processes
+    send_scheduler.global_bucket = TokenBucket(rate, rate)
+
+
+class SharedTimeouts:
+    """Сроки бездействия FSM в сортированном множестве Redis (значение — срок в unix-времени)"""
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    async def touch(self, key: StorageKey, deadline: float):
+        await self.redis.zadd(DEADLINES_KEY, {f"{key.bot_id}:{key.chat_id}:{key.user_id}": deadline})
+
+    async def pending(self, key: StorageKey) -> bool:
+        """Срок сессии снова стоит в множестве (пользователь продлил его после pop_due)"""
+        return await self.redis.zscore(DEADLINES_KEY, f"{key.bot_id}:{key.chat_id}:{key.user_id}") is not None
+
+    async def pop_due(self, now: float, limit: int):
+        """Забирает до limit истёкших сроков; ещё не истёкшие возвращает обратно"""
+        popped = await self.redis.zpopmin(DEADLINES_KEY, limit)
+        due, early = [], {}
+        for member, deadline in popped:
+            if deadline <= now:
+                bot_id, chat_id, user_id = map(int, member.decode().split(":"))
+                due.append(StorageKey(bot_id=bot_id, chat_id=chat_id, user_id=user_id))
+            else:
+                early[member] = deadline
+        if early:
+            # GT: если пользователь успел продлить срок, пока запись была снята, оставляем более поздний
+            await self.redis.zadd(DEADLINES_KEY, early, gt=True)
+        return due
+
+
+class ClusterBus:
+    """Канал событий между процессами: изменения в users и пробуждение outbox"""
+
+    def __init__(self, redis, origin: str):
+        self.redis = redis
+        self.origin = origin
+        self._pending = set()
+        self._listener = None
+
+    def _publish(self, message: str):
+        task = asyncio.create_task(self.redis.publish(EVENTS_CHANNEL, f"{self.origin}:{message}"))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    def user_changed(self, user_id: int):
+        self._publish(f"user:{user_id}")
+
+    def outbox_added(self):
+        self._publish("outbox:")
+
+    def start(self):
+        change_listeners.append(self.user_changed)
+        admin_outbox.wake_listeners.append(self.outbox_added)
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+        await asyncio.gather(*self._pending, return_exceptions=True)
+
+    async def _listen(self):
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(EVENTS_CHANNEL)
+        try:
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                origin, kind, value = message["data"].decode().split(":", 2)
+                if origin == self.origin:
+                    continue
+                try:
+                    if kind == "user":
+                        await reload_user(int(value))
+                    elif kind == "outbox":
+                        admin_outbox._wakeup.set()
+                except Exception as e:
+                    logging.error(f"Ошибка обработки события {kind}:{value} из {origin}: {e}")
+        finally:
+            await pubsub.aclose()
+
+
+class Worker:
+    """Процесс-воркер: читает свой список обновлений и передаёт их в Dispatcher.
+
+    События разных пользователей обрабатываются параллельно (до WORKER_CONCURRENCY),
+    события одного пользователя — строго друг за другом. Слот занимается только на время
+    feed_update: событие, ждущее предыдущее событие своего пользователя, слот не держит,
+    поэтому поток событий одного пользователя не останавливает остальных. Из Redis
+    забирается не больше WORKER_BACKLOG необработанных событий.
+    """
+
+    def __init__(self, index: int, workers: int):
+        self.index = index
+        self.workers = workers
+        self._slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+        self._backlog = asyncio.Semaphore(WORKER_BACKLOG)
+        self._tails = {}  # user_id -> задача последнего события пользователя
+        self._tasks = set()
+
+    async def run(self):
+        import main  # Здесь, а не наверху: main сам импортирует этот модуль
+        redis = await connect_redis()
+        if redis is None:
+            raise RuntimeError("Воркеру нужен Redis")
+        await init_db_pool()
+        await route_catalog.load()
+        await driver_index.load()
+        await load_banned_users()
+        _share_send_rate(self.workers + 1)
+        bot = main.create_bot()
+        storage, events_isolation = await main.create_storage(redis)
+        dp = main.create_dispatcher(storage, main.TimeoutMiddleware(shared=SharedTimeouts(redis)), events_isolation)
+        main.register_gauges()
+        if metrics.METRICS_PORT:
+            metrics.METRICS_PORT += 1 + self.index  # Главный процесс занимает METRICS_PORT
+        metrics_runner = await metrics.start_metrics_server()
+        bus = ClusterBus(redis, f"worker{self.index}")
+        bus.start()
+        await delayed_actions.start(bot, restore=False)  # Действия упавших воркеров забираются по истечении аренды
+        logging.info(f"Воркер {self.index} запущен")
+        try:
+            await self._consume(dp, bot, redis)
+        finally:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            await delayed_actions.stop()
+            await route_notifier.close()
+            await bus.stop()
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+            await events_isolation.close()
+            await storage.close()
+            await bot.session.close()
+            await close_db_pool()
+
+    async def _consume(self, dp, bot: Bot, redis):
+        queue = f"{QUEUE_PREFIX}{self.index}"
+        while True:
+            await self._backlog.acquire()
+            try:
+                item = await redis.blpop([queue], timeout=QUEUE_WAIT)
+            except Exception as e:
+                self._backlog.release()
+                if asyncio.current_task().cancelling():
+                    raise asyncio.CancelledError  # redis-py превращает отмену в свой TimeoutError
+                logging.error(f"Ошибка чтения очереди {queue}: {e}")
+                await asyncio.sleep(1)
+                continue
+            except BaseException:
+                self._backlog.release()
+                raise
+            if item is None:
+                self._backlog.release()
+                continue
+            data = json.loads(item[1])
+            user_id = update_user_id(data)
+            task = asyncio.create_task(self._handle(dp, bot, data, self._tails.get(user_id)))
+            self._tails[user_id] = task
+            self._tasks.add(task)
+            task.add_done_callback(lambda t, u=user_id: self._forget(u, t))
+
+    def _forget(self, user_id: int, task):
+        self._tasks.discard(task)
+        if self._tails.get(user_id) is task:
+            del self._tails[user_id]
+
+    async def _handle(self, dp, bot: Bot, data: dict, previous):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            async with self._slots:
+                await dp.feed_update(bot, Update.model_validate(data, context={"bot": bot}))
+        except Exception as e:
+            logging.error(f"Ошибка обработки обновления {data.get('update_id')}: {e}")
+        finally:
+            self._backlog.release()
+
+
+def run_worker(index: int, workers: int):
+    """Точка входа процесса-воркера"""
+    logging.basicConfig(level=logging.INFO, format=f"[worker{index}] %(levelname)s:%(name)s:%(message)s")
+
+    async def guarded():
+        task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, task.cancel)
+        loop.add_signal_handler(signal.SIGINT, task.cancel)
+        await Worker(index, workers).run()
+
+    try:
+        asyncio.run(guarded())
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        pass
+
+
+class Front:
+    """Главный процесс: запускает воркеров, принимает обновления и раскладывает их по воркерам"""
+
+    def __init__(self, redis, workers: int):
+        self.redis = redis
+        self.workers = workers
+        self.processes = []
+        self._context = multiprocessing.get_context("spawn")
+        self._stopping = False
+
+    def _spawn(self, index: int):
+        process = self._context.Process(target=run_worker, args=(index, self.workers), name=f"bot-worker-{index}")
+        process.start()
+        return process
+
+    async def _supervise(self):
+        while True:
+            await asyncio.sleep(1)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive() and not self._stopping:
+                    logging.error(f"Воркер {index} завершился с кодом {process.exitcode}, перезапускаем")
+                    self.processes[index] = self._spawn(index)
+
+    async def _dispatch(self, updates):
+        # MULTI/EXEC: при обрыве соединения пачка не оказывается в очередях наполовину
+        pipe = self.redis.pipeline(transaction=True)
+        for data in updates:
+            pipe.rpush(f"{QUEUE_PREFIX}{update_user_id(data) % self.workers}", json.dumps(data))
+        await pipe.execute()
+
+    async def _poll(self, bot: Bot, allowed_updates):
+        offset = None
+        while True:
+            try:
+                updates = await bot(GetUpdates(offset=offset, timeout=POLLING_TIMEOUT, allowed_updates=allowed_updates))
+            except Exception as e:
+                logging.error(f"Ошибка получения обновлений: {e}")
+                await asyncio.sleep(1)
+                continue
+            if not updates:
+                continue
+            try:
+                await self._dispatch([update.model_dump(mode="json", by_alias=True, exclude_none=True)
+                                      for update in updates])
+            except Exception as e:
+                # offset не сдвигаем: Telegram отдаст те же обновления при следующем запросе
+                logging.error(f"Ошибка передачи обновлений воркерам: {e}")
+                await asyncio.sleep(1)
+                continue
+            offset = updates[-1].update_id + 1
+
+    async def _serve_webhook(self, bot: Bot, allowed_updates):
+        async def receive(request: web.Request):
+            if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+                return web.Response(status=401)
+            try:
+                await self._dispatch([await request.json()])
+            except Exception as e:
+                logging.error(f"Ошибка передачи обновления воркерам: {e}")
+                return web.Response(status=503)  # Telegram повторит доставку
+            return web.Response()
+
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, receive)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+            if WEBHOOK_URL:
+                await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                      allowed_updates=allowed_updates)
+        except Exception as e:
+            logging.error(f"Не удалось запустить вебхук, переключаемся на polling: {e}")
+            await runner.cleanup()
+            await bot.delete_webhook()
+            return await self._poll(bot, allowed_updates)
+        logging.info(f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    async def run(self, mode: str, allowed_updates):
+        import main
+        await init_db_pool()
+        await route_catalog.load()
+        await driver_index.load()
+        _share_send_rate(self.workers + 1)
+        bot = main.create_bot()
+        storage, events_isolation = await main.create_storage(self.redis)
+        timeout_middleware = main.TimeoutMiddleware(shared=SharedTimeouts(self.redis), storage=storage, bot=bot)
+        main.register_gauges()
+        metrics_runner = await metrics.start_metrics_server()
+        bus = ClusterBus(self.redis, "front")
+        bus.start()
+        subscription_enforcer = SubscriptionEnforcer(bot)
+        stats_reconciler = StatsReconciler()
+
+        # Действия прошлого запуска забираются до запуска воркеров, чтобы не отнять их строки
+        await delayed_actions.start(bot)
+        self.processes = [self._spawn(index) for index in range(self.workers)]
+        supervisor = asyncio.create_task(self._supervise())
+        timeout_middleware.start()
+        subscription_enforcer.start()
+        stats_reconciler.start()
+        admin_outbox.start(bot)
+        logging.info(f"✅ Бот запущен: {self.workers} воркеров, режим {mode}")
+
+        receiver = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, receiver.cancel)
+        loop.add_signal_handler(signal.SIGINT, receiver.cancel)
+        try:
+            if mode == "webhook":
+                await self._serve_webhook(bot, allowed_updates)
+            else:
+                await self._poll(bot, allowed_updates)
+        except asyncio.CancelledError:
+            logging.info("Остановка: завершаем воркеров")
+        finally:
+            loop.remove_signal_handler(signal.SIGTERM)
+            loop.remove_signal_handler(signal.SIGINT)
+            self._stopping = True
+            supervisor.cancel()
+            for process in self.processes:
+                process.terminate()
+            await asyncio.gather(*(asyncio.to_thread(process.join, 30) for process in self.processes))
+            await timeout_middleware.stop()
+            await subscription_enforcer.stop()
+            await stats_reconciler.stop()
+            await admin_outbox.stop()
+            await delayed_actions.stop()
+            await bus.stop()
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+            await events_isolation.close()
+            await storage.close()
+            await bot.session.close()
+            await close_db_pool()
+
+
+async def run_cluster(redis, mode: str, allowed_updates):
+    await Front(redis, BOT_WORKERS).run(mode, allowed_updates)
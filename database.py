@@ -1,136 +1,632 @@
 import aiosqlite
+import asyncio
+import bisect
+import heapq
 import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import NamedTuple
 
-async def get_db_connection():
-    """Открывает соединение с базой данных"""
-    return await aiosqlite.connect("database.db")
+from metrics import db_query_latency
+from migrations import migrate
 
-async def setup_database():
-    conn = await get_db_connection()
-    try:
-        # Создаем таблицу
-        await conn.executescript("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                role TEXT,
-                name TEXT,
-                phone TEXT,
-                car_info TEXT,
-                route TEXT DEFAULT NULL,
-                available INTEGER DEFAULT 0,
-                rides_count INTEGER DEFAULT 0,
-                subscribed INTEGER DEFAULT 0,
-                banned INTEGER DEFAULT 0,
-                last_route_change TIMESTAMP DEFAULT NULL,
-                subscription_end TIMESTAMP DEFAULT NULL,
-                passport TEXT DEFAULT NULL,
-                payment TEXT DEFAULT NULL,
-                price INTEGER DEFAULT NULL,
-                last_arrival_time TIMESTAMP DEFAULT NULL
-            );
-            CREATE INDEX IF NOT EXISTS idx_users_route ON users(route);
-        """)
-        await conn.commit()
-        logging.info("Таблица users успешно создана или уже существует")
+DB_PATH = os.getenv("DB_PATH", "database.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_BUSY_TIMEOUT_MS = 5000
 
-        # Проверяем, что таблица действительно создана
-        async with conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users';") as cursor:
-            result = await cursor.fetchone()
-            if result:
-                logging.info("Таблица users подтверждена в базе данных")
-            else:
-                logging.error("Таблица users не найдена после создания")
-
-        # Проверяем наличие колонок и добавляем их, если их нет
-        async with conn.execute("PRAGMA table_info(users);") as cursor:
-            columns = [row[1] for row in await cursor.fetchall()]
-            logging.info(f"Существующие колонки в таблице users: {columns}")
-
-        if "passport" not in columns:
-            await conn.execute("ALTER TABLE users ADD COLUMN passport TEXT DEFAULT NULL;")
-            logging.info("Добавлена колонка passport")
-        if "payment" not in columns:
-            await conn.execute("ALTER TABLE users ADD COLUMN payment TEXT DEFAULT NULL;")
-            logging.info("Добавлена колонка payment")
-        if "price" not in columns:
-            await conn.execute("ALTER TABLE users ADD COLUMN price INTEGER DEFAULT NULL;")
-            logging.info("Добавлена колонка price")
-        if "last_arrival_time" not in columns:
-            await conn.execute("ALTER TABLE users ADD COLUMN last_arrival_time TIMESTAMP DEFAULT NULL;")
-            logging.info("Добавлена колонка last_arrival_time")
 
-        await conn.commit()
-        logging.info("Все необходимые колонки добавлены или уже существуют")
+_statement_names = {}
+
+
+def statement_name(sql: str) -> str:
+    """Короткое имя запроса для метрик: операция и таблица, например 'SELECT users'"""
+    name = _statement_names.get(sql)
+    if name is None:
+        words = sql.replace("(", " ").replace(";", " ").split()
+        operation = words[0].upper() if words else "?"
+        table = ""
+        for i, word in enumerate(words[:-1]):
+            if word.upper() in ("FROM", "INTO", "UPDATE", "TABLE", "ON"):
+                table = next((w for w in words[i + 1:] if w.upper() not in ("IF", "NOT", "EXISTS")), "")
+                break
+        name = _statement_names[sql] = f"{operation} {table}".strip()
+    return name
+
+
+class _TimedResult:
+    """Обёртка над conn.execute(): поддерживает и await, и async with, и замеряет время запроса"""
+    __slots__ = ("_result", "_name", "_cursor")
+
+    def __init__(self, result, name: str):
+        self._result = result
+        self._name = name
+        self._cursor = None
+
+    async def _run(self):
+        started = time.perf_counter()
+        try:
+            return await self._result
+        finally:
+            db_query_latency.labels(self._name).observe(time.perf_counter() - started)
+
+    def __await__(self):
+        return self._run().__await__()
+
+    async def __aenter__(self):
+        self._cursor = await self._run()
+        return self._cursor
+
+    async def __aexit__(self, *exc_info):
+        await self._cursor.close()
+
+
+class TimedConnection:
+    """Соединение aiosqlite, у которого каждый execute/executemany попадает в метрики по имени запроса"""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def execute(self, sql: str, parameters=None):
+        return _TimedResult(self._conn.execute(sql, parameters), statement_name(sql))
+
+    def executemany(self, sql: str, parameters):
+        return _TimedResult(self._conn.executemany(sql, parameters), statement_name(sql))
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+async def open_connection(path: str = None):
+    """Открывает соединение с WAL-журналом, таймаутом блокировки и кэшем подготовленных запросов"""
+    conn = TimedConnection(await aiosqlite.connect(path or DB_PATH, cached_statements=256))
+    await conn.execute("PRAGMA journal_mode=WAL;")
+    await conn.execute("PRAGMA synchronous=NORMAL;")
+    await conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS};")
+    return conn
+
+
+class ConnectionPool:
+    """Ограниченный пул долгоживущих соединений с базой данных"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._idle = asyncio.Queue(maxsize=size)
+        self._connections = []
+
+    async def open(self):
+        for _ in range(self.size):
+            conn = await open_connection()
+            self._connections.append(conn)
+            self._idle.put_nowait(conn)
+        logging.info(f"Пул соединений с базой данных открыт ({self.size} соединений)")
+
+    @asynccontextmanager
+    async def acquire(self):
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            # Незавершённая транзакция не должна достаться следующему обработчику
+            if conn.in_transaction:
+                await conn.rollback()
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        for conn in self._connections:
+            await conn.close()
+        self._connections.clear()
+        logging.info("Пул соединений с базой данных закрыт")
 
+
+_pool = None
+
+
+async def init_db_pool():
+    """Открывает общий пул соединений; вызывается один раз из main() после setup_database()"""
+    global _pool
+    if _pool is None:
+        pool = ConnectionPool(DB_POOL_SIZE)
+        await pool.open()
+        _pool = pool
+
+
+async def close_db_pool():
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
+
+
+@asynccontextmanager
+async def get_db_connection():
+    """Выдаёт соединение из пула (или временное соединение, если пул ещё не открыт)"""
+    if _pool is not None:
+        async with _pool.acquire() as conn:
+            yield conn
+        return
+    conn = await open_connection()
+    try:
+        yield conn
+    finally:
+        await conn.close()
+
+
+async def setup_database():
+    """Доводит схему базы до актуальной версии; на актуальной базе это один PRAGMA"""
+    conn = await open_connection()
+    try:
+        await migrate(conn)
     except Exception as e:
         logging.error(f"Ошибка при создании/обновлении базы данных: {e}", exc_info=True)
+        raise
     finally:
         await conn.close()
 
+
+class User(NamedTuple):
+    user_id: int
+    role: str
+    name: str
+    phone: str
+    car_info: str
+    route_id: int
+    available: int
+    rides_count: int
+    subscribed: int
+    banned: int
+    last_route_change: str
+    subscription_end: str
+    passport: str
+    payment: str
+    price: int
+    last_arrival_time: str
+
+
+# Колонки перечислены по имени, чтобы изменение схемы не сдвигало поля записи
+_USER_COLUMNS = ", ".join(User._fields)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300"))
+
+
+class UserCache:
+    """LRU-кэш профилей с TTL перед fetch_user; сбрасывается после каждой записи в users"""
+
+    def __init__(self, size: int, ttl: int):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (срок годности, User)
+        # Счётчик сбросов и момент последнего сброса по каждому user_id: прочитанное до записи
+        # в этого же пользователя не сохраняется, записи в других пользователей чтению не мешают
+        self.clock = 0
+        self._written = OrderedDict()  # user_id -> clock последнего сброса, не больше size записей
+        self._forgotten = 0  # clock самой свежей вытесненной из _written записи
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user: User, since: int = None):
+        """since — значение clock до чтения из базы; если пользователь с тех пор менялся, запись не кэшируется"""
+        if since is not None and max(self._written.get(user.user_id, 0), self._forgotten) > since:
+            return
+        self._entries[user.user_id] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(user.user_id)
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def update(self, user_id: int, **fields):
+        """Точечно обновляет закэшированную запись после известной записи в базу"""
+        entry = self._entries.get(user_id)
+        self.invalidate(user_id)
+        if entry is not None:
+            self.put(entry[1]._replace(**fields))
+
+    def invalidate(self, user_id: int):
+        self.clock += 1
+        self._written[user_id] = self.clock
+        self._written.move_to_end(user_id)
+        if len(self._written) > self.size:
+            self._forgotten = self._written.popitem(last=False)[1]
+        self._entries.pop(user_id, None)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+# Функции user_id -> None, которым сообщается о записи в users (например, рассылка другим процессам)
+change_listeners = []
+
+
+def _notify_change(user_id: int):
+    for listener in change_listeners:
+        listener(user_id)
+
+
+async def user_changed(user_id: int, conn=None):
+    """Вызывается после любой записи в users: сбрасывает кэш профиля и обновляет индекс водителей"""
+    user_cache.invalidate(user_id)
+    await driver_index.refresh(user_id, conn)
+    _notify_change(user_id)
+
+
+async def reload_user(user_id: int):
+    """Перечитывает пользователя после записи, сделанной другим процессом"""
+    user_cache.invalidate(user_id)
+    async with get_db_connection() as conn:
+        async with conn.execute("SELECT banned FROM users WHERE user_id=?", (user_id,)) as cursor:
+            row = await cursor.fetchone()
+        if row and row[0]:
+            banned_users.add(user_id)
+        else:
+            banned_users.discard(user_id)
+        await driver_index.refresh(user_id, conn)
+
+
+async def _upsert_user(conn, user_id: int, role: str, name: str, phone: str, car_info: str = None,
+                       route_id: int = None):
+    from datetime import datetime, timedelta
+    subscription_end = (datetime.now() + timedelta(days=10)).strftime("%Y-%m-%d %H:%M:%S")
+    await conn.execute("""
+        INSERT INTO users (user_id, role, name, phone, car_info, route_id, available, rides_count, subscription_end)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET 
+            car_info=excluded.car_info,
+            subscription_end=excluded.subscription_end;
+    """, (user_id, role, name, phone, car_info, route_id, 1 if role == "driver" else 0, 0, subscription_end))
+
+
 # Остальные функции остаются без изменений
-async def save_user(user_id: int, role: str, name: str, phone: str, car_info: str = None, route: str = None):
-    async with aiosqlite.connect("database.db") as conn:
+async def save_user(user_id: int, role: str, name: str, phone: str, car_info: str = None, route_id: int = None):
+    async with get_db_connection() as conn:
         try:
-            from datetime import datetime, timedelta
-            subscription_end = (datetime.now() + timedelta(days=10)).strftime("%Y-%m-%d %H:%M:%S")
-            await conn.execute("""
-                INSERT INTO users (user_id, role, name, phone, car_info, route, available, rides_count, subscription_end)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET 
-                    car_info=excluded.car_info,
-                    subscription_end=excluded.subscription_end;
-            """, (user_id, role, name, phone, car_info, route, 1 if role == "driver" else 0, 0, subscription_end))
+            await _upsert_user(conn, user_id, role, name, phone, car_info, route_id)
             await conn.commit()
+            await user_changed(user_id, conn)
             return True, None  # Успех, сообщение об ошибке не нужно
         except Exception as e:
             logging.error(f"Ошибка сохранения пользователя {user_id}: {e}")
             return False, "⚠️ Ошибка при сохранении данных. Попробуйте позже."
 
 
+async def register_driver(user_id: int, name: str, phone: str, car_info: str, passport: str, payment: str):
+    """Сохраняет заявку водителя и ставит уведомление админу в outbox одной транзакцией"""
+    import json
+    from datetime import datetime
+    async with get_db_connection() as conn:
+        try:
+            await _upsert_user(conn, user_id, "driver", name, phone, car_info)
+            await conn.execute("UPDATE users SET passport=?, payment=?, available=0 WHERE user_id=?",
+                               (passport, payment, user_id))
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            payload = json.dumps({"name": name, "phone": phone, "car": car_info, "passport": passport,
+                                  "payment": payment}, ensure_ascii=False)
+            await conn.execute(
+                "INSERT INTO admin_outbox (driver_id, payload, created_at, next_attempt_at) VALUES (?, ?, ?, ?)",
+                (user_id, payload, now, now))
+            await conn.commit()
+            await user_changed(user_id, conn)
+            return True, None
+        except Exception as e:
+            logging.error(f"Ошибка сохранения заявки водителя {user_id}: {e}")
+            return False, "⚠️ Ошибка при сохранении данных. Попробуйте позже."
+
+
 async def set_driver_availability(user_id: int, available: bool):
-    conn = await get_db_connection()
-    try:
+    async with get_db_connection() as conn:
         await conn.execute("UPDATE users SET available=? WHERE user_id=?", (1 if available else 0, user_id))
         await conn.commit()
-    finally:
-        await conn.close()
+        user_cache.update(user_id, available=1 if available else 0)
+        await driver_index.refresh(user_id, conn)
+    _notify_change(user_id)
 
 async def fetch_user(user_id: int):
-    async with aiosqlite.connect("database.db") as conn:
+    """Профиль пользователя из кэша или из базы"""
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+    since = user_cache.clock
+    async with get_db_connection() as conn:
         try:
-            async with conn.execute("SELECT * FROM users WHERE user_id=?", (user_id,)) as cursor:
+            async with conn.execute(f"SELECT {_USER_COLUMNS} FROM users WHERE user_id=?", (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 if row:
-                    return {
-                        "user_id": row[0],
-                        "role": row[1],
-                        "name": row[2],
-                        "phone": row[3],
-                        "car_info": row[4],
-                        "route": row[5],
-                        "available": row[6],
-                        "rides_count": row[7],
-                        "subscribed": row[8],
-                        "banned": row[9],
-                        "last_route_change": row[10],
-                        "subscription_end": row[11],
-                        "passport": row[12],
-                        "payment": row[13],
-                        "price": row[14],
-                        "last_arrival_time": row[15]
-                    }
+                    user = User(*row)
+                    user_cache.put(user, since)
+                    return user
         except Exception as e:
             logging.error(f"Ошибка получения пользователя {user_id}: {e}")
     return None
 
 async def get_all_drivers():
-    conn = await get_db_connection()
-    try:
-        async with (conn.execute("SELECT user_id, name, phone, route, available FROM users WHERE role='driver'") as cursor):
-            drivers = await cursor.fetchall()
-            return drivers
-    except Exception as e:
-        logging.error(f"Ошибка при получении списка водителей: {e}")
-    finally:
-        await conn.close()
-    return []
\ No newline at end of file
+    async with get_db_connection() as conn:
+        try:
+            async with (conn.execute("SELECT user_id, name, phone, route_id, available FROM users WHERE role='driver'") as cursor):
+                drivers = await cursor.fetchall()
+                return drivers
+        except Exception as e:
+            logging.error(f"Ошибка при получении списка водителей: {e}")
+    return []
+
+async def fetch_users_page(role: str, where: str = "", params=(), after: int = None, before: int = None,
+                           limit: int = 10):
+    """Страница пользователей роли по ключу user_id (keyset-пагинация).
+
+    after — вернуть записи с user_id больше указанного, before — меньше (страница назад).
+    Возвращает (строки, есть_предыдущая, есть_следующая); читается не больше limit + 1 строк.
+    """
+    condition = "role=?" + (f" AND {where}" if where else "")
+    params = (role, *params)
+    async with get_db_connection() as conn:
+        if before is not None:
+            cursor = await conn.execute(
+                f"SELECT user_id, name, phone, car_info, route_id, available, banned FROM users "
+                f"WHERE {condition} AND user_id<? ORDER BY user_id DESC LIMIT ?",
+                (*params, before, limit + 1))
+            rows = await cursor.fetchall()
+            has_prev = len(rows) > limit
+            rows = rows[:limit][::-1]
+            has_next = True
+        else:
+            cursor = await conn.execute(
+                f"SELECT user_id, name, phone, car_info, route_id, available, banned FROM users "
+                f"WHERE {condition} AND user_id>? ORDER BY user_id LIMIT ?",
+                (*params, after or 0, limit + 1))
+            rows = await cursor.fetchall()
+            has_next = len(rows) > limit
+            rows = rows[:limit]
+            has_prev = bool(after)
+    return rows, has_prev, has_next
+
+# Заблокированные пользователи; проверка каждого события — один поиск в множестве
+banned_users = set()
+
+
+async def load_banned_users():
+    async with get_db_connection() as conn:
+        async with conn.execute("SELECT user_id FROM users WHERE banned=1") as cursor:
+            rows = await cursor.fetchall()
+    banned_users.clear()
+    banned_users.update(row[0] for row in rows)
+    logging.info(f"Заблокированных пользователей: {len(banned_users)}")
+
+
+async def set_user_banned(user_id: int, banned: bool) -> bool:
+    """Блокирует или разблокирует пользователя; возвращает False, если его нет в базе"""
+    async with get_db_connection() as conn:
+        cursor = await conn.execute("UPDATE users SET banned=? WHERE user_id=?", (1 if banned else 0, user_id))
+        await conn.commit()
+        found = cursor.rowcount > 0
+        if found:
+            if banned:
+                banned_users.add(user_id)
+            else:
+                banned_users.discard(user_id)
+        await user_changed(user_id, conn)
+    return found
+
+
+async def book_ride(passenger_id: int, driver_id: int, idempotency_key: str):
+    """Записывает поездку в журнал bookings и увеличивает rides_count водителя одной транзакцией.
+
+    Повторное нажатие с тем же ключом ничего не меняет. Возвращает (создана_ли_запись, имя водителя,
+    имя и телефон пассажира) или None, если водитель не найден.
+    """
+    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    async with get_db_connection() as conn:
+        cursor = await conn.execute("""
+            INSERT INTO bookings (idempotency_key, passenger_id, driver_id, route_id, price, created_at)
+            SELECT ?, ?, user_id, route_id, price, ? FROM users WHERE user_id=? AND role='driver' AND banned=0
+            ON CONFLICT(idempotency_key) DO NOTHING;
+        """, (idempotency_key, passenger_id, created_at, driver_id))
+        created = cursor.rowcount == 1
+        if created:
+            await conn.execute("UPDATE users SET rides_count = rides_count + 1 WHERE user_id=?", (driver_id,))
+        await conn.commit()
+        if created:
+            await user_changed(driver_id, conn)  # rides_count участвует в сортировке поиска водителей
+        cursor = await conn.execute("SELECT name FROM users WHERE user_id=? AND role='driver' AND banned=0",
+                                    (driver_id,))
+        driver_row = await cursor.fetchone()
+        cursor = await conn.execute("SELECT name, phone FROM users WHERE user_id=?", (passenger_id,))
+        passenger_row = await cursor.fetchone()
+    if not driver_row:
+        return None
+    return created, driver_row[0], passenger_row
+
+
+async def count_route_rides(route_id: int, since: str = None, conn=None) -> int:
+    """Число поездок по маршруту (с указанного момента) по индексу (route_id, created_at).
+
+    Число поездок водителя — колонка rides_count, её увеличивает book_ride в той же транзакции.
+    """
+    if conn is None:
+        async with get_db_connection() as conn:
+            return await count_route_rides(route_id, since, conn)
+    async with conn.execute(
+            "SELECT COUNT(*) FROM bookings WHERE route_id=? AND created_at>=?", (route_id, since or "")) as cursor:
+        return (await cursor.fetchone())[0]
+
+
+class IndexedDriver(NamedTuple):
+    user_id: int
+    name: str
+    phone: str
+    car_info: str
+    price: int
+    last_arrival_time: str
+    available: int
+    rides_count: int
+    subscription_end: str
+
+
+_INDEXED_DRIVER_COLUMNS = ("user_id, name, phone, car_info, price, last_arrival_time, available, rides_count,"
+                           " subscription_end, route_id")
+_INDEXED_DRIVER_FILTER = (
+    "role='driver' AND available=1 AND banned=0 AND route_id IS NOT NULL"
+    " AND (subscription_end IS NULL OR subscription_end > strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime'))"
+)
+
+# Порядки поиска водителей: код -> (ключ по возрастанию, выдавать с конца списка).
+# Водители без цены и без времени прибытия идут последними.
+DRIVER_SORTS = {
+    "price": (lambda driver: (driver.price is None, driver.price or 0), False),
+    "recent": (lambda driver: (driver.last_arrival_time is not None, driver.last_arrival_time or ""), True),
+    "rides": (lambda driver: driver.rides_count or 0, True),
+}
+
+
+class DriverIndex:
+    """Индекс доступных водителей по маршрутам в памяти процесса.
+
+    Строится при старте и обновляется после каждой записи, которая может изменить
+    видимость водителя, так что find_drivers не обращается к SQLite. Для каждого
+    маршрута и порядка из DRIVER_SORTS держится отсортированный список (ключ, user_id),
+    который правится bisect при каждом изменении: страница поиска — срез этого списка.
+    Водители с истёкшей подпиской убираются при обращении к индексу (куча сроков),
+    не дожидаясь, пока SubscriptionEnforcer снимет их с работы.
+    """
+
+    def __init__(self):
+        self._by_route = {}  # route_id -> {user_id: IndexedDriver}
+        self._route_of = {}  # user_id -> route_id
+        self._ranked = {}  # (route_id, порядок) -> отсортированный список (ключ, user_id)
+        self._versions = {}  # route_id -> номер версии списка водителей
+        self._expiry = []  # куча (subscription_end, user_id)
+        self._expiry_queued = {}  # user_id -> subscription_end, уже лежащий в куче
+
+    def _bump(self, route_id: int):
+        self._versions[route_id] = self._versions.get(route_id, 0) + 1
+
+    def _put(self, row):
+        driver, route = IndexedDriver(*row[:9]), row[9]
+        if self._route_of.get(driver.user_id) == route and self._by_route[route][driver.user_id] == driver:
+            return
+        self._discard(driver.user_id)
+        self._by_route.setdefault(route, {})[driver.user_id] = driver
+        self._route_of[driver.user_id] = route
+        for sort, (key, _) in DRIVER_SORTS.items():
+            bisect.insort(self._ranked.setdefault((route, sort), []), (key(driver), driver.user_id))
+        if driver.subscription_end is not None and self._expiry_queued.get(driver.user_id) != driver.subscription_end:
+            heapq.heappush(self._expiry, (driver.subscription_end, driver.user_id))
+            self._expiry_queued[driver.user_id] = driver.subscription_end
+        self._bump(route)
+
+    def _discard(self, user_id: int):
+        route = self._route_of.pop(user_id, None)
+        if route is not None:
+            drivers = self._by_route[route]
+            driver = drivers.pop(user_id)
+            if not drivers:
+                del self._by_route[route]
+            for sort, (key, _) in DRIVER_SORTS.items():
+                ranked = self._ranked[(route, sort)]
+                del ranked[bisect.bisect_left(ranked, (key(driver), user_id))]
+                if not ranked:
+                    del self._ranked[(route, sort)]
+            self._bump(route)
+
+    def _evict_expired(self):
+        """Убирает водителей, чья подписка закончилась после того, как их прочитали из таблицы"""
+        if not self._expiry:
+            return
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        while self._expiry and self._expiry[0][0] <= now:
+            subscription_end, user_id = heapq.heappop(self._expiry)
+            if self._expiry_queued.get(user_id) == subscription_end:
+                del self._expiry_queued[user_id]
+            route = self._route_of.get(user_id)
+            if route is not None and self._by_route[route][user_id].subscription_end == subscription_end:
+                self._discard(user_id)
+
+    async def _fetch_all(self, conn):
+        async with conn.execute(
+                f"SELECT {_INDEXED_DRIVER_COLUMNS} FROM users WHERE {_INDEXED_DRIVER_FILTER}") as cursor:
+            return await cursor.fetchall()
+
+    async def load(self):
+        async with get_db_connection() as conn:
+            rows = await self._fetch_all(conn)
+        for route in self._by_route:
+            self._bump(route)
+        self._by_route.clear()
+        self._route_of.clear()
+        self._ranked.clear()
+        self._expiry.clear()
+        self._expiry_queued.clear()
+        for row in rows:
+            self._put(row)
+        logging.info(f"Индекс водителей построен: {len(self._route_of)} доступных водителей")
+
+    async def refresh(self, user_id: int, conn=None):
+        """Перечитывает одного пользователя из таблицы после записи (write-through)"""
+        if conn is None:
+            async with get_db_connection() as conn:
+                return await self.refresh(user_id, conn)
+        async with conn.execute(
+                f"SELECT {_INDEXED_DRIVER_COLUMNS} FROM users WHERE user_id=? AND {_INDEXED_DRIVER_FILTER}",
+                (user_id,)) as cursor:
+            row = await cursor.fetchone()
+        if row:
+            self._put(row)
+        else:
+            self._discard(user_id)
+
+    def version(self, route_id: int) -> int:
+        """Номер версии списка водителей маршрута; растёт при любом изменении"""
+        self._evict_expired()
+        return self._versions.get(route_id, 0)
+
+    def route_of(self, user_id: int):
+        """route_id маршрута, в списке которого сейчас виден водитель, или None"""
+        return self._route_of.get(user_id)
+
+    def page(self, route_id: int, sort: str, offset: int, limit: int):
+        """Водители маршрута в порядке sort с offset, не больше limit; возвращает (водители, всего)"""
+        self._evict_expired()
+        ranked = self._ranked.get((route_id, sort))
+        if not ranked:
+            return [], 0
+        total = len(ranked)
+        if DRIVER_SORTS[sort][1]:
+            stop = max(total - offset, 0)
+            window = ranked[max(stop - limit, 0):stop][::-1]
+        else:
+            window = ranked[offset:offset + limit]
+        drivers = self._by_route[route_id]
+        return [drivers[user_id] for _, user_id in window], total
+
+    async def check_consistency(self):
+        """Сравнивает индекс с таблицей; возвращает user_id водителей, по которым есть расхождение"""
+        async with get_db_connection() as conn:
+            rows = await self._fetch_all(conn)
+        self._evict_expired()
+        expected = {row[0]: (row[9], IndexedDriver(*row[:9])) for row in rows}
+        actual = {user_id: (route, self._by_route[route][user_id]) for user_id, route in self._route_of.items()}
+        drift = {user_id for user_id in expected.keys() | actual.keys() if expected.get(user_id) != actual.get(user_id)}
+        for (route, sort), ranked in self._ranked.items():
+            key = DRIVER_SORTS[sort][0]
+            drivers = self._by_route.get(route, {})
+            if ranked != sorted((key(driver), user_id) for user_id, driver in drivers.items()):
+                drift.update(user_id for _, user_id in ranked)
+        drift = sorted(drift)
+        if drift:
+            logging.error(f"Индекс водителей расходится с таблицей users: {drift}")
+        return drift
+
+
+driver_index = DriverIndex()
@@ -0,0 +1,189 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+
+from aiogram import Bot
+
+from database import get_db_connection
+from send_scheduler import background
+
+DELAYED_LEASE = float(os.getenv("DELAYED_LEASE", "60"))  # секунд, на которые процесс закрепляет свои действия
+
+
+class DelayedActions:
+    """Отложенные действия с ботом: «удалить сообщение через 5 секунд» и т.п.
+
+    Обработчик вызывает schedule() и сразу возвращается. Действие записывается в таблицу
+    delayed_actions и в кучу по сроку; одна фоновая задача спит до ближайшего срока и
+    выполняет созревшие действия пачкой. При старте незавершённые действия читаются из
+    таблицы, так что переживают перезапуск; просроченные за время простоя выполняются сразу.
+
+    Строка принадлежит процессу, который держит её в куче (owner), пока он продлевает
+    аренду (lease_until) раз в треть DELAYED_LEASE. Действия процесса, переставшего
+    продлевать аренду (например, упавшего воркера), забирает любой другой процесс.
+    Перед выполнением владелец удаляет свои строки, поэтому действие, отменённое или
+    забранное другим процессом, не выполняется.
+    """
+
+    def __init__(self):
+        self.bot = None
+        self.owner = None
+        self._handlers = {}  # вид действия -> async функция (bot, **payload)
+        self._heap = []  # (срок, action_id, вид, payload)
+        self._queued = set()  # action_id из кучи
+        self._cancelled = set()  # отменённые action_id, которые ещё лежат в куче
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def action(self, kind: str):
+        """Регистрирует исполнителя действия вида kind"""
+        def register(handler):
+            self._handlers[kind] = handler
+            return handler
+        return register
+
+    async def start(self, bot: Bot, restore: bool = True):
+        """restore=True — сразу забрать все действия из таблицы (один процесс или фронт кластера
+        до запуска воркеров); иначе забираются только действия с истёкшей арендой"""
+        self.bot = bot
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        if restore:
+            async with get_db_connection() as conn:
+                restored = await self._claim(conn, "1", ())
+                await conn.commit()
+            if restored:
+                logging.info(f"Восстановлено отложенных действий: {restored}")
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def schedule(self, kind: str, delay: float, **payload) -> int:
+        """Запланировать действие через delay секунд; возвращает id для cancel()"""
+        if kind not in self._handlers:
+            raise ValueError(f"Неизвестное отложенное действие: {kind}")
+        due_at = time.time() + delay
+        async with get_db_connection() as conn:
+            cursor = await conn.execute(
+                "INSERT INTO delayed_actions (due_at, kind, payload, owner, lease_until) VALUES (?, ?, ?, ?, ?)",
+                (due_at, kind, json.dumps(payload, ensure_ascii=False), self.owner, time.time() + DELAYED_LEASE))
+            action_id = cursor.lastrowid
+            await conn.commit()
+        self._push(due_at, action_id, kind, payload)
+        return action_id
+
+    async def cancel(self, action_id: int):
+        """Отменяет действие, если оно ещё не выполнено (в том числе запланированное другим процессом)"""
+        async with get_db_connection() as conn:
+            await conn.execute("DELETE FROM delayed_actions WHERE action_id=?", (action_id,))
+            await conn.commit()
+        if action_id in self._queued:
+            self._cancelled.add(action_id)  # Запись в куче пропустится при извлечении
+
+    def _push(self, due_at: float, action_id: int, kind: str, payload: dict):
+        heapq.heappush(self._heap, (due_at, action_id, kind, payload))
+        self._queued.add(action_id)
+        self._wakeup.set()
+
+    async def _claim(self, conn, where: str, params) -> int:
+        """Переписывает на себя строки по условию where и кладёт их в кучу; возвращает их число"""
+        async with conn.execute(f"""
+            UPDATE delayed_actions SET owner=?, lease_until=? WHERE {where}
+            RETURNING due_at, action_id, kind, payload
+        """, (self.owner, time.time() + DELAYED_LEASE, *params)) as cursor:
+            rows = await cursor.fetchall()
+        for due_at, action_id, kind, payload in rows:
+            if action_id not in self._queued:
+                self._push(due_at, action_id, kind, json.loads(payload))
+        return len(rows)
+
+    async def renew(self) -> int:
+        """Продлевает аренду своих строк и забирает строки с истёкшей арендой; возвращает число забранных"""
+        now = time.time()
+        async with get_db_connection() as conn:
+            await conn.execute("UPDATE delayed_actions SET lease_until=? WHERE owner=?", (now + DELAYED_LEASE, self.owner))
+            claimed = await self._claim(conn, "lease_until < ?", (now,))
+            await conn.commit()
+        if claimed:
+            logging.warning(f"Забрано отложенных действий другого процесса: {claimed}")
+        return claimed
+
+    @property
+    def pending(self) -> int:
+        return len(self._heap)
+
+    async def _run_forever(self):
+        renew_at = time.time() + DELAYED_LEASE / 3
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            if now >= renew_at:
+                try:
+                    await self.renew()
+                except Exception as e:
+                    logging.error(f"Ошибка продления аренды отложенных действий: {e}")
+                renew_at = now + DELAYED_LEASE / 3
+            delay = renew_at - now
+            if self._heap:
+                delay = min(delay, self._heap[0][0] - now)
+                if delay <= 0:
+                    await self._run_due()
+                    continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_due(self):
+        now = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, action_id, kind, payload = heapq.heappop(self._heap)
+            self._queued.discard(action_id)
+            if action_id in self._cancelled:
+                self._cancelled.discard(action_id)
+                continue
+            due.append((action_id, kind, payload))
+        if not due:
+            return
+        # Удаляем до выполнения и только свои строки: отменённое или забранное другим процессом пропускается
+        async with get_db_connection() as conn:
+            async with conn.execute(
+                    f"DELETE FROM delayed_actions WHERE owner=? AND action_id IN ({', '.join('?' * len(due))})"
+                    f" RETURNING action_id", (self.owner, *(action_id for action_id, _, _ in due))) as cursor:
+                owned = {row[0] for row in await cursor.fetchall()}
+            await conn.commit()
+        await asyncio.gather(*(self._execute(*item) for item in due if item[0] in owned))
+
+    async def _execute(self, action_id: int, kind: str, payload: dict):
+        # Действие выполняется один раз: ошибка (например, сообщение уже удалено) не повторяется
+        try:
+            with background():
+                await self._handlers[kind](self.bot, **payload)
+        except Exception as e:
+            logging.error(f"Ошибка отложенного действия {kind} #{action_id}: {e}")
+
+
+delayed_actions = DelayedActions()
+
+
+@delayed_actions.action("delete_message")
+async def _delete_message(bot: Bot, chat_id: int, message_id: int):
+    await bot.delete_message(chat_id=chat_id, message_id=message_id)
+
+
+@delayed_actions.action("edit_message_text")
+async def _edit_message_text(bot: Bot, chat_id: int, message_id: int, text: str):
+    await bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id)
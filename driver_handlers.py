@@ -1,18 +1,16 @@
 from aiogram import Router, F
-from aiogram.types import Message, ContentType, KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardMarkup, \
-    InlineKeyboardButton, CallbackQuery
+from aiogram.types import Message, ContentType, CallbackQuery
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from database import get_db_connection, set_driver_availability, save_user
-import os
+from database import get_db_connection, set_driver_availability, register_driver, user_changed, fetch_user, driver_index
 import logging
-from dotenv import load_dotenv
 from aiogram.filters import Command
 from datetime import datetime, timedelta
-
-
-load_dotenv()
-ADMIN_ID = int(os.getenv("ADMIN_ID"))
+from route_watch import route_notifier
+from outbox import admin_outbox
+from routes import route_catalog
+from callbacks import callbacks, ApproveDriver, DriverRoute
+import replies
 
 router = Router()
 
@@ -37,12 +35,8 @@ async def driver_name(message: Message, state: FSMContext):
         return
     await state.update_data(name=name)
     await state.set_state(DriverReg.phone)
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="📞 Отправить номер", request_contact=True)]],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
-    await message.answer("📞 Теперь отправьте ваш номер телефона:", reply_markup=keyboard)
+    await message.answer("📞 Теперь отправьте ваш номер телефона:",
+                         reply_markup=replies.keyboard("driver_contact", message.from_user.language_code))
 
 
 @router.message(F.contact, DriverReg.phone)
@@ -79,25 +73,16 @@ async def driver_car(message: Message, state: FSMContext):
 async def driver_payment(message: Message, state: FSMContext):
     payment_photo = message.photo[-1].file_id
     data = await state.get_data()
-    success, error_message = await save_user(message.from_user.id, "driver", data["name"], data["phone"], data["car"], None)
+    # Заявка и уведомление админу сохраняются вместе; отправку делает фоновый воркер outbox
+    success, error_message = await register_driver(message.from_user.id, data["name"], data["phone"], data["car"],
+                                                   data["passport"], payment_photo)
     if not success:
         await message.answer(error_message)  # Выводим сообщение об ошибке
         await state.clear()
         return
-
-    conn = await get_db_connection()
-    await conn.execute("""
-            UPDATE users SET passport=?, payment=?, available=?
-            WHERE user_id=?
-        """, (data["passport"], payment_photo, 0, message.from_user.id))
-    await conn.commit()
-    await conn.close()
+    admin_outbox.wake()
 
     await state.set_state(DriverReg.waiting_approval)
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Одобрить", callback_data=f"approve_{message.from_user.id}")],
-        [InlineKeyboardButton(text="❌ Отклонить", callback_data=f"reject_{message.from_user.id}")]
-    ])
 
     # Рассчитываем время до 18:00
     now = datetime.now()
@@ -115,48 +100,25 @@ async def driver_payment(message: Message, state: FSMContext):
     else:
         admin_message = "⏳ Админ работает после 18:00 и ответит в течение 24 часов."
 
-    try:
-        await message.bot.send_photo(
-            ADMIN_ID,
-            photo=data["passport"],
-            caption=f"🔔 Новый водитель ожидает одобрения!\n\n"
-                    f"👤 Имя: {data['name']}\n"
-                    f"📞 Телефон: {data['phone']}\n"
-                    f"🚗 Автомобиль: {data['car']}\n\n"
-                    f"📄 Техпаспорт и права (выше)\n\n"
-                    f"💰 Чек оплаты (ниже)",
-            reply_markup=keyboard
-        )
-        await message.bot.send_photo(ADMIN_ID, photo=payment_photo)
-        await message.answer(
-            f"✅ Ваши данные отправлены администратору. Ожидайте одобрения.\n"
-            f"{admin_message}\n"
-            f"Если хотите отменить заявку, нажмите кнопку ниже.",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="❌ Отменить заявку", callback_data="cancel_driver_reg")]
-            ])
-        )
-    except Exception as e:
-        logging.error(f"Ошибка при отправке данных админу: {e}")
-        await message.answer("⚠️ Ошибка при отправке данных администратору. Попробуйте позже.")
-        await state.clear()
+    language = message.from_user.language_code
+    await message.answer(replies.text("driver_waiting", language, admin_message=admin_message),
+                         reply_markup=replies.keyboard("driver_waiting", language))
 
 
-@router.callback_query(lambda c: c.data.startswith("approve_"))
-async def approve_driver(callback: CallbackQuery, state: FSMContext):
-    user_id = int(callback.data.split("_")[1])
-    conn = await get_db_connection()
-    await conn.execute("UPDATE users SET available=1 WHERE user_id=?", (user_id,))
-    await conn.commit()
-    await conn.close()
+@callbacks.handler(ApproveDriver)
+async def approve_driver(callback: CallbackQuery, callback_data: ApproveDriver, state: FSMContext):
+    user_id = callback_data.driver_id
+    previous_route_id = driver_index.route_of(user_id)
+    async with get_db_connection() as conn:
+        await conn.execute("UPDATE users SET available=1 WHERE user_id=?", (user_id,))
+        await conn.commit()
+        await user_changed(user_id, conn)
+    route_notifier.driver_changed(callback.bot, user_id, previous_route_id)
     try:
         await callback.message.bot.send_message(user_id, "✅ Ваша заявка одобрена! Укажите ваш маршрут:")
         await state.set_state(DriverReg.route)
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🛫 Ташкент ➡️ Нукус 🛬", callback_data="driver_route_tashkent_nukus")],
-            [InlineKeyboardButton(text="🛫 Нукус ➡️ Ташкент 🛬", callback_data="driver_route_nukus_tashkent")]
-        ])
-        await callback.message.bot.send_message(user_id, "🚖 Выберите маршрут:", reply_markup=keyboard)
+        await callback.message.bot.send_message(user_id, replies.text("choose_route"),
+                                                reply_markup=route_catalog.keyboard(DriverRoute))
         await callback.message.bot.send_message(callback.from_user.id, "✅ Водитель одобрен!")
     except Exception as e:
         logging.error(f"Ошибка при одобрении водителя {user_id}: {e}")
@@ -164,33 +126,37 @@ async def approve_driver(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@router.callback_query(lambda c: c.data.startswith("driver_route_"))
-async def choose_driver_route(callback: CallbackQuery, state: FSMContext):
+@callbacks.handler(DriverRoute)
+async def choose_driver_route(callback: CallbackQuery, callback_data: DriverRoute, state: FSMContext):
     user_id = callback.from_user.id
-    new_route = "🛫 Ташкент ➡️ Нукус 🛬" if callback.data == "driver_route_tashkent_nukus" else "🛫 Нукус ➡️ Ташкент 🛬"
-    conn = await get_db_connection()
-    try:
-        cursor = await conn.execute("SELECT route FROM users WHERE user_id=?", (user_id,))
-        current_route = (await cursor.fetchone())[0]
-        if current_route and current_route != new_route:
-            arrival_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            await conn.execute(
-                "UPDATE users SET route=?, last_arrival_time=? WHERE user_id=?",
-                (new_route, arrival_time, user_id)
-            )
-        else:
-            await conn.execute("UPDATE users SET route=? WHERE user_id=?", (new_route, user_id))
-        await conn.commit()
-    except Exception as e:
-        logging.error(f"Ошибка изменения маршрута водителя {user_id}: {e}")
-    finally:
-        await conn.close()
+    new_route = route_catalog.selectable(callback_data.route)
+    if new_route is None:
+        await callback.answer("❌ Этот маршрут больше недоступен. Выберите другой.", show_alert=True)
+        return
+    previous_route_id = driver_index.route_of(user_id)
+    async with get_db_connection() as conn:
+        try:
+            cursor = await conn.execute("SELECT route_id FROM users WHERE user_id=?", (user_id,))
+            current_route_id = (await cursor.fetchone())[0]
+            if current_route_id and current_route_id != new_route.route_id:
+                arrival_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                await conn.execute(
+                    "UPDATE users SET route_id=?, last_arrival_time=? WHERE user_id=?",
+                    (new_route.route_id, arrival_time, user_id)
+                )
+            else:
+                await conn.execute("UPDATE users SET route_id=? WHERE user_id=?", (new_route.route_id, user_id))
+            await conn.commit()
+            await user_changed(user_id, conn)
+        except Exception as e:
+            logging.error(f"Ошибка изменения маршрута водителя {user_id}: {e}")
+    route_notifier.driver_changed(callback.bot, user_id, previous_route_id)
 
     # Сразу запрашиваем сумму после выбора маршрута
     await state.set_state(DriverReg.price)
     await callback.message.edit_text(
-        f"✅ Ваш маршрут сохранён: \n{new_route}.\n\n💵 Укажите сумму за поездку (введите число, например, 100000):")
-    await state.update_data(route=new_route)  # Сохраняем маршрут в состоянии
+        replies.text("driver_route_saved", callback.from_user.language_code, route=new_route.label))
+    await state.update_data(route_id=new_route.route_id)  # Сохраняем маршрут в состоянии
     await callback.answer()
 
 
@@ -207,80 +173,55 @@ async def driver_price(message: Message, state: FSMContext):
 
     user_id = message.from_user.id
     data = await state.get_data()
-    route = data.get("route")  # Получаем маршрут из состояния
-    conn = await get_db_connection()
+    route = route_catalog.label(data.get("route_id"))  # Получаем маршрут из состояния
     try:
-        await conn.execute("UPDATE users SET price=? WHERE user_id=?", (price, user_id))
-        await conn.commit()
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✏ Изменить маршрут и сумму", callback_data="change_driver_route")],
-            [InlineKeyboardButton(text="🚫 Не работаю", callback_data="driver_busy")]
-        ])
-        await message.answer(
-            f"✅ Ваш маршрут и сумма сохранены:\n"
-            f"🛣 Маршрут: {route}\n"
-            f"💵 Сумма: {price} сум\n\n"
-            f"Выберите действие:",
-            reply_markup=keyboard
-        )
+        async with get_db_connection() as conn:
+            await conn.execute("UPDATE users SET price=? WHERE user_id=?", (price, user_id))
+            await conn.commit()
+            await user_changed(user_id, conn)
+        language = message.from_user.language_code
+        await message.answer(replies.text("driver_saved", language, route=route, price=price),
+                             reply_markup=replies.keyboard("driver_menu", language))
     except Exception as e:
         logging.error(f"Ошибка при сохранении суммы для водителя {user_id}: {e}")
         await message.answer("⚠️ Ошибка при сохранении суммы. Попробуйте позже.")
-    finally:
-        await conn.close()
     await state.clear()
 
 
-@router.callback_query(lambda c: c.data == "change_driver_route")
+@callbacks.handler("change_driver_route")
 async def change_driver_route(callback: CallbackQuery):
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🛫 Ташкент ➡️ Нукус 🛬", callback_data="driver_route_tashkent_nukus")],
-        [InlineKeyboardButton(text="🛫 Нукус ➡️ Ташкент 🛬", callback_data="driver_route_nukus_tashkent")]
-    ])
-    await callback.message.edit_text("🚖 Выберите новый маршрут:", reply_markup=keyboard)
+    await callback.message.edit_text(replies.text("choose_new_route", callback.from_user.language_code),
+                                     reply_markup=route_catalog.keyboard(DriverRoute))
     await callback.answer()
 
 
-@router.callback_query(lambda c: c.data == "driver_busy")
+@callbacks.handler("driver_busy")
 async def driver_set_busy(callback: CallbackQuery):
     user_id = callback.from_user.id
     await set_driver_availability(user_id, False)
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Вернуться на работу", callback_data="driver_available")]
-    ])
-    await callback.message.edit_text(
-        "🚫 Вы теперь **не работаете**. \n\nКогда будете готовы, нажмите \n'✅ Вернуться на работу'.",
-        reply_markup=keyboard)
+    language = callback.from_user.language_code
+    await callback.message.edit_text(replies.text("driver_busy", language),
+                                     reply_markup=replies.keyboard("driver_busy", language))
     await callback.answer()
 
 
-@router.callback_query(lambda c: c.data == "driver_available")
+@callbacks.handler("driver_available")
 async def driver_set_available(callback: CallbackQuery):
     user_id = callback.from_user.id
+    user = await fetch_user(user_id)
+    if user and user.subscription_end and user.subscription_end <= datetime.now().strftime("%Y-%m-%d %H:%M:%S"):
+        await callback.answer("⌛ Ваша подписка истекла. Обратитесь к администратору для продления.", show_alert=True)
+        return
+    previous_route_id = driver_index.route_of(user_id)
     await set_driver_availability(user_id, True)
-    conn = await get_db_connection()
-    try:
-        cursor = await conn.execute("SELECT route, price FROM users WHERE user_id=?", (user_id,))
-        row = await cursor.fetchone()
-        current_route = row[0] if row else "Маршрут не установлен"
-        current_price = row[1] if row[1] is not None else "Не указана"
-    except Exception as e:
-        logging.error(f"Ошибка получения данных водителя {user_id}: {e}")
-        current_route = "Маршрут не установлен"
-        current_price = "Не указана"
-    finally:
-        await conn.close()
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✏ Изменить маршрут и сумму", callback_data="change_driver_route")],
-        [InlineKeyboardButton(text="🚫 Не работаю", callback_data="driver_busy")]
-    ])
+    route_notifier.driver_changed(callback.bot, user_id, previous_route_id)
+    user = await fetch_user(user_id)
+    current_route = route_catalog.label(user.route_id if user else None)
+    current_price = user.price if user and user.price is not None else "Не указана"
+    language = callback.from_user.language_code
     await callback.message.edit_text(
-        f"✅ Вы **вернулись на работу**.\n"
-        f"🛣 Ваш маршрут: {current_route}\n"
-        f"💵 Сумма: {current_price} сум\n\n"
-        f"Выберите действие:",
-        reply_markup=keyboard
+        replies.text("driver_available", language, route=current_route, price=current_price),
+        reply_markup=replies.keyboard("driver_menu", language)
     )
     await callback.answer()
 
@@ -288,12 +229,11 @@ async def driver_set_available(callback: CallbackQuery):
 @router.message(Command("cancel"))
 async def cancel_command(message: Message, state: FSMContext):
     await state.clear()
-    conn = await get_db_connection()
-    try:
-        await conn.execute("DELETE FROM users WHERE user_id=?", (message.from_user.id,))
-        await conn.commit()
-    except Exception as e:
-        logging.error(f"Ошибка при удалении данных пользователя {message.from_user.id}: {e}")
-    finally:
-        await conn.close()
+    async with get_db_connection() as conn:
+        try:
+            await conn.execute("DELETE FROM users WHERE user_id=?", (message.from_user.id,))
+            await conn.commit()
+            await user_changed(message.from_user.id, conn)
+        except Exception as e:
+            logging.error(f"Ошибка при удалении данных пользователя {message.from_user.id}: {e}")
     await message.answer("❌ Все действия отменены. Используйте /start, чтобы начать заново.")
\ No newline at end of file
@@ -4,13 +4,17 @@ from aiogram.filters import Command
 from passenger_handlers import router as passenger_router
 from driver_handlers import router as driver_router
 from dotenv import load_dotenv
-from database import get_db_connection
+from database import get_db_connection, user_changed, fetch_users_page, set_user_banned
 import os
 from aiogram.fsm.context import FSMContext
 from driver_handlers import DriverReg
 from passenger_handlers import PassengerReg
 from aiogram.fsm.state import State, StatesGroup
 from messages import WELCOME, HELP_TEXT
+from callbacks import callbacks, DriversPage, PassengersPage
+from routes import route_catalog
+from stats import fetch_stats, STATS_DAYS
+import replies
 
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -21,9 +25,12 @@ ADMIN_ID = int(os.getenv("ADMIN_ID"))
 router = Router()
 router.include_router(passenger_router)
 router.include_router(driver_router)
+# Все callback-запросы идут через словарь префиксов callbacks (см. callbacks.py)
+router.callback_query.register(callbacks.dispatch)
 
 class AdminStates(StatesGroup):
     ban_user = State()
+    unban_user = State()
     update_status = State()
 
 @router.message(Command("admin"))
@@ -31,22 +38,39 @@ async def admin_panel(message: Message, bot: Bot):
     if message.from_user.id != ADMIN_ID:
         await message.answer("❌ У вас нет доступа к админ-панели.")
         return
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📜 Список водителей", callback_data="list_drivers")],
-        [InlineKeyboardButton(text="📜 Список пассажиров", callback_data="list_passengers")],
-        [InlineKeyboardButton(text="🚫 Заблокировать пользователя", callback_data="ban_user")],
-        [InlineKeyboardButton(text="🔄 Обновить статус водителя", callback_data="update_driver_status")]
-    ])
-    await message.answer("🔧 Панель администратора:", reply_markup=keyboard)
-
-@router.callback_query(lambda c: c.data == "reg_passenger")
+    language = message.from_user.language_code
+    await message.answer(replies.text("admin_panel", language), reply_markup=replies.keyboard("admin_panel", language))
+
+@router.message(Command("stats"))
+async def stats_command(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("❌ У вас нет доступа к админ-панели.")
+        return
+    stats = await fetch_stats()
+    routes = "\n".join(
+        f"{route_catalog.label(route_id)}: {active}, средняя цена "
+        + (f"{average_price} сум" if average_price is not None else "не указана")
+        for route_id, (active, average_price) in stats["routes"].items()
+    ) or "Нет работающих водителей."
+    bookings = "\n".join(f"{day}: {count}" for day, count in stats["bookings"]) or "Поездок не было."
+    route_rides = "\n".join(f"{route_catalog.label(route_id)}: {count}"
+                            for route_id, count in stats["route_rides"].items()) or "Нет маршрутов."
+    await message.answer(
+        f"📊 Статистика\n\n"
+        f"⏳ Заявок водителей на одобрении: {stats['pending_drivers']}\n\n"
+        f"🚗 Работающие водители по маршрутам:\n{routes}\n\n"
+        f"📅 Поездки за {STATS_DAYS} дней:\n{bookings}\n\n"
+        f"🛣 Поездки по маршрутам за {STATS_DAYS} дней:\n{route_rides}"
+    )
+
+@callbacks.handler("reg_passenger")
 async def handle_passenger_role(callback: CallbackQuery, state: FSMContext, bot: Bot):
     await state.update_data(role="passenger")
     await state.set_state(PassengerReg.name)
     await bot.send_message(callback.from_user.id, "👤 Введите ваше имя:")
     await callback.answer()
 
-@router.callback_query(lambda c: c.data == "reg_driver")
+@callbacks.handler("reg_driver")
 async def handle_driver_role(callback: CallbackQuery, state: FSMContext, bot: Bot):
     await state.update_data(role="driver")
     await state.set_state(DriverReg.name)
@@ -55,46 +79,112 @@ async def handle_driver_role(callback: CallbackQuery, state: FSMContext, bot: Bo
 
 @router.message(Command("start"))
 async def start_command(message: Message):
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🧑‍💼 Я пассажир", callback_data="reg_passenger")],
-        [InlineKeyboardButton(text="🚗 Я водитель", callback_data="reg_driver")]
-    ])
-    await message.answer(WELCOME, reply_markup=keyboard)
+    await message.answer(WELCOME, reply_markup=replies.keyboard("choose_role", message.from_user.language_code))
 
 @router.message(Command("help"))
 async def help_command(message: Message):
     await message.answer(HELP_TEXT)
 
 
-@router.callback_query(lambda c: c.data == "list_drivers")
-async def list_drivers(callback: CallbackQuery):
-    conn = await get_db_connection()
-    cursor = await conn.execute("SELECT user_id, name, phone, car_info, route, available FROM users WHERE role='driver'")
-    drivers = await cursor.fetchall()
-    await conn.close()
-    if not drivers:
-        await callback.answer("❌ Водителей нет в базе данных.", show_alert=True)
+ADMIN_PAGE_SIZE = 10
+MESSAGE_LIMIT = 4000  # Запас до лимита Telegram в 4096 символов
+
+# Фильтры списков: код в callback_data -> (подпись кнопки, условие SQL, параметры).
+# Фильтры по маршрутам (rt<route_id>) добавляются из справочника, см. with_route_filters.
+DRIVER_FILTERS = {
+    "all": ("Все", "", ()),
+    "on": ("✅ Работают", "available=1", ()),
+    "off": ("❌ Не работают", "available=0", ()),
+    "ban": ("🚫 Заблокированы", "banned=1", ()),
+}
+PASSENGER_FILTERS = {
+    "all": ("Все", "", ()),
+    "ban": ("🚫 Заблокированы", "banned=1", ()),
+}
+
+
+def with_route_filters(filters: dict) -> dict:
+    """Фильтры списка с фильтром на каждый действующий маршрут сразу после «Все»"""
+    first, *rest = filters.items()
+    routes = [(f"rt{route.route_id}", (route.label, "route_id=?", (route.route_id,)))
+              for route in route_catalog.active()]
+    return dict([first, *routes, *rest])
+
+
+def format_driver(driver):
+    return (f"👤 {driver[1]} ({'✅ Работает' if driver[5] else '❌ Не работает'})"
+            f"{' 🚫' if driver[6] else ''}\n🚗 {driver[3]}\n🛣 Маршрут: {route_catalog.label(driver[4])}"
+            f"\n📞 {driver[2]}\n🆔 {driver[0]}")
+
+
+def format_passenger(passenger):
+    return (f"👤 {passenger[1]}{' 🚫' if passenger[6] else ''}\n🛣 Маршрут: {route_catalog.label(passenger[4])}"
+            f"\n📞 {passenger[2]}\n🆔 {passenger[0]}")
+
+
+async def show_users_page(callback: CallbackQuery, page, page_type, role: str, title: str, filters: dict, formatter):
+    """Показывает страницу списка; page — разобранный callback_data кнопки листания или None при открытии"""
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("❌ У вас нет доступа к админ-панели.", show_alert=True)
         return
-    driver_list = "\n\n".join([f"👤 {driver[1]} ({'✅ Работает' if driver[5] else '❌ Не работает'})\n🚗 {driver[3]}\n🛣 Маршрут: {driver[4]}\n📞 {driver[2]}" for driver in drivers])
-    await callback.message.answer(f"📜 **Список водителей:**\n\n{driver_list}")
-    await callback.answer()
+    filters = with_route_filters(filters)
+    filter_code = page.view if page and page.view in filters else "all"
+    direction, cursor = (page.direction, page.cursor) if page else ("n", 0)
+    _, where, params = filters[filter_code]
 
+    if direction == "p":
+        rows, has_prev, has_next = await fetch_users_page(role, where, params, before=cursor, limit=ADMIN_PAGE_SIZE)
+    else:
+        rows, has_prev, has_next = await fetch_users_page(role, where, params, after=cursor, limit=ADMIN_PAGE_SIZE)
 
-@router.callback_query(lambda c: c.data == "list_passengers")
-async def list_passengers(callback: CallbackQuery):
-    conn = await get_db_connection()
-    cursor = await conn.execute("SELECT user_id, name, phone, route FROM users WHERE role='passenger'")
-    passengers = await cursor.fetchall()
-    await conn.close()
-    if not passengers:
-        await callback.answer("❌ Пассажиров нет в базе данных.", show_alert=True)
+    if not rows and page is None:
+        await callback.answer(f"❌ {title.capitalize()} нет в базе данных.", show_alert=True)
         return
-    passenger_list = "\n\n".join([f"👤 {passenger[1]}\n🛣 Маршрут: {passenger[3]}\n📞 {passenger[2]}" for passenger in passengers])
-    await callback.message.answer(f"📜 **Список пассажиров:**\n\n{passenger_list}")
+
+    # Обрезаем страницу, если длинные записи не помещаются в одно сообщение
+    entries = [formatter(row) for row in rows]
+    while len(entries) > 1 and sum(len(entry) + 2 for entry in entries) > MESSAGE_LIMIT:
+        entries.pop()
+        has_next = True
+    rows = rows[:len(entries)]
+    text = f"📜 **Список {title}** ({filters[filter_code][0]}):\n\n" + ("\n\n".join(entries) or "Ничего не найдено.")
+
+    navigation = []
+    if rows and has_prev:
+        navigation.append(InlineKeyboardButton(
+            text="⬅️", callback_data=page_type(view=filter_code, direction="p", cursor=rows[0][0]).pack()))
+    if rows and has_next:
+        navigation.append(InlineKeyboardButton(
+            text="➡️", callback_data=page_type(view=filter_code, direction="n", cursor=rows[-1][0]).pack()))
+    buttons = [navigation] if navigation else []
+    buttons += [
+        [InlineKeyboardButton(text=("• " if code == filter_code else "") + label,
+                              callback_data=page_type(view=code, direction="n", cursor=0).pack())]
+        for code, (label, _, _) in filters.items()
+    ]
+    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+
+    if page is None:
+        await callback.message.answer(text, reply_markup=keyboard)
+    else:
+        await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
 
-@router.callback_query(lambda c: c.data == "ban_user")
+@callbacks.handler("list_drivers")
+@callbacks.handler(DriversPage)
+async def list_drivers(callback: CallbackQuery, callback_data: DriversPage = None):
+    await show_users_page(callback, callback_data, DriversPage, "driver", "водителей", DRIVER_FILTERS, format_driver)
+
+
+@callbacks.handler("list_passengers")
+@callbacks.handler(PassengersPage)
+async def list_passengers(callback: CallbackQuery, callback_data: PassengersPage = None):
+    await show_users_page(callback, callback_data, PassengersPage, "passenger", "пассажиров", PASSENGER_FILTERS,
+                          format_passenger)
+
+
+@callbacks.handler("ban_user")
 async def ask_user_id_for_ban(callback: CallbackQuery, state: FSMContext):
     await callback.message.answer("Введите ID пользователя, которого нужно заблокировать:")
     await state.set_state(AdminStates.ban_user)
@@ -110,20 +200,40 @@ async def ban_user(message: Message, state: FSMContext):
     except ValueError:
         await message.answer("❌ Введите корректный числовой ID.")
         return
-    conn = await get_db_connection()
-    cursor = await conn.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,))
-    if not await cursor.fetchone():
+    if not await set_user_banned(user_id, True):
         await message.answer("❌ Пользователь с таким ID не найден.")
-        await conn.close()
         return
-    await conn.execute("UPDATE users SET banned=1 WHERE user_id=?", (user_id,))
-    await conn.commit()
-    await conn.close()
     await message.answer(f"✅ Пользователь {user_id} заблокирован.")
     await state.clear()
 
 
-@router.callback_query(lambda c: c.data == "update_driver_status")
+@callbacks.handler("unban_user")
+async def ask_user_id_for_unban(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("❌ У вас нет доступа к админ-панели.", show_alert=True)
+        return
+    await callback.message.answer("Введите ID пользователя, которого нужно разблокировать:")
+    await state.set_state(AdminStates.unban_user)
+    await callback.answer()
+
+
+@router.message(AdminStates.unban_user)
+async def unban_user(message: Message, state: FSMContext):
+    if message.from_user.id != ADMIN_ID:
+        return
+    try:
+        user_id = int(message.text.strip())
+    except ValueError:
+        await message.answer("❌ Введите корректный числовой ID.")
+        return
+    if not await set_user_banned(user_id, False):
+        await message.answer("❌ Пользователь с таким ID не найден.")
+        return
+    await message.answer(f"✅ Пользователь {user_id} разблокирован.")
+    await state.clear()
+
+
+@callbacks.handler("update_driver_status")
 async def ask_driver_id(callback: CallbackQuery, state: FSMContext):
     await callback.message.answer("Введите ID водителя, чтобы изменить его статус (работает/не работает):")
     await state.set_state(AdminStates.update_status)
@@ -139,17 +249,17 @@ async def update_driver_status(message: Message, state: FSMContext):
     except ValueError:
         await message.answer("❌ Введите корректный числовой ID.")
         return
-    conn = await get_db_connection()
-    cursor = await conn.execute("SELECT available FROM users WHERE user_id=? AND role='driver'", (user_id,))
-    row = await cursor.fetchone()
+    async with get_db_connection() as conn:
+        cursor = await conn.execute("SELECT available FROM users WHERE user_id=? AND role='driver'", (user_id,))
+        row = await cursor.fetchone()
+        if row:
+            new_status = 0 if row[0] == 1 else 1
+            await conn.execute("UPDATE users SET available=? WHERE user_id=?", (new_status, user_id))
+            await conn.commit()
+            await user_changed(user_id, conn)
     if not row:
         await message.answer("❌ Водитель с таким ID не найден.")
-        await conn.close()
         return
-    new_status = 0 if row[0] == 1 else 1
-    await conn.execute("UPDATE users SET available=? WHERE user_id=?", (new_status, user_id))
-    await conn.commit()
-    await conn.close()
     status_text = "✅ Теперь водитель работает." if new_status == 1 else "🚫 Водитель отключён."
     await message.answer(f"Пользователь {user_id}: {status_text}")
     await state.clear()
@@ -0,0 +1,277 @@
+"""Нагрузочный тест бота против локального фейкового Bot API.
+
+Поднимает aiohttp-сервер вместо api.telegram.org, запускает main.main() с long polling
+на него и прогоняет через настоящие обработчики регистрацию водителей (DriverReg),
+пассажиров (PassengerReg), find_drivers, листание поиска и book_driver. Печатает пропускную способность
+и задержки p50/p95/p99 по каждому обработчику, а в конце сверяет индекс водителей с таблицей
+(DriverIndex.check_consistency): при расхождении код выхода 1.
+
+    python loadtest.py --drivers 200 --passengers 2000 --concurrency 200 --json bench_output.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import signal
+import tempfile
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+BOT_TOKEN = "123456:LOADTEST"
+BOT_ID = 123456
+ADMIN_ID = 1
+
+
+class FakeTelegram:
+    """Минимальный Bot API: отдаёт обновления через getUpdates и запоминает ответы бота"""
+
+    def __init__(self):
+        self.updates = asyncio.Queue()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._callback_ids = itertools.count(1)
+        self.last_message = {}  # chat_id -> последнее сообщение бота
+        self.calls = defaultdict(list)  # chat_id -> [(метод, параметры)]
+        self._waiters = {}
+        self.requests = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    def _message(self, chat_id: int, params: dict):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "bot"},
+            "text": params.get("text") or params.get("caption") or "",
+        }
+        markup = json.loads(params.get("reply_markup") or "{}")
+        if "inline_keyboard" in markup:  # В Message возвращается только inline-клавиатура
+            message["reply_markup"] = markup
+        self.last_message[chat_id] = message
+        return message
+
+    def _resolve(self, key):
+        waiter = self._waiters.pop(key, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.requests += 1
+        result = True
+        if method == "getMe":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "bot", "username": "loadtest_bot"}
+        elif method == "getUpdates":
+            result = await self._get_updates(float(params.get("timeout") or 0), int(params.get("limit") or 100))
+        elif method in ("sendMessage", "sendPhoto", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            result = self._message(chat_id, params)
+            self.calls[chat_id].append((method, result))
+            self._resolve(("chat", chat_id))
+        elif method == "sendMediaGroup":
+            chat_id = int(params["chat_id"])
+            result = [self._message(chat_id, media) for media in json.loads(params["media"])]
+            self.calls[chat_id].append((method, result[0]))
+            self._resolve(("chat", chat_id))
+        elif method == "answerCallbackQuery":
+            self._resolve(("callback", params["callback_query_id"]))
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, timeout: float, limit: int):
+        batch = []
+        try:
+            batch.append(await asyncio.wait_for(self.updates.get(), timeout=timeout or 0.01))
+        except asyncio.TimeoutError:
+            return batch
+        while len(batch) < limit and not self.updates.empty():
+            batch.append(self.updates.get_nowait())
+        return batch
+
+    def _user(self, user_id: int):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    async def send_message(self, user_id: int, **fields):
+        """Отправляет боту сообщение от пользователя и ждёт первого ответа в этот чат"""
+        waiter = self._waiters[("chat", user_id)] = asyncio.get_running_loop().create_future()
+        self.updates.put_nowait({"update_id": next(self._update_ids), "message": {
+            "message_id": next(self._message_ids), "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id), **fields,
+        }})
+        await waiter
+
+    async def press(self, user_id: int, data: str, chat_id: int = None):
+        """Нажимает inline-кнопку под последним сообщением бота и ждёт answerCallbackQuery"""
+        chat_id = chat_id or user_id
+        callback_id = str(next(self._callback_ids))
+        waiter = self._waiters[("callback", callback_id)] = asyncio.get_running_loop().create_future()
+        message = self.last_message.get(chat_id) or self._message(chat_id, {"text": "-"})
+        self.updates.put_nowait({"update_id": next(self._update_ids), "callback_query": {
+            "id": callback_id, "from": self._user(user_id), "chat_instance": str(chat_id),
+            "message": message, "data": data,
+        }})
+        await waiter
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def step(self, name: str, action, timeout: float):
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(action, timeout=timeout)
+        except Exception:
+            self.errors[name] += 1
+            return False
+        self.samples[name].append(time.perf_counter() - started)
+        return True
+
+    def report(self, elapsed: float):
+        def percentile(values, q):
+            return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+        rows = {}
+        for name, values in self.samples.items():
+            values.sort()
+            rows[name] = {
+                "count": len(values),
+                "errors": self.errors.get(name, 0),
+                "throughput": len(values) / elapsed,
+                "p50_ms": percentile(values, 0.50),
+                "p95_ms": percentile(values, 0.95),
+                "p99_ms": percentile(values, 0.99),
+            }
+        for name, count in self.errors.items():
+            rows.setdefault(name, {"count": 0, "errors": count})
+        return rows
+
+
+async def driver_flow(api: FakeTelegram, rec: Recorder, user_id: int, timeout: float):
+    photo = [{"file_id": f"photo{user_id}", "file_unique_id": f"u{user_id}", "width": 1, "height": 1}]
+    contact = {"phone_number": f"+99890{user_id:07d}", "first_name": "Driver", "user_id": user_id}
+    steps = [
+        ("handle_driver_role", lambda: api.press(user_id, "reg_driver")),
+        ("driver_name", lambda: api.send_message(user_id, text="Driver")),
+        ("driver_phone", lambda: api.send_message(user_id, contact=contact)),
+        ("driver_passport", lambda: api.send_message(user_id, photo=photo)),
+        ("driver_car", lambda: api.send_message(user_id, text="Cobalt")),
+        ("driver_payment", lambda: api.send_message(user_id, photo=photo)),
+        ("approve_driver", lambda: api.press(ADMIN_ID, f"ap:{user_id}")),
+        ("choose_driver_route", lambda: api.press(user_id, "rd:1")),
+        ("driver_price", lambda: api.send_message(user_id, text="150000")),
+    ]
+    for name, action in steps:
+        if not await rec.step(name, action(), timeout):
+            return
+
+
+async def passenger_flow(api: FakeTelegram, rec: Recorder, user_id: int, timeout: float):
+    contact = {"phone_number": f"+99891{user_id:07d}", "first_name": "Passenger", "user_id": user_id}
+    steps = [
+        ("handle_passenger_role", lambda: api.press(user_id, "reg_passenger")),
+        ("passenger_name", lambda: api.send_message(user_id, text="Passenger")),
+        ("passenger_phone", lambda: api.send_message(user_id, contact=contact)),
+        ("confirm_passenger_route", lambda: api.press(user_id, "rp:1")),
+        ("choose_passenger_route", lambda: api.press(user_id, _button_with_prefix(api, user_id, "rc:"))),
+        ("find_drivers", lambda: api.press(user_id, "find_drivers")),
+        ("search_drivers", lambda: api.press(user_id, "ds:rides:1")),
+    ]
+    for name, action in steps:
+        if not await rec.step(name, action(), timeout):
+            return
+    driver_button = _button_with_prefix(api, user_id, "bd:")
+    if driver_button:
+        await rec.step("book_driver", api.press(user_id, driver_button), timeout)
+
+
+def _button_with_prefix(api: FakeTelegram, chat_id: int, prefix: str):
+    for method, message in reversed(api.calls[chat_id]):
+        for row in message.get("reply_markup", {}).get("inline_keyboard", []):
+            for button in row:
+                if button.get("callback_data", "").startswith(prefix):
+                    return button["callback_data"]
+    return None
+
+
+async def run(args):
+    api = FakeTelegram()
+    runner = web.AppRunner(api.app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", args.port)
+    await site.start()
+
+    import main  # Импортируем после настройки окружения
+    bot_task = asyncio.create_task(main.main())
+    await asyncio.sleep(1)
+
+    rec = Recorder()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(flow, user_id):
+        async with semaphore:
+            await flow(api, rec, user_id, args.timeout)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(driver_flow, 1_000_000 + i) for i in range(args.drivers)))
+    await asyncio.gather(*(limited(passenger_flow, 2_000_000 + i) for i in range(args.passengers)))
+    elapsed = time.perf_counter() - started
+    # Индекс водителей после всех записей должен совпадать с таблицей users
+    drift = await main.driver_index.check_consistency()
+
+    # Останавливаем polling так же, как при штатном завершении процесса
+    os.kill(os.getpid(), signal.SIGTERM)
+    await bot_task
+    await runner.cleanup()
+
+    report = {"elapsed_s": elapsed, "api_requests": api.requests, "index_drift": drift,
+              "handlers": rec.report(elapsed)}
+    print(f"{'handler':26} {'count':>6} {'err':>5} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, row in report["handlers"].items():
+        print(f"{name:26} {row['count']:6} {row['errors']:5} {row.get('throughput', 0):8.1f} "
+              f"{row.get('p50_ms', 0):8.1f} {row.get('p95_ms', 0):8.1f} {row.get('p99_ms', 0):8.1f}")
+    print(f"Всего: {elapsed:.1f} с, запросов к Bot API: {api.requests}")
+    print(f"Расхождений индекса водителей с таблицей: {len(drift)}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return not drift
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--drivers", type=int, default=100)
+    parser.add_argument("--passengers", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100, help="одновременно активных пользователей")
+    parser.add_argument("--timeout", type=float, default=30, help="предел ожидания ответа на один шаг, с")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--throttled", action="store_true",
+                        help="оставить лимиты скорости Telegram в планировщике отправки")
+    parser.add_argument("--json", help="куда сохранить отчёт для сравнения между релизами")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    os.environ.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "ADMIN_ID": str(ADMIN_ID),
+        "DB_PATH": os.path.join(workdir, "database.db"),
+        "BOT_MODE": "polling",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{args.port}",
+    })
+    if not args.throttled:
+        os.environ.update({"SEND_GLOBAL_RATE": "1000000", "SEND_CHAT_RATE": "1000000", "SEND_CHAT_BURST": "1000000"})
+    logging.basicConfig(level=logging.WARNING)
+    if not asyncio.run(run(args)):
+        raise SystemExit(1)
@@ -1,61 +1,248 @@
 import asyncio
 import logging
 import os
+import time
 from aiogram import Bot, Dispatcher, BaseMiddleware
-from aiogram.client.session.aiohttp import AiohttpSession
-from aiogram.types import Update
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import ErrorEvent
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
 from dotenv import load_dotenv
 from handlers import router
-from database import setup_database
+from database import setup_database, init_db_pool, close_db_pool, driver_index, banned_users, load_banned_users
+from storage import SQLiteStorage, FSM_TTL
+from webhook import run_webhook
+from send_scheduler import send_scheduler, background
+from subscriptions import SubscriptionEnforcer
+from stats import StatsReconciler
+from route_watch import route_notifier
+from outbox import admin_outbox
+from routes import route_catalog
+from replies import PrebuiltSession
+from delayed import delayed_actions
+from database import user_cache
+import metrics
+from metrics import InstrumentationMiddleware, start_metrics_server
+import cluster
 
 
 load_dotenv()
 TOKEN = os.getenv("BOT_TOKEN")
 CHANNEL_NAME = os.getenv("CHANNEL_NAME")
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")  # sqlite, memory или redis (REDIS_URL)
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling или webhook
+ALLOWED_UPDATES = ["message", "callback_query"]
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # Свой Bot API сервер (например, стенд loadtest.py)
 
 if not TOKEN:
     raise ValueError("❌ BOT_TOKEN не найден! Проверь файл .env")
 
+class BanMiddleware(BaseMiddleware):
+    """Отбрасывает события заблокированных пользователей до обработчиков и обращений к FSM.
+
+    Ставится внешним middleware на update перед FSMContextMiddleware (см. create_dispatcher),
+    поэтому для них не берётся блокировка events_isolation и не читается состояние.
+    Проверка — один поиск в множестве banned_users.
+    """
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None and user.id in banned_users:
+            if event.callback_query:  # Убираем «часики» на кнопке
+                await event.callback_query.answer("🚫 Вы заблокированы.", show_alert=True)
+            return None
+        return await handler(event, data)
+
+
 # Middleware для тайм-аута FSM
 class TimeoutMiddleware(BaseMiddleware):
-    def __init__(self):
+    """Отслеживает бездействие пользователей в FSM-состоянии.
+
+    Сроки хранятся в колесе таймеров с корзинами по TICK секунд: обновление срока — O(1),
+    а одна фоновая задача раз в тик завершает все истёкшие сессии пачкой.
+    Один экземпляр регистрируется и для сообщений, и для callback-запросов.
+    При нескольких процессах (shared) сроки хранятся в Redis, а проверяет их один процесс.
+    Сессия, продлённая, пока пачка истёкших ещё обрабатывается, не завершается.
+    """
+
+    TIMEOUT = 600  # 10 минут
+    TICK = 5
+    BATCH_SIZE = 50
+
+    def __init__(self, shared=None, storage=None, bot: Bot = None):
         super().__init__()
-        self.active_states = {}  # Храним время последнего действия для каждого пользователя
+        self.active_states = {}  # chat_id -> (номер корзины, state, bot)
+        self.buckets = {}  # номер корзины -> множество chat_id
+        self.shared = shared  # cluster.SharedTimeouts; storage и bot нужны, чтобы завершать его сессии
+        self.storage = storage
+        self.bot = bot
+        self._sweeper = None
 
     async def __call__(self, handler, event, data):
         state: FSMContext = data.get("state")
         chat_id = event.from_user.id if event.from_user else event.chat.id
 
-        # Если пользователь что-то делает, обновляем время последнего действия
-        self.active_states[chat_id] = asyncio.get_event_loop().time()
-
-        # Проверяем, есть ли активное состояние
+        # Если у пользователя есть активное состояние, переносим его срок
         current_state = await state.get_state()
         if current_state:
-            # Запускаем задачу для проверки тайм-аута
-            asyncio.create_task(self.check_timeout(chat_id, state, event.bot))
+            if self.shared is not None:
+                await self.shared.touch(state.key, time.time() + self.TIMEOUT)
+            else:
+                self.touch(chat_id, state, event.bot)
 
         return await handler(event, data)
 
-    async def check_timeout(self, chat_id: int, state: FSMContext, bot: Bot):
-        # Ждем 10 минут (600 секунд)
-        await asyncio.sleep(600)
-
-        # Проверяем, прошло ли 10 минут с последнего действия
-        last_action_time = self.active_states.get(chat_id, 0)
-        current_time = asyncio.get_event_loop().time()
-        if current_time - last_action_time >= 600:  # Если прошло 10 минут
-            current_state = await state.get_state()
-            if current_state:  # Если состояние всё ещё активно
-                await state.clear()  # Очищаем состояние
-                try:
+    def _now(self):
+        return asyncio.get_running_loop().time()
+
+    def touch(self, chat_id: int, state: FSMContext, bot: Bot, delay: float = None):
+        bucket = int((self._now() + (self.TIMEOUT if delay is None else delay)) // self.TICK) + 1
+        previous = self.active_states.get(chat_id)
+        if previous and previous[0] != bucket:
+            self._unlink(chat_id, previous[0])
+        self.active_states[chat_id] = (bucket, state, bot)
+        self.buckets.setdefault(bucket, set()).add(chat_id)
+
+    def _unlink(self, chat_id: int, bucket: int):
+        chat_ids = self.buckets.get(bucket)
+        if chat_ids is not None:
+            chat_ids.discard(chat_id)
+            if not chat_ids:
+                del self.buckets[bucket]
+
+    def restore(self, storage: SQLiteStorage, bot: Bot):
+        """Ставит в колесо сессии, загруженные хранилищем после перезапуска.
+
+        Срок отсчитывается от последнего изменения записи в хранилище.
+        """
+        now = time.time()
+        for key, updated_at in storage.sessions():
+            self.touch(key.chat_id, FSMContext(storage, key), bot, max(updated_at + self.TIMEOUT - now, 0))
+        if self.active_states:
+            logging.info(f"Восстановлено сроков бездействия FSM: {len(self.active_states)}")
+
+    def start(self):
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_forever())
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.TICK)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logging.error(f"Ошибка при проверке тайм-аутов FSM: {e}")
+
+    async def sweep(self):
+        if self.shared is not None:
+            return await self._sweep_shared()
+        current_bucket = int(self._now() // self.TICK)
+        expired = []
+        for bucket in [b for b in self.buckets if b <= current_bucket]:
+            for chat_id in self.buckets.pop(bucket):
+                _, state, bot = self.active_states.pop(chat_id)
+                expired.append((chat_id, state, bot))
+        for i in range(0, len(expired), self.BATCH_SIZE):
+            await asyncio.gather(*(self.expire(*item) for item in expired[i:i + self.BATCH_SIZE]))
+
+    async def _sweep_shared(self):
+        while True:
+            keys = await self.shared.pop_due(time.time(), self.BATCH_SIZE)
+            await asyncio.gather(*(self.expire(key.chat_id, FSMContext(self.storage, key), self.bot) for key in keys))
+            if len(keys) < self.BATCH_SIZE:
+                return
+
+    async def _still_due(self, chat_id: int, state: FSMContext) -> bool:
+        """Пользователь не продлил срок, пока сессия ждала своей пачки"""
+        if self.shared is not None:
+            return not await self.shared.pending(state.key)
+        return chat_id not in self.active_states
+
+    async def expire(self, chat_id: int, state: FSMContext, bot: Bot):
+        if not await self._still_due(chat_id, state):
+            return
+        current_state = await state.get_state()
+        if current_state:  # Если состояние всё ещё активно
+            await state.clear()  # Очищаем состояние
+            try:
+                with background():
                     await bot.send_message(chat_id, "⏳ Время ожидания истекло. Начните заново с /start.")
-                except Exception as e:
-                    logging.error(f"Ошибка при отправке сообщения о тайм-ауте пользователю {chat_id}: {e}")
-                finally:
-                    self.active_states.pop(chat_id, None)  # Удаляем из активных
+            except Exception as e:
+                logging.error(f"Ошибка при отправке сообщения о тайм-ауте пользователю {chat_id}: {e}")
+
+def create_bot() -> Bot:
+    if TELEGRAM_API_URL:
+        session = PrebuiltSession(timeout=60, api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    else:
+        session = PrebuiltSession(timeout=60)  # Готовые клавиатуры из replies.py уходят без повторной сериализации
+    session.middleware(send_scheduler)  # Ограничение скорости исходящих сообщений
+    return Bot(token=TOKEN, session=session)
+
+
+async def create_storage(redis=None):
+    """Хранилище FSM и изоляция событий: общие в Redis, если он подключён, иначе локальные"""
+    if redis is not None:
+        from aiogram.fsm.storage.redis import RedisStorage, RedisEventIsolation
+        return RedisStorage(redis, state_ttl=FSM_TTL, data_ttl=FSM_TTL), RedisEventIsolation(redis)
+    # По умолчанию хранилище переживает перезапуски, MemoryStorage — для отладки
+    if FSM_STORAGE == "memory":
+        return MemoryStorage(), None
+    storage = SQLiteStorage()
+    await storage.open()
+    return storage, None
+
+
+def create_dispatcher(storage, timeout_middleware: TimeoutMiddleware, events_isolation=None) -> Dispatcher:
+    if events_isolation is not None:
+        dp = Dispatcher(storage=storage, events_isolation=events_isolation)
+    else:
+        dp = Dispatcher(storage=storage)
+    # Dispatcher уже зарегистрировал FSMContextMiddleware; бан проверяем раньше него
+    middlewares = dp.update.outer_middleware._middlewares
+    middlewares.insert(middlewares.index(dp.fsm), BanMiddleware())
+
+    # Метрики обработчиков (первым, чтобы в замер попадали и остальные middleware)
+    instrumentation = InstrumentationMiddleware()
+    dp.message.middleware(instrumentation)
+    dp.callback_query.middleware(instrumentation)
+
+    # Подключаем middleware для тайм-аута (один экземпляр на оба типа событий)
+    dp.message.middleware(timeout_middleware)
+    dp.callback_query.middleware(timeout_middleware)
+
+    dp.include_router(router)  # handlers.py
+
+    # Регистрируем обработчик ошибок с помощью декоратора
+    @dp.errors()
+    async def on_error(event: ErrorEvent, bot: Bot):
+        logging.error(f"Ошибка: {event.exception}")
+        if event.update.message:  # Проверяем, есть ли сообщение
+            await bot.send_message(event.update.message.chat.id, "⚠️ Произошла ошибка. Попробуйте позже.")
+
+    return dp
+
+
+def register_gauges():
+    # Метрики очереди отправки и кэша профилей
+    metrics.register_gauge("bot_send_queue_depth", "Запросы в очереди отправки", lambda: send_scheduler.queue_depth)
+    metrics.register_gauge("bot_send_wait_seconds_max", "Наибольшее ожидание в очереди отправки",
+                           lambda: send_scheduler.wait_time_max)
+    metrics.register_gauge("bot_send_wait_seconds_avg", "Среднее ожидание в очереди отправки",
+                           lambda: send_scheduler.stats()["wait_time_avg"])
+    metrics.register_gauge("bot_send_retries", "Повторы после RetryAfter", lambda: send_scheduler.retried)
+    metrics.register_gauge("bot_delayed_actions_pending", "Запланированные отложенные действия",
+                           lambda: delayed_actions.pending)
+    metrics.register_gauge("bot_user_cache_hit_rate", "Доля попаданий в кэш профилей", lambda: user_cache.hit_rate)
+
 
 async def main():
     logging.basicConfig(level=logging.INFO)  # Настройка логирования
@@ -63,27 +250,54 @@ async def main():
     await setup_database()
     logging.info("Инициализация базы данных завершена")
 
-    session = AiohttpSession(timeout=60)
-    global bot
-    bot = Bot(token=TOKEN, session=session)
-    storage = MemoryStorage()  # Хранилище для FSM
-    dp = Dispatcher(storage=storage)
+    redis = None
+    if FSM_STORAGE == "redis" or cluster.BOT_WORKERS > 1:
+        redis = await cluster.connect_redis()
+        if redis is None:
+            logging.warning("Redis недоступен: работаем одним процессом с SQLite-хранилищем FSM")
+    if redis is not None and cluster.BOT_WORKERS > 1:
+        await cluster.run_cluster(redis, BOT_MODE, ALLOWED_UPDATES)
+        return
 
-    # Подключаем middleware для тайм-аута
-    dp.message.middleware(TimeoutMiddleware())
-    dp.callback_query.middleware(TimeoutMiddleware())
+    await init_db_pool()
+    await route_catalog.load()
+    await driver_index.load()
+    await load_banned_users()
 
-    dp.include_router(router)  # handlers.py
-
-    # Регистрируем обработчик ошибок с помощью декоратора
-    @dp.errors()
-    async def on_error(update: Update, exception: Exception):
-        logging.error(f"Ошибка: {exception}")
-        if update.message:  # Проверяем, есть ли сообщение
-            await bot.send_message(update.message.chat.id, "⚠️ Произошла ошибка. Попробуйте позже.")
+    global bot
+    bot = create_bot()
+    storage, events_isolation = await create_storage(redis)
+    timeout_middleware = TimeoutMiddleware()
+    if isinstance(storage, SQLiteStorage):
+        timeout_middleware.restore(storage, bot)
+    dp = create_dispatcher(storage, timeout_middleware, events_isolation)
+    register_gauges()
+    metrics_runner = await start_metrics_server()
 
     logging.info("✅ Бот запущен!")
-    await dp.start_polling(bot, allowed_updates=["message", "callback_query"])
+    timeout_middleware.start()
+    # Снятие с работы водителей с истёкшей подпиской и напоминания о продлении
+    subscription_enforcer = SubscriptionEnforcer(bot)
+    subscription_enforcer.start()
+    stats_reconciler = StatsReconciler()  # Сверка сводок /stats с таблицами
+    stats_reconciler.start()
+    admin_outbox.start(bot)  # Доставка заявок водителей администратору
+    await delayed_actions.start(bot)  # Отложенные действия, в том числе оставшиеся с прошлого запуска
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot, ALLOWED_UPDATES)
+        else:
+            await dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES)
+    finally:
+        await timeout_middleware.stop()
+        await subscription_enforcer.stop()
+        await stats_reconciler.stop()
+        await route_notifier.close()
+        await admin_outbox.stop()
+        await delayed_actions.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await close_db_pool()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -24,4 +24,3 @@ HELP_TEXT = "📚 **Инструкция по использованию бот
             "   - /cancel — отменить текущий процесс.\n" \
             "   - /help — показать эту инструкцию.\n\n" \
             "💡 Если что-то не работает, свяжитесь с администратором!"
-
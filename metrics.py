@@ -0,0 +1,148 @@
+import logging
+import os
+import time
+from bisect import bisect_left
+
+from aiogram import BaseMiddleware
+from aiohttp import web
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — эндпоинт не запускается
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Гистограмма с заранее заданными границами; наблюдение — бинарный поиск и инкремент"""
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class HistogramFamily:
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.children = {}
+
+    def labels(self, value: str) -> Histogram:
+        child = self.children.get(value)
+        if child is None:
+            child = self.children[value] = Histogram()
+        return child
+
+    def render(self, lines: list):
+        lines.append(f"# HELP {self.name} {self.help_text}")
+        lines.append(f"# TYPE {self.name} histogram")
+        for value, histogram in sorted(self.children.items()):
+            label = f'{self.label}="{_escape(value)}"'
+            cumulative = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {histogram.count}')
+            lines.append(f"{self.name}_sum{{{label}}} {histogram.sum}")
+            lines.append(f"{self.name}_count{{{label}}} {histogram.count}")
+
+
+class CounterFamily:
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.values = {}
+
+    def inc(self, value: str, amount: int = 1):
+        self.values[value] = self.values.get(value, 0) + amount
+
+    def render(self, lines: list):
+        lines.append(f"# HELP {self.name} {self.help_text}")
+        lines.append(f"# TYPE {self.name} counter")
+        for value, count in sorted(self.values.items()):
+            lines.append(f'{self.name}{{{self.label}="{_escape(value)}"}} {count}')
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+handler_latency = HistogramFamily("bot_handler_latency_seconds", "Время обработки события", "handler")
+handler_errors = CounterFamily("bot_handler_errors_total", "Исключения в обработчиках", "handler")
+db_query_latency = HistogramFamily("bot_db_query_seconds", "Время выполнения запроса к SQLite", "statement")
+in_flight = 0
+_gauges = []  # (имя, описание, функция без аргументов)
+
+
+def register_gauge(name: str, help_text: str, read):
+    """Добавляет в выдачу значение, которое считывается в момент запроса /metrics"""
+    _gauges.append((name, help_text, read))
+
+
+def render() -> str:
+    lines = [
+        "# HELP bot_updates_in_flight Обрабатываемые сейчас события",
+        "# TYPE bot_updates_in_flight gauge",
+        f"bot_updates_in_flight {in_flight}",
+    ]
+    handler_latency.render(lines)
+    handler_errors.render(lines)
+    db_query_latency.render(lines)
+    for name, help_text, read in _gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {read()}")
+    return "\n".join(lines) + "\n"
+
+
+def _handler_name(handler_object, event) -> str:
+    if handler_object is None:
+        return "unknown"
+    callback = handler_object.callback
+    # Диспетчер callback-запросов (callbacks.py) называет конкретный обработчик
+    resolve_name = getattr(getattr(callback, "__self__", None), "resolve_name", None)
+    return resolve_name(event) if resolve_name else callback.__name__
+
+
+class InstrumentationMiddleware(BaseMiddleware):
+    """Меряет время каждого обработчика, считает ошибки и события в работе"""
+
+    async def __call__(self, handler, event, data):
+        global in_flight
+        name = _handler_name(data.get("handler"), event)
+        in_flight += 1
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_latency.labels(name).observe(time.perf_counter() - started)
+            in_flight -= 1
+
+
+async def _metrics_view(request: web.Request):
+    return web.Response(body=render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+async def start_metrics_server():
+    """Поднимает GET /metrics в формате Prometheus; возвращает runner для остановки"""
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_view)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
@@ -0,0 +1,326 @@
+import logging
+
+
+# Миграция 1 приводит к единой схеме и новые базы, и базы, созданные до появления миграций
+async def _create_users(conn):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            role TEXT,
+            name TEXT,
+            phone TEXT,
+            car_info TEXT,
+            route TEXT DEFAULT NULL,
+            available INTEGER DEFAULT 0,
+            rides_count INTEGER DEFAULT 0,
+            subscribed INTEGER DEFAULT 0,
+            banned INTEGER DEFAULT 0,
+            last_route_change TIMESTAMP DEFAULT NULL,
+            subscription_end TIMESTAMP DEFAULT NULL,
+            passport TEXT DEFAULT NULL,
+            payment TEXT DEFAULT NULL,
+            price INTEGER DEFAULT NULL,
+            last_arrival_time TIMESTAMP DEFAULT NULL
+        );
+    """)
+    async with conn.execute("PRAGMA table_info(users);") as cursor:
+        columns = {row[1] for row in await cursor.fetchall()}
+    for column, definition in (
+            ("passport", "TEXT DEFAULT NULL"),
+            ("payment", "TEXT DEFAULT NULL"),
+            ("price", "INTEGER DEFAULT NULL"),
+            ("last_arrival_time", "TIMESTAMP DEFAULT NULL"),
+    ):
+        if column not in columns:
+            await conn.execute(f"ALTER TABLE users ADD COLUMN {column} {definition};")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_route ON users(route);")
+
+
+# Маршруты, которые до миграции 8 хранились в users.route текстом кнопки
+_INITIAL_ROUTES = (
+    (1, "Ташкент", "Нукус", "🛫 Ташкент ➡️ Нукус 🛬"),
+    (2, "Нукус", "Ташкент", "🛫 Нукус ➡️ Ташкент 🛬"),
+)
+
+
+async def _normalize_routes(conn):
+    await conn.execute("""
+        CREATE TABLE routes (
+            route_id INTEGER PRIMARY KEY,
+            origin TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            label TEXT NOT NULL UNIQUE,
+            position INTEGER NOT NULL DEFAULT 0,
+            active INTEGER NOT NULL DEFAULT 1,
+            UNIQUE (origin, destination)
+        );
+    """)
+    await conn.executemany("INSERT INTO routes (route_id, origin, destination, label, position) VALUES (?, ?, ?, ?, ?)",
+                           [(*route, route[0]) for route in _INITIAL_ROUTES])
+    # Незнакомые тексты маршрутов сохраняются отключёнными маршрутами, чтобы ссылки на них не потерялись
+    await conn.execute("""
+        INSERT INTO routes (origin, destination, label, active)
+        SELECT route, route, route, 0 FROM (
+            SELECT route FROM users UNION SELECT route FROM bookings UNION SELECT route FROM route_watchers
+        ) WHERE route IS NOT NULL AND route NOT IN (SELECT label FROM routes);
+    """)
+
+    for table, indexes in (
+            ("users", {
+                "idx_users_available_drivers": """
+                    CREATE INDEX idx_users_available_drivers
+                        ON users(route_id, price, name, phone, car_info, last_arrival_time, available)
+                        WHERE role='driver' AND available=1;
+                """,
+                "idx_users_role_route": "CREATE INDEX idx_users_role_route ON users(role, route_id, user_id);",
+            }),
+            ("bookings", {
+                "idx_bookings_route": "CREATE INDEX idx_bookings_route ON bookings(route_id, created_at);",
+            }),
+    ):
+        for name in indexes:
+            await conn.execute(f"DROP INDEX IF EXISTS {name};")  # Колонку нельзя удалить, пока она в индексе
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN route_id INTEGER REFERENCES routes(route_id);")
+        await conn.execute(f"UPDATE {table} SET route_id=(SELECT route_id FROM routes WHERE label={table}.route) "
+                           f"WHERE route IS NOT NULL;")
+        await conn.execute(f"ALTER TABLE {table} DROP COLUMN route;")
+        for statement in indexes.values():
+            await conn.execute(statement)
+
+    await conn.execute("""
+        CREATE TABLE route_watchers_new (
+            passenger_id INTEGER PRIMARY KEY,
+            route_id INTEGER NOT NULL REFERENCES routes(route_id),
+            expires_at TIMESTAMP NOT NULL,
+            notified_at TIMESTAMP DEFAULT NULL
+        );
+    """)
+    await conn.execute("""
+        INSERT INTO route_watchers_new (passenger_id, route_id, expires_at, notified_at)
+        SELECT passenger_id, routes.route_id, expires_at, notified_at
+        FROM route_watchers JOIN routes ON routes.label = route_watchers.route;
+    """)
+    await conn.execute("DROP TABLE route_watchers;")
+    await conn.execute("ALTER TABLE route_watchers_new RENAME TO route_watchers;")
+    await conn.execute("CREATE INDEX idx_route_watchers_route ON route_watchers(route_id, passenger_id);")
+    await conn.execute("ANALYZE;")
+
+
+# Сводки для /stats. Кто считается работающим водителем и заявкой на одобрении — условия
+# над строкой users ({row} — NEW, OLD или users); их используют и триггеры, и пересчёт.
+STATS_ACTIVE_DRIVER = ("{row}.role='driver' AND {row}.available=1 AND {row}.banned=0"
+                       " AND {row}.route_id IS NOT NULL")
+STATS_PENDING_DRIVER = ("{row}.role='driver' AND {row}.available=0 AND {row}.banned=0"
+                        " AND {row}.route_id IS NULL AND {row}.passport IS NOT NULL")
+
+
+def _stats_route_delta(row: str, sign: str) -> str:
+    """Добавляет (sign='+') или вычитает водителя row из сводки его маршрута"""
+    active = STATS_ACTIVE_DRIVER.format(row=row)
+    update = (f"UPDATE route_stats SET active_drivers = active_drivers {sign} 1,"
+              f" priced_drivers = priced_drivers {sign} ({row}.price IS NOT NULL),"
+              f" price_sum = price_sum {sign} IFNULL({row}.price, 0)"
+              f" WHERE route_id = {row}.route_id AND {active};")
+    if sign == "+":
+        return f"INSERT OR IGNORE INTO route_stats (route_id) SELECT {row}.route_id WHERE {active};\n{update}"
+    return update
+
+
+def _stats_pending_delta(new: bool, old: bool) -> str:
+    # IFNULL: при NULL в available или banned условие даёт NULL, а счётчик должен остаться числом
+    delta = " ".join(part for part, used in (
+        (f"+ IFNULL(({STATS_PENDING_DRIVER.format(row='NEW')}), 0)", new),
+        (f"- IFNULL(({STATS_PENDING_DRIVER.format(row='OLD')}), 0)", old),
+    ) if used)
+    return f"UPDATE stats_counters SET value = value {delta} WHERE name = 'pending_drivers';"
+
+
+# Полный пересчёт сводок из users и bookings: заполняет их в миграции и сверяет в StatsReconciler
+STATS_RECOMPUTE = [
+    "DELETE FROM route_stats;",
+    f"""
+    INSERT INTO route_stats (route_id, active_drivers, priced_drivers, price_sum)
+    SELECT route_id, COUNT(*), COUNT(price), IFNULL(SUM(price), 0) FROM users
+    WHERE {STATS_ACTIVE_DRIVER.format(row="users")} GROUP BY route_id;
+    """,
+    "DELETE FROM booking_days;",
+    """
+    INSERT INTO booking_days (day, bookings)
+    SELECT substr(created_at, 1, 10), COUNT(*) FROM bookings GROUP BY 1;
+    """,
+    f"""
+    INSERT OR REPLACE INTO stats_counters (name, value)
+    VALUES ('pending_drivers', (SELECT COUNT(*) FROM users WHERE {STATS_PENDING_DRIVER.format(row="users")}));
+    """,
+]
+
+# Триггеры обновляют сводки в той же транзакции, что и запись в users или bookings,
+# поэтому их не обходит ни один путь записи (обработчики, подписки, другие процессы)
+_STATS_TABLES = [
+    """
+    CREATE TABLE route_stats (
+        route_id INTEGER PRIMARY KEY REFERENCES routes(route_id),
+        active_drivers INTEGER NOT NULL DEFAULT 0,
+        priced_drivers INTEGER NOT NULL DEFAULT 0,
+        price_sum INTEGER NOT NULL DEFAULT 0
+    );
+    """,
+    "CREATE TABLE booking_days (day TEXT PRIMARY KEY, bookings INTEGER NOT NULL DEFAULT 0);",
+    "CREATE TABLE stats_counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0);",
+    f"""
+    CREATE TRIGGER users_stats_insert AFTER INSERT ON users BEGIN
+        {_stats_route_delta("NEW", "+")}
+        {_stats_pending_delta(new=True, old=False)}
+    END;
+    """,
+    f"""
+    CREATE TRIGGER users_stats_update AFTER UPDATE OF role, available, banned, route_id, price, passport ON users
+    BEGIN
+        {_stats_route_delta("OLD", "-")}
+        {_stats_route_delta("NEW", "+")}
+        {_stats_pending_delta(new=True, old=True)}
+    END;
+    """,
+    f"""
+    CREATE TRIGGER users_stats_delete AFTER DELETE ON users BEGIN
+        {_stats_route_delta("OLD", "-")}
+        {_stats_pending_delta(new=False, old=True)}
+    END;
+    """,
+    """
+    CREATE TRIGGER bookings_stats_insert AFTER INSERT ON bookings BEGIN
+        INSERT OR IGNORE INTO booking_days (day) VALUES (substr(NEW.created_at, 1, 10));
+        UPDATE booking_days SET bookings = bookings + 1 WHERE day = substr(NEW.created_at, 1, 10);
+    END;
+    """,
+    """
+    CREATE TRIGGER bookings_stats_delete AFTER DELETE ON bookings BEGIN
+        UPDATE booking_days SET bookings = bookings - 1 WHERE day = substr(OLD.created_at, 1, 10);
+    END;
+    """,
+]
+
+
+# Упорядоченный список миграций: (номер, описание, список SQL или async-функция от соединения).
+# Применённые миграции не меняются — изменения схемы добавляются новой записью в конец.
+MIGRATIONS = [
+    (1, "таблица users", _create_users),
+    (2, "журнал поездок bookings", [
+        """
+        CREATE TABLE IF NOT EXISTS bookings (
+            booking_id INTEGER PRIMARY KEY,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            passenger_id INTEGER NOT NULL,
+            driver_id INTEGER NOT NULL,
+            route TEXT,
+            price INTEGER,
+            created_at TIMESTAMP NOT NULL
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_bookings_driver ON bookings(driver_id);",
+        "CREATE INDEX IF NOT EXISTS idx_bookings_route ON bookings(route, created_at);",
+    ]),
+    (3, "индексы под горячие запросы", [
+        # Доступные водители маршрута по цене; покрывает все поля карточки водителя
+        """
+        CREATE INDEX IF NOT EXISTS idx_users_available_drivers
+            ON users(route, price, name, phone, car_info, last_arrival_time, available)
+            WHERE role='driver' AND available=1;
+        """,
+        # Списки админки: роль, необязательный маршрут и keyset по user_id
+        "CREATE INDEX IF NOT EXISTS idx_users_role ON users(role, user_id);",
+        "CREATE INDEX IF NOT EXISTS idx_users_role_route ON users(role, route, user_id);",
+        "CREATE INDEX IF NOT EXISTS idx_users_banned ON users(role, user_id) WHERE banned=1;",
+        "DROP INDEX IF EXISTS idx_users_route;",
+        "ANALYZE;",
+    ]),
+    (4, "контроль окончания подписки водителей", [
+        "ALTER TABLE users ADD COLUMN subscription_reminded TIMESTAMP DEFAULT NULL;",
+        # Истёкшие среди работающих водителей и ближайшие окончания для напоминаний
+        "CREATE INDEX idx_users_expiring_drivers ON users(subscription_end) WHERE role='driver' AND available=1;",
+        "CREATE INDEX idx_users_subscription_end ON users(subscription_end) WHERE role='driver';",
+    ]),
+    (5, "подписки пассажиров на появление водителей", [
+        """
+        CREATE TABLE route_watchers (
+            passenger_id INTEGER PRIMARY KEY,
+            route TEXT NOT NULL,
+            expires_at TIMESTAMP NOT NULL,
+            notified_at TIMESTAMP DEFAULT NULL
+        );
+        """,
+        "CREATE INDEX idx_route_watchers_route ON route_watchers(route, passenger_id);",
+    ]),
+    (6, "outbox уведомлений администратору", [
+        # stage: 0 — ничего не отправлено, 1 — альбом с фото отправлен, осталась клавиатура
+        """
+        CREATE TABLE admin_outbox (
+            outbox_id INTEGER PRIMARY KEY,
+            driver_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            stage INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP NOT NULL,
+            next_attempt_at TIMESTAMP NOT NULL
+        );
+        """,
+        "CREATE INDEX idx_admin_outbox_due ON admin_outbox(next_attempt_at);",
+    ]),
+    (7, "отложенные действия", [
+        """
+        CREATE TABLE delayed_actions (
+            action_id INTEGER PRIMARY KEY,
+            due_at REAL NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL
+        );
+        """,
+    ]),
+    (8, "справочник маршрутов routes и route_id вместо текста маршрута", _normalize_routes),
+    (9, "сводки для /stats с триггерами", _STATS_TABLES + STATS_RECOMPUTE),
+    (10, "индекс работающих водителей под загрузку индекса в памяти и сводки /stats", [
+        # Прежний «покрывающий» индекс по route_id, price, ... не использовался: поиск водителей
+        # идёт по индексу в памяти, а его загрузка отбирает ещё и по banned и subscription_end
+        "DROP INDEX IF EXISTS idx_users_available_drivers;",
+        """
+        CREATE INDEX idx_users_available_drivers ON users(role, available, banned, route_id)
+            WHERE role='driver' AND available=1 AND banned=0;
+        """,
+        "ANALYZE;",
+    ]),
+    (11, "владелец и аренда отложенных действий", [
+        # Строки, оставшиеся с прошлого запуска, считаются ничьими (аренда истекла)
+        "ALTER TABLE delayed_actions ADD COLUMN owner TEXT DEFAULT NULL;",
+        "ALTER TABLE delayed_actions ADD COLUMN lease_until REAL NOT NULL DEFAULT 0;",
+        "CREATE INDEX idx_delayed_actions_owner ON delayed_actions(owner);",
+        "CREATE INDEX idx_delayed_actions_lease ON delayed_actions(lease_until);",
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def migrate(conn):
+    """Применяет недостающие миграции по PRAGMA user_version, каждую в своей транзакции"""
+    async with conn.execute("PRAGMA user_version;") as cursor:
+        version = (await cursor.fetchone())[0]
+    if version >= SCHEMA_VERSION:
+        return version
+
+    for number, description, step in MIGRATIONS:
+        if number <= version:
+            continue
+        await conn.execute("BEGIN;")
+        try:
+            if callable(step):
+                await step(conn)
+            else:
+                for statement in step:
+                    await conn.execute(statement)
+            await conn.execute(f"PRAGMA user_version={number};")
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+        logging.info(f"Применена миграция {number}: {description}")
+    return SCHEMA_VERSION
@@ -0,0 +1,138 @@
+import asyncio
+import json
+import logging
+import os
+import random
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
+from dotenv import load_dotenv
+
+from database import get_db_connection
+from send_scheduler import background
+from callbacks import ApproveDriver, RejectDriver
+
+load_dotenv()
+ADMIN_ID = int(os.getenv("ADMIN_ID"))
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", "5"))  # секунд до первого повтора
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", "3600"))
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class AdminOutbox:
+    """Фоновая доставка заявок водителей администратору из таблицы admin_outbox.
+
+    Запись в outbox делается в одной транзакции с данными водителя (register_driver),
+    поэтому заявка не теряется ни при сбое Telegram, ни при перезапуске. Каждая запись
+    отправляется альбомом из техпаспорта и чека и отдельным сообщением с кнопками
+    (к альбому нельзя прикрепить клавиатуру). Неудачная попытка откладывается
+    с экспоненциальной паузой до OUTBOX_RETRY_MAX; удаляется запись только после доставки.
+    """
+
+    BATCH_SIZE = 20
+
+    def __init__(self):
+        self.bot = None
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self.wake_listeners = []  # Вызываются при wake(): воркер может работать в другом процессе
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        """Просит воркер проверить outbox сразу, не дожидаясь следующего срока"""
+        self._wakeup.set()
+        for listener in self.wake_listeners:
+            listener()
+
+    async def _run_forever(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                delay = await self.drain()
+            except Exception as e:
+                logging.error(f"Ошибка при обработке outbox администратора: {e}")
+                delay = OUTBOX_RETRY_BASE
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def drain(self) -> float:
+        """Отправляет все созревшие записи; возвращает паузу до следующей"""
+        while True:
+            now = datetime.now()
+            async with get_db_connection() as conn:
+                async with conn.execute("""
+                    SELECT outbox_id, driver_id, payload, stage, attempts FROM admin_outbox
+                    WHERE next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?
+                """, (now.strftime(TIME_FORMAT), self.BATCH_SIZE)) as cursor:
+                    rows = await cursor.fetchall()
+            for row in rows:
+                await self._deliver(*row)
+            if len(rows) < self.BATCH_SIZE:
+                break
+
+        async with get_db_connection() as conn:
+            async with conn.execute("SELECT MIN(next_attempt_at) FROM admin_outbox") as cursor:
+                next_attempt_at = (await cursor.fetchone())[0]
+        if next_attempt_at is None:
+            return OUTBOX_RETRY_MAX
+        wait = (datetime.strptime(next_attempt_at, TIME_FORMAT) - datetime.now()).total_seconds()
+        return min(max(wait, 1.0), OUTBOX_RETRY_MAX)
+
+    async def _deliver(self, outbox_id: int, driver_id: int, payload: str, stage: int, attempts: int):
+        data = json.loads(payload)
+        try:
+            with background():
+                if stage == 0:
+                    await self.bot.send_media_group(ADMIN_ID, media=[
+                        InputMediaPhoto(
+                            media=data["passport"],
+                            caption=f"🔔 Новый водитель ожидает одобрения!\n\n"
+                                    f"👤 Имя: {data['name']}\n"
+                                    f"📞 Телефон: {data['phone']}\n"
+                                    f"🚗 Автомобиль: {data['car']}\n\n"
+                                    f"📄 Техпаспорт и права, 💰 чек оплаты"
+                        ),
+                        InputMediaPhoto(media=data["payment"]),
+                    ])
+                    stage = 1
+                await self.bot.send_message(
+                    ADMIN_ID,
+                    f"Заявка водителя {data['name']} ({data['phone']}):",
+                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                        [InlineKeyboardButton(text="✅ Одобрить", callback_data=ApproveDriver(driver_id=driver_id).pack())],
+                        [InlineKeyboardButton(text="❌ Отклонить", callback_data=RejectDriver(driver_id=driver_id).pack())]
+                    ])
+                )
+        except Exception as e:
+            attempts += 1
+            delay = min(OUTBOX_RETRY_BASE * 2 ** (attempts - 1), OUTBOX_RETRY_MAX) * random.uniform(0.8, 1.2)
+            next_attempt_at = (datetime.now() + timedelta(seconds=delay)).strftime(TIME_FORMAT)
+            logging.error(f"Не удалось отправить заявку водителя {driver_id} админу "
+                          f"(попытка {attempts}, следующая в {next_attempt_at}): {e}")
+            async with get_db_connection() as conn:
+                await conn.execute("UPDATE admin_outbox SET stage=?, attempts=?, next_attempt_at=? WHERE outbox_id=?",
+                                   (stage, attempts, next_attempt_at, outbox_id))
+                await conn.commit()
+            return
+        async with get_db_connection() as conn:
+            await conn.execute("DELETE FROM admin_outbox WHERE outbox_id=?", (outbox_id,))
+            await conn.commit()
+
+
+admin_outbox = AdminOutbox()
@@ -1,13 +1,22 @@
 import logging
+import os
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, KeyboardButton, ReplyKeyboardMarkup
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from database import get_db_connection
+from database import get_db_connection, driver_index, book_ride, user_changed, fetch_user
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
+from dotenv import load_dotenv
 from messages import SUCCESS_PASSENGER
-import asyncio
+from routes import route_catalog
+from callbacks import callbacks, BookDriver, PassengerRoute, ConfirmRoute, DriverSearch
+from send_scheduler import background
+from delayed import delayed_actions
+from route_watch import watch_route, unwatch_route
+import replies
 
+load_dotenv()
 router = Router()
 
 class PassengerReg(StatesGroup):
@@ -15,6 +24,74 @@ class PassengerReg(StatesGroup):
     phone = State()
     route = State()
 
+
+DRIVER_PAGE_SIZE = int(os.getenv("DRIVER_PAGE_SIZE", "5"))
+# Порядки поиска водителей в кнопках: код DRIVER_SORTS -> подпись
+DRIVER_SORT_LABELS = {
+    "price": "💵 Дешевле",
+    "recent": "🕒 Недавно прибыли",
+    "rides": "🏆 Больше поездок",
+}
+
+# Кэш отрисованных страниц: (route_id, порядок, страница) -> (версия, текст, клавиатура)
+_driver_page_cache = {}
+
+
+def render_driver_page(route_id: int, sort: str = "price", page: int = 0):
+    """Возвращает текст и клавиатуру страницы поиска водителей, пересобирая её только при смене версии маршрута.
+
+    Страница — срез отсортированного списка driver_index, так что работа не зависит от числа водителей.
+    Сборка синхронная и не уступает цикл событий, поэтому одновременные запросы
+    одной страницы и версии всегда получают один и тот же собранный результат.
+    """
+    version = driver_index.version(route_id)
+    cached = _driver_page_cache.get((route_id, sort, page))
+    if cached and cached[0] == version:
+        return cached[1], cached[2]
+
+    drivers, total = driver_index.page(route_id, sort, page * DRIVER_PAGE_SIZE, DRIVER_PAGE_SIZE)
+    if total and not drivers:  # Водители ушли, а кнопка осталась — показываем последнюю страницу
+        return render_driver_page(route_id, sort, (total - 1) // DRIVER_PAGE_SIZE)
+    if not drivers:
+        text = None
+        keyboard = replies.keyboard("no_drivers")
+    else:
+        pages = (total + DRIVER_PAGE_SIZE - 1) // DRIVER_PAGE_SIZE
+        driver_list = "\n\n".join([
+            f"🚗 {driver.car_info}\n👤 {driver.name}\n📞 [{driver.phone}](tel:{driver.phone})\n💵 {driver.price} сум"
+            + (f"\n🕒 Прибыл: {driver.last_arrival_time}" if driver.last_arrival_time else "")
+            + f"\n{'✅ Работает' if driver.available == 1 else '❌ Не работает'}"
+            for driver in drivers
+        ])
+        buttons = [[InlineKeyboardButton(text=f"✅ Договорился с {driver.name}",
+                                         callback_data=BookDriver(driver_id=driver.user_id).pack())]
+                   for driver in drivers]
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton(
+                text="⬅️", callback_data=DriverSearch(sort=sort, page=page - 1).pack()))
+        if page + 1 < pages:
+            navigation.append(InlineKeyboardButton(
+                text="➡️", callback_data=DriverSearch(sort=sort, page=page + 1).pack()))
+        if navigation:
+            buttons.append(navigation)
+        buttons.append([
+            InlineKeyboardButton(text=("• " if code == sort else "") + label,
+                                 callback_data=DriverSearch(sort=code, page=0).pack())
+            for code, label in DRIVER_SORT_LABELS.items()
+        ])
+        buttons.append([InlineKeyboardButton(text="🔔 Сообщить о новых водителях", callback_data="watch_route")])
+        buttons.append([InlineKeyboardButton(text="⬅️ Вернуться в меню", callback_data="return_to_menu")])
+        text = (
+            f"🚗 Доступные водители по маршруту \n{route_catalog.label(route_id)}:\n"
+            f"{DRIVER_SORT_LABELS[sort]} · стр. {page + 1} из {pages} · всего {total}\n\n{driver_list}\n\n"
+            f"📲 **Свяжитесь с водителем по номеру телефона, чтобы договориться о поездке.**\n"
+            f"После этого нажмите кнопку ниже, чтобы отметить, что вы договорились."
+        )
+        keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+    _driver_page_cache[(route_id, sort, page)] = (version, text, keyboard)
+    return text, keyboard
+
 @router.message(PassengerReg.name)
 async def passenger_name(message: Message, state: FSMContext):
     name = message.text.strip()
@@ -23,12 +100,8 @@ async def passenger_name(message: Message, state: FSMContext):
         return
     await state.update_data(name=name)
     await state.set_state(PassengerReg.phone)
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="☎️ Отправить номер", request_contact=True)]],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
-    await message.answer("☎️ Укажите ваш номер телефона:", reply_markup=keyboard)
+    await message.answer("☎️ Укажите ваш номер телефона:",
+                         reply_markup=replies.keyboard("passenger_contact", message.from_user.language_code))
 
 @router.message(F.contact, PassengerReg.phone)
 async def passenger_phone(message: Message, state: FSMContext):
@@ -44,90 +117,77 @@ async def passenger_phone(message: Message, state: FSMContext):
     name = data.get("name")
     user_id = message.from_user.id
 
-    conn = await get_db_connection()
-    await conn.execute(
-        "INSERT INTO users (user_id, role, name, phone) VALUES (?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET name=?, phone=?",
-        (user_id, "passenger", name, phone, name, phone)
-    )
-    await conn.commit()
-    await conn.close()
+    async with get_db_connection() as conn:
+        await conn.execute(
+            "INSERT INTO users (user_id, role, name, phone) VALUES (?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET name=?, phone=?",
+            (user_id, "passenger", name, phone, name, phone)
+        )
+        await conn.commit()
+        await user_changed(user_id, conn)
 
     await state.update_data(phone=phone)
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🛫 Ташкент ➡️ Нукус 🛬", callback_data="passenger_route_tashkent_nukus")],
-        [InlineKeyboardButton(text="🛫 Нукус ➡️ Ташкент 🛬", callback_data="passenger_route_nukus_tashkent")]
-    ])
     await state.set_state(PassengerReg.route)
-    await message.answer("🚖 Выберите маршрут:", reply_markup=keyboard)
+    await message.answer(replies.text("choose_route", message.from_user.language_code),
+                         reply_markup=route_catalog.keyboard(PassengerRoute))
 
-@router.callback_query(lambda c: c.data.startswith("passenger_route_"))
-async def confirm_passenger_route(callback: CallbackQuery):
-    user_id = callback.from_user.id
-    new_route = "🛫 Ташкент ➡️ Нукус 🛬" if callback.data == "passenger_route_tashkent_nukus" else "🛫 Нукус ➡️ Ташкент 🛬"
+@callbacks.handler(PassengerRoute)
+async def confirm_passenger_route(callback: CallbackQuery, callback_data: PassengerRoute):
+    new_route = route_catalog.selectable(callback_data.route)
+    if new_route is None:
+        await callback.answer("❌ Этот маршрут больше недоступен. Выберите другой.", show_alert=True)
+        return
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"confirm_route_{new_route}")],
+        [InlineKeyboardButton(text="✅ Подтвердить", callback_data=ConfirmRoute(route=new_route.route_id).pack())],
         [InlineKeyboardButton(text="❌ Изменить маршрут", callback_data="change_passenger_route")]
     ])
-    await callback.message.edit_text(f"Вы выбрали маршрут: \n{new_route}.\n\n❗️ Подтвердите выбор:", reply_markup=keyboard)
+    await callback.message.edit_text(
+        replies.text("passenger_route_confirm", callback.from_user.language_code, route=new_route.label),
+        reply_markup=keyboard)
     await callback.answer()
 
-@router.callback_query(lambda c: c.data == "change_passenger_route")
+@callbacks.handler("change_passenger_route")
 async def change_passenger_route(callback: CallbackQuery):
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🛫 Ташкент ➡️ Нукус 🛬", callback_data="passenger_route_tashkent_nukus")],
-        [InlineKeyboardButton(text="🛫 Нукус ➡️ Ташкент 🛬", callback_data="passenger_route_nukus_tashkent")]
-    ])
-    await callback.message.edit_text("Выберите новый маршрут:", reply_markup=keyboard)
+    await callback.message.edit_text(replies.text("choose_new_route", callback.from_user.language_code),
+                                     reply_markup=route_catalog.keyboard(PassengerRoute))
     await callback.answer()
 
-@router.callback_query(lambda c: c.data.startswith("confirm_route_"))
-async def choose_passenger_route(callback: CallbackQuery, state: FSMContext):
+@callbacks.handler(ConfirmRoute)
+async def choose_passenger_route(callback: CallbackQuery, callback_data: ConfirmRoute, state: FSMContext):
     user_id = callback.from_user.id
-    new_route = callback.data.replace("confirm_route_", "")
-    conn = await get_db_connection()
+    new_route = route_catalog.selectable(callback_data.route)
+    if new_route is None:
+        await callback.answer("❌ Этот маршрут больше недоступен. Выберите другой.", show_alert=True)
+        return
     try:
-        await conn.execute("UPDATE users SET route=? WHERE user_id=?", (new_route, user_id))
-        await conn.commit()
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✏ Изменить маршрут", callback_data="change_passenger_route")],
-            [InlineKeyboardButton(text="🔄 Найти водителей", callback_data="find_drivers")]
-        ])
-        await callback.message.edit_text(
-            f"✅ Ваш маршрут сохранён: \n{new_route}.\n\nВыберите действие:",
-            reply_markup=keyboard
-        )
+        async with get_db_connection() as conn:
+            await conn.execute("UPDATE users SET route_id=? WHERE user_id=?", (new_route.route_id, user_id))
+            await conn.commit()
+            await user_changed(user_id, conn)
+            await unwatch_route(user_id, conn)
+        language = callback.from_user.language_code
+        await callback.message.edit_text(replies.text("passenger_route_saved", language, route=new_route.label),
+                                         reply_markup=replies.keyboard("passenger_menu", language))
         success_message = await callback.message.bot.send_message(user_id, SUCCESS_PASSENGER)
-        await asyncio.sleep(5)
-        await callback.message.bot.delete_message(chat_id=user_id, message_id=success_message.message_id)
+        await delayed_actions.schedule("delete_message", 5, chat_id=user_id, message_id=success_message.message_id)
     except Exception as e:
         print(f"Ошибка изменения маршрута пассажира {user_id}: {e}")
-    finally:
-        await conn.close()
     await state.clear()
     await callback.answer()
 
-@router.callback_query(lambda c: c.data == "find_drivers")
+@callbacks.handler("find_drivers")
 async def find_drivers(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     logging.info(f"Пользователь {user_id} нажал 'Найти водителей'")
 
-    conn = await get_db_connection()
     try:
-        cursor = await conn.execute("SELECT route FROM users WHERE user_id=?", (user_id,))
-        row = await cursor.fetchone()
-        if not row or not row[0]:
+        user = await fetch_user(user_id)
+        if not user or not user.route_id:
             logging.warning(f"У пользователя {user_id} не установлен маршрут")
             await callback.answer("❌ У вас нет указанного маршрута! Выберите маршрут сначала.", show_alert=True)
             return
-        passenger_route = row[0]
+        passenger_route = route_catalog.label(user.route_id)
         logging.info(f"Маршрут пользователя {user_id}: {passenger_route}")
-
-        cursor = await conn.execute(
-            "SELECT user_id, name, phone, car_info, price, last_arrival_time, available FROM users WHERE role='driver' AND available=1 AND route=?",
-            (passenger_route,)
-        )
-        drivers = await cursor.fetchall()
-        logging.info(f"Найдено водителей: {len(drivers)}")
+        driver_list, keyboard = render_driver_page(user.route_id)
 
         data = await state.get_data()
         previous_message_id = data.get("last_driver_list_message_id")
@@ -138,35 +198,20 @@ async def find_drivers(callback: CallbackQuery, state: FSMContext):
             except Exception as e:
                 logging.error(f"Ошибка при удалении сообщения {previous_message_id}: {e}")
 
-        if not drivers:
+        if driver_list is None:
             new_message = await callback.message.answer(
                 "❌ Нет доступных водителей на этом маршруте.",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="⬅️ Вернуться в меню", callback_data="return_to_menu")]
-                ])
+                reply_markup=keyboard
             )
             logging.info("Водители не найдены")
         else:
-            driver_list = "\n\n".join([
-                f"🚗 {driver[3]}\n👤 {driver[1]}\n📞 [{driver[2]}](tel:{driver[2]})\n💵 {driver[4]} сум"
-                + (f"\n🕒 Прибыл: {driver[5]}" if driver[5] else "")
-                + f"\n{'✅ Работает' if driver[6] == 1 else '❌ Не работает'}"
-                for driver in drivers
-            ])
-            buttons = []
-            for driver in drivers:
-                driver_id = driver[0]
-                buttons.append([InlineKeyboardButton(text=f"✅ Договорился с {driver[1]}", callback_data=f"book_driver_{driver_id}")])
-            buttons.append([InlineKeyboardButton(text="⬅️ Вернуться в меню", callback_data="return_to_menu")])
             new_message = await callback.message.answer(
-                f"🚗 Доступные водители по маршруту \n{passenger_route}:\n\n{driver_list}\n\n"
-                f"📲 **Свяжитесь с водителем по номеру телефона, чтобы договориться о поездке.**\n"
-                f"После этого нажмите кнопку ниже, чтобы отметить, что вы договорились.",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
+                driver_list,
+                reply_markup=keyboard,
                 parse_mode="Markdown",
                 disable_web_page_preview=True
             )
-            logging.info(f"Список водителей отправлен: {driver_list}")
+            logging.info(f"Список водителей маршрута {passenger_route} отправлен")
 
         await state.update_data(last_driver_list_message_id=new_message.message_id)
         await state.clear()
@@ -174,95 +219,104 @@ async def find_drivers(callback: CallbackQuery, state: FSMContext):
     except Exception as e:
         logging.error(f"Ошибка в find_drivers для пользователя {user_id}: {e}")
         await callback.message.answer("⚠️ Произошла ошибка при поиске водителей. Попробуйте позже.")
-    finally:
-        await conn.close()
 
     await callback.answer()
 
-@router.callback_query(lambda c: c.data.startswith("book_driver_"))
-async def book_driver(callback: CallbackQuery):
+@callbacks.handler(DriverSearch)
+async def search_drivers(callback: CallbackQuery, callback_data: DriverSearch):
+    """Листание и смена порядка в уже показанном списке водителей"""
+    if callback_data.sort not in DRIVER_SORT_LABELS or callback_data.page < 0:
+        await callback.answer()
+        return
+    user = await fetch_user(callback.from_user.id)
+    if not user or not user.route_id:
+        await callback.answer("❌ У вас нет указанного маршрута! Выберите маршрут сначала.", show_alert=True)
+        return
+    driver_list, keyboard = render_driver_page(user.route_id, callback_data.sort, callback_data.page)
+    try:
+        if driver_list is None:
+            await callback.message.edit_text("❌ Нет доступных водителей на этом маршруте.", reply_markup=keyboard)
+        else:
+            await callback.message.edit_text(driver_list, reply_markup=keyboard, parse_mode="Markdown",
+                                             disable_web_page_preview=True)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):  # Повторное нажатие той же кнопки
+            raise
+    await callback.answer()
+
+@callbacks.handler("watch_route")
+async def watch_route_handler(callback: CallbackQuery):
     user_id = callback.from_user.id
-    driver_id = int(callback.data.split("_")[2])
+    user = await fetch_user(user_id)
+    if not user or not user.route_id:
+        await callback.answer("❌ У вас нет указанного маршрута! Выберите маршрут сначала.", show_alert=True)
+        return
+    expires_at = await watch_route(user_id, user.route_id)
+    await callback.answer(
+        f"🔔 Мы сообщим, когда на вашем маршруте появится водитель.\nПодписка действует до {expires_at}.",
+        show_alert=True
+    )
 
-    conn = await get_db_connection()
-    try:
-        cursor = await conn.execute("SELECT rides_count, name FROM users WHERE user_id=?", (driver_id,))
-        row = await cursor.fetchone()
-        if row:
-            new_rides_count = row[0] + 1
-            driver_name = row[1]
-            await conn.execute("UPDATE users SET rides_count=? WHERE user_id=?", (new_rides_count, driver_id))
-            await conn.commit()
+@callbacks.handler(BookDriver)
+async def book_driver(callback: CallbackQuery, callback_data: BookDriver):
+    user_id = callback.from_user.id
+    driver_id = callback_data.driver_id
 
-        cursor = await conn.execute("SELECT name, phone FROM users WHERE user_id=?", (user_id,))
-        passenger_row = await cursor.fetchone()
+    try:
+        # Ключ идемпотентности: повторное нажатие в том же списке не засчитывает поездку дважды
+        booking = await book_ride(user_id, driver_id, f"{user_id}:{driver_id}:{callback.message.message_id}")
+        if booking is None:
+            await callback.answer("❌ Водитель не найден.", show_alert=True)
+            return
+        created, driver_name, passenger_row = booking
         passenger_name = passenger_row[0] if passenger_row else "Пассажир"
         passenger_phone = passenger_row[1] if passenger_row else "Не указан"
 
-        try:
-            await callback.message.bot.send_message(
-                driver_id,
-                f"🔔 Пассажир {passenger_name} договорился с вами о поездке!\n"
-                f"📞 Свяжитесь с ним: [{passenger_phone}](tel:{passenger_phone})",
-                parse_mode="Markdown",
-                disable_web_page_preview=True
-            )
-        except Exception as e:
-            logging.error(f"Не удалось уведомить водителя {driver_id}: {e}")
-
-        await callback.message.edit_text(
-            f"✅ Вы отметили, что договорились с {driver_name}!\n\n"
-            f"Если хотите найти других водителей, вернитесь в меню.",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="⬅️ Вернуться в меню", callback_data="return_to_menu")]
-            ])
-        )
+        if created:
+            await unwatch_route(user_id)  # Поездка найдена — уведомления больше не нужны
+            try:
+                with background():
+                    await callback.message.bot.send_message(
+                        driver_id,
+                        f"🔔 Пассажир {passenger_name} договорился с вами о поездке!\n"
+                        f"📞 Свяжитесь с ним: [{passenger_phone}](tel:{passenger_phone})",
+                        parse_mode="Markdown",
+                        disable_web_page_preview=True
+                    )
+            except Exception as e:
+                logging.error(f"Не удалось уведомить водителя {driver_id}: {e}")
+
+        language = callback.from_user.language_code
+        await callback.message.edit_text(replies.text("passenger_booked", language, driver=driver_name),
+                                         reply_markup=replies.keyboard("back_to_menu", language))
     except Exception as e:
         logging.error(f"Ошибка при бронировании водителя {driver_id} для пользователя {user_id}: {e}")
         await callback.message.answer("⚠️ Произошла ошибка. Попробуйте позже.")
-    finally:
-        await conn.close()
 
     await callback.answer()
 
-@router.callback_query(lambda c: c.data == "return_to_menu")
+@callbacks.handler("return_to_menu")
 async def return_to_menu(callback: CallbackQuery):
     user_id = callback.from_user.id
-    conn = await get_db_connection()
-    try:
-        cursor = await conn.execute("SELECT route FROM users WHERE user_id=?", (user_id,))
-        row = await cursor.fetchone()
-        current_route = row[0] if row and row[0] else "Маршрут не установлен"
-    except Exception as e:
-        logging.error(f"Ошибка получения данных пассажира {user_id}: {e}")
-        current_route = "Маршрут не установлен"
-    finally:
-        await conn.close()
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✏ Изменить маршрут", callback_data="change_passenger_route")],
-        [InlineKeyboardButton(text="🔄 Найти водителей", callback_data="find_drivers")]
-    ])
-    await callback.message.edit_text(
-        f"🧑‍💼 Вы зарегистрированы как пассажир.\n"
-        f"🛣 Ваш маршрут: {current_route}\n\n"
-        f"Выберите действие:",
-        reply_markup=keyboard
-    )
+    user = await fetch_user(user_id)
+    current_route = route_catalog.label(user.route_id if user else None)
+    language = callback.from_user.language_code
+    await callback.message.edit_text(replies.text("passenger_menu", language, route=current_route),
+                                     reply_markup=replies.keyboard("passenger_menu", language))
     await callback.answer()
 
 @router.message(Command("cancel"))
 async def cancel_command(message: Message, state: FSMContext):
     current_state = await state.get_state()
     if current_state is not None:  # Если пользователь в процессе регистрации
-        conn = await get_db_connection()
-        try:
-            await conn.execute("DELETE FROM users WHERE user_id=?", (message.from_user.id,))
-            await conn.commit()
-        except Exception as e:
-            logging.error(f"Ошибка при удалении данных пользователя {message.from_user.id}: {e}")
-        finally:
-            await conn.close()
+        async with get_db_connection() as conn:
+            try:
+                await conn.execute("DELETE FROM users WHERE user_id=?", (message.from_user.id,))
+                await conn.commit()
+                await user_changed(message.from_user.id, conn)
+                await unwatch_route(message.from_user.id, conn)
+            except Exception as e:
+                logging.error(f"Ошибка при удалении данных пользователя {message.from_user.id}: {e}")
     await state.clear()
     await message.answer("❌ Все действия отменены. Используйте /start, чтобы начать заново.")
 
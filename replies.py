@@ -0,0 +1,128 @@
+# replies.py
+"""Готовые клавиатуры и шаблоны ответов.
+
+Клавиатуры собираются (и проверяются pydantic) один раз при импорте. Объекты aiogram
+неизменяемые, поэтому один экземпляр отдаётся во все ответы. Клавиатура, помеченная
+prebuilt(), сериализуется в JSON при первой отправке, дальше PrebuiltSession
+подставляет готовую строку вместо model_dump + json_dumps на каждый ответ.
+
+Тексты и подписи кнопок хранятся по языкам: LOCALES[язык] = (шаблоны, клавиатуры).
+Пока заполнен только русский; для другого языка достаточно добавить словари с теми же
+ключами — недостающие шаблоны и клавиатуры берутся из DEFAULT_LOCALE.
+"""
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, KeyboardButton, ReplyKeyboardMarkup
+
+DEFAULT_LOCALE = "ru"
+
+_prebuilt = {}  # id(клавиатура) -> [клавиатура, JSON или None]; ссылка держит id занятым
+
+
+def prebuilt(markup):
+    """Помечает неизменяемую клавиатуру, чтобы её JSON считался один раз"""
+    _prebuilt.setdefault(id(markup), [markup, None])
+    return markup
+
+
+class PrebuiltSession(AiohttpSession):
+    """Сессия, которая отправляет помеченные prebuilt() клавиатуры уже сериализованными"""
+
+    def build_form_data(self, bot, method):
+        markup = getattr(method, "reply_markup", None)
+        entry = _prebuilt.get(id(markup)) if markup is not None else None
+        if entry is None or entry[0] is not markup:
+            return super().build_form_data(bot, method)
+        form = super().build_form_data(bot, method.model_copy(update={"reply_markup": None}))
+        if entry[1] is None:
+            entry[1] = self.prepare_value(markup, bot=bot, files={})
+        form.add_field("reply_markup", entry[1])
+        return form
+
+
+def _inline(*rows):
+    return prebuilt(InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=text, callback_data=callback_data) for text, callback_data in row]
+        for row in rows
+    ]))
+
+
+def _contact(text):
+    return prebuilt(ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text=text, request_contact=True)]],
+        resize_keyboard=True,
+        one_time_keyboard=True
+    ))
+
+
+_RU_TEXTS = {
+    "admin_panel": "🔧 Панель администратора:",
+    "driver_saved": "✅ Ваш маршрут и сумма сохранены:\n"
+                    "🛣 Маршрут: {route}\n"
+                    "💵 Сумма: {price} сум\n\n"
+                    "Выберите действие:",
+    "driver_busy": "🚫 Вы теперь **не работаете**. \n\nКогда будете готовы, нажмите \n'✅ Вернуться на работу'.",
+    "driver_available": "✅ Вы **вернулись на работу**.\n"
+                        "🛣 Ваш маршрут: {route}\n"
+                        "💵 Сумма: {price} сум\n\n"
+                        "Выберите действие:",
+    "driver_route_saved": "✅ Ваш маршрут сохранён: \n{route}.\n\n"
+                          "💵 Укажите сумму за поездку (введите число, например, 100000):",
+    "driver_waiting": "✅ Ваши данные отправлены администратору. Ожидайте одобрения.\n"
+                      "{admin_message}\n"
+                      "Если хотите отменить заявку, нажмите кнопку ниже.",
+    "choose_route": "🚖 Выберите маршрут:",
+    "choose_new_route": "🚖 Выберите новый маршрут:",
+    "passenger_menu": "🧑‍💼 Вы зарегистрированы как пассажир.\n"
+                      "🛣 Ваш маршрут: {route}\n\n"
+                      "Выберите действие:",
+    "passenger_route_confirm": "Вы выбрали маршрут: \n{route}.\n\n❗️ Подтвердите выбор:",
+    "passenger_route_saved": "✅ Ваш маршрут сохранён: \n{route}.\n\nВыберите действие:",
+    "passenger_booked": "✅ Вы отметили, что договорились с {driver}!\n\n"
+                        "Если хотите найти других водителей, вернитесь в меню.",
+    "route_watch_notice": "🔔 На маршруте \n{route}\nпоявился водитель!",
+}
+
+_RU_KEYBOARDS = {
+    "choose_role": _inline([("🧑‍💼 Я пассажир", "reg_passenger")], [("🚗 Я водитель", "reg_driver")]),
+    "admin_panel": _inline(
+        [("📜 Список водителей", "list_drivers")],
+        [("📜 Список пассажиров", "list_passengers")],
+        [("🚫 Заблокировать пользователя", "ban_user")],
+        [("♻️ Разблокировать пользователя", "unban_user")],
+        [("🔄 Обновить статус водителя", "update_driver_status")],
+    ),
+    "driver_contact": _contact("📞 Отправить номер"),
+    "driver_waiting": _inline([("❌ Отменить заявку", "cancel_driver_reg")]),
+    "driver_menu": _inline([("✏ Изменить маршрут и сумму", "change_driver_route")], [("🚫 Не работаю", "driver_busy")]),
+    "driver_busy": _inline([("✅ Вернуться на работу", "driver_available")]),
+    "passenger_contact": _contact("☎️ Отправить номер"),
+    "passenger_menu": _inline([("✏ Изменить маршрут", "change_passenger_route")], [("🔄 Найти водителей", "find_drivers")]),
+    "no_drivers": _inline([("🔔 Сообщить, когда появится водитель", "watch_route")],
+                          [("⬅️ Вернуться в меню", "return_to_menu")]),
+    "back_to_menu": _inline([("⬅️ Вернуться в меню", "return_to_menu")]),
+    "find_drivers": _inline([("🔄 Найти водителей", "find_drivers")]),
+}
+
+LOCALES = {
+    "ru": (_RU_TEXTS, _RU_KEYBOARDS),
+}
+
+
+def locale(language_code: str = None) -> str:
+    """Язык ответа по language_code пользователя Telegram; неизвестные — DEFAULT_LOCALE"""
+    if language_code:
+        language_code = language_code.split("-")[0].lower()
+        if language_code in LOCALES:
+            return language_code
+    return DEFAULT_LOCALE
+
+
+def text(name: str, language_code: str = None, **fields) -> str:
+    texts = LOCALES[locale(language_code)][0]
+    template = texts.get(name) or LOCALES[DEFAULT_LOCALE][0][name]
+    return template.format_map(fields) if fields else template
+
+
+def keyboard(name: str, language_code: str = None):
+    keyboards = LOCALES[locale(language_code)][1]
+    return keyboards.get(name) or LOCALES[DEFAULT_LOCALE][1][name]
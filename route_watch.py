@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+
+from database import get_db_connection, driver_index
+from routes import route_catalog
+from send_scheduler import background
+import replies
+
+ROUTE_WATCH_TTL = timedelta(hours=int(os.getenv("ROUTE_WATCH_TTL_HOURS", "12")))
+ROUTE_WATCH_DEDUP_WINDOW = timedelta(minutes=int(os.getenv("ROUTE_WATCH_DEDUP_MINUTES", "10")))
+ROUTE_WATCH_CONCURRENCY = int(os.getenv("ROUTE_WATCH_CONCURRENCY", "20"))
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+async def watch_route(passenger_id: int, route_id: int) -> str:
+    """Подписывает пассажира на появление водителей маршрута; возвращает время окончания подписки"""
+    expires_at = (datetime.now() + ROUTE_WATCH_TTL).strftime(TIME_FORMAT)
+    async with get_db_connection() as conn:
+        await conn.execute("""
+            INSERT INTO route_watchers (passenger_id, route_id, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(passenger_id) DO UPDATE SET
+                notified_at = CASE WHEN route_id = excluded.route_id THEN notified_at END,
+                route_id = excluded.route_id,
+                expires_at = excluded.expires_at
+        """, (passenger_id, route_id, expires_at))
+        await conn.commit()
+    return expires_at
+
+
+async def unwatch_route(passenger_id: int, conn=None):
+    if conn is None:
+        async with get_db_connection() as conn:
+            return await unwatch_route(passenger_id, conn)
+    await conn.execute("DELETE FROM route_watchers WHERE passenger_id=?", (passenger_id,))
+    await conn.commit()
+
+
+class RouteNotifier:
+    """Рассылка подписчикам маршрута, когда на нём появляется водитель.
+
+    Рассылка запускается только при реальном изменении: водитель стал виден в индексе
+    на маршруте, где его раньше не было. Пока рассылка по маршруту идёт, новые поводы
+    для него поглощаются. Подписчики читаются пачками по keyset, каждому не чаще раза
+    в ROUTE_WATCH_DEDUP_WINDOW; истёкшие подписки удаляются перед рассылкой.
+    """
+
+    BATCH_SIZE = 200
+
+    def __init__(self):
+        self._running = {}  # route_id -> задача рассылки
+
+    def driver_changed(self, bot: Bot, driver_id: int, previous_route_id: int = None):
+        """Вызывается после записи, которая могла вывести водителя на маршрут"""
+        route_id = driver_index.route_of(driver_id)
+        if route_id is None or route_id == previous_route_id:
+            return
+        task = self._running.get(route_id)
+        if task is not None and not task.done():
+            return
+        self._running[route_id] = asyncio.create_task(self._fan_out_safe(bot, route_id))
+
+    async def _fan_out_safe(self, bot: Bot, route_id: int):
+        try:
+            sent = await self.fan_out(bot, route_id)
+            if sent:
+                logging.info(f"Подписчикам маршрута {route_id} отправлено уведомлений: {sent}")
+        except Exception as e:
+            logging.error(f"Ошибка рассылки подписчикам маршрута {route_id}: {e}")
+        finally:
+            self._running.pop(route_id, None)
+
+    async def fan_out(self, bot: Bot, route_id: int) -> int:
+        now = datetime.now()
+        now_text = now.strftime(TIME_FORMAT)
+        notified_before = (now - ROUTE_WATCH_DEDUP_WINDOW).strftime(TIME_FORMAT)
+        semaphore = asyncio.Semaphore(ROUTE_WATCH_CONCURRENCY)
+        notice = replies.text("route_watch_notice", route=route_catalog.label(route_id))
+        keyboard = replies.keyboard("find_drivers")
+
+        async def send(passenger_id):
+            async with semaphore:
+                try:
+                    with background():
+                        await bot.send_message(passenger_id, notice, reply_markup=keyboard)
+                except Exception as e:
+                    logging.error(f"Не удалось уведомить пассажира {passenger_id}: {e}")
+
+        total = 0
+        last_id = 0
+        async with get_db_connection() as conn:
+            await conn.execute("DELETE FROM route_watchers WHERE route_id=? AND expires_at <= ?", (route_id, now_text))
+            await conn.commit()
+        while True:
+            async with get_db_connection() as conn:
+                async with conn.execute("""
+                    SELECT passenger_id FROM route_watchers
+                    WHERE route_id=? AND passenger_id > ? AND expires_at > ?
+                      AND (notified_at IS NULL OR notified_at <= ?)
+                    ORDER BY passenger_id LIMIT ?
+                """, (route_id, last_id, now_text, notified_before, self.BATCH_SIZE)) as cursor:
+                    passenger_ids = [row[0] for row in await cursor.fetchall()]
+                if not passenger_ids:
+                    return total
+                # Отмечаем до отправки: при сбое уведомление лучше потерять, чем прислать дважды
+                await conn.executemany("UPDATE route_watchers SET notified_at=? WHERE passenger_id=?",
+                                       [(now_text, passenger_id) for passenger_id in passenger_ids])
+                await conn.commit()
+            await asyncio.gather(*(send(passenger_id) for passenger_id in passenger_ids))
+            total += len(passenger_ids)
+            last_id = passenger_ids[-1]
+
+    async def close(self):
+        tasks = [task for task in self._running.values() if not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+route_notifier = RouteNotifier()
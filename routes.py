@@ -0,0 +1,70 @@
+import logging
+from typing import NamedTuple
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from database import get_db_connection
+from replies import prebuilt
+
+
+class Route(NamedTuple):
+    route_id: int
+    origin: str
+    destination: str
+    label: str
+
+
+class RouteCatalog:
+    """Справочник маршрутов из таблицы routes, загруженный в память процесса.
+
+    В users, bookings, route_watchers и callback_data маршрут хранится номером route_id,
+    текст кнопки берётся отсюда. Новый маршрут — это строка в таблице, а не правка кода:
+
+        INSERT INTO routes (origin, destination, label, position)
+        VALUES ('Самарканд', 'Ташкент', '🛫 Самарканд ➡️ Ташкент 🛬', 3);
+
+    После изменения таблицы справочник перечитывается при перезапуске (или вызовом load()).
+    """
+
+    def __init__(self):
+        self._routes = {}  # route_id -> Route, в том числе отключённые
+        self._active = {}  # route_id -> Route, действующие маршруты в порядке кнопок
+        self._keyboards = {}  # класс CallbackData -> клавиатура выбора маршрута
+
+    async def load(self):
+        async with get_db_connection() as conn:
+            async with conn.execute(
+                    "SELECT route_id, origin, destination, label, active FROM routes ORDER BY position, route_id") as cursor:
+                rows = await cursor.fetchall()
+        self._routes = {row[0]: Route(*row[:4]) for row in rows}
+        self._active = {row[0]: self._routes[row[0]] for row in rows if row[4]}
+        self._keyboards.clear()
+        logging.info(f"Справочник маршрутов загружен: {len(self._active)} действующих")
+
+    def get(self, route_id: int):
+        """Маршрут по номеру или None, если такого нет"""
+        return self._routes.get(route_id)
+
+    def label(self, route_id: int, default: str = "Маршрут не установлен") -> str:
+        route = self._routes.get(route_id)
+        return route.label if route else default
+
+    def selectable(self, route_id: int):
+        """Действующий маршрут по номеру из кнопки или None (маршрут удалён или отключён)"""
+        return self._active.get(route_id)
+
+    def active(self):
+        return list(self._active.values())
+
+    def keyboard(self, callback_data_cls) -> InlineKeyboardMarkup:
+        """Клавиатура выбора маршрута с кнопками callback_data_cls(route=route_id); собирается один раз"""
+        keyboard = self._keyboards.get(callback_data_cls)
+        if keyboard is None:
+            keyboard = self._keyboards[callback_data_cls] = prebuilt(InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text=route.label, callback_data=callback_data_cls(route=route.route_id).pack())]
+                for route in self._active.values()
+            ]))
+        return keyboard
+
+
+route_catalog = RouteCatalog()
@@ -0,0 +1,192 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    AnswerCallbackQuery, DeleteMessage, EditMessageCaption, EditMessageReplyMarkup, EditMessageText
+)
+
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))  # сообщений в секунду на бота
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))  # сообщений в секунду на чат
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_MAX_RETRIES = 3
+
+# Приоритеты: меньше — раньше
+INTERACTIVE = 0
+NORMAL = 1
+BACKGROUND = 2
+
+_INTERACTIVE_METHODS = (AnswerCallbackQuery, EditMessageText, EditMessageReplyMarkup, EditMessageCaption, DeleteMessage)
+_priority = ContextVar("send_priority", default=None)
+
+
+@contextmanager
+def background():
+    """Помечает отправки внутри блока как фоновые уведомления"""
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до появления токена"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """Очередь исходящих запросов к Telegram с общим и поканальным ограничением скорости.
+
+    Запросы без chat_id (answerCallbackQuery, getUpdates и т.п.) проходят сразу. Остальные
+    ждут в куче по приоритету: ответы на нажатия раньше обычных сообщений, обычные раньше
+    фоновых уведомлений. RetryAfter от Telegram приостанавливает всю очередь и повторяет запрос.
+    """
+
+    def __init__(self, global_rate: float = SEND_GLOBAL_RATE, chat_rate: float = SEND_CHAT_RATE,
+                 chat_burst: int = SEND_CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self._queue = []  # (приоритет, порядковый номер, chat_id, future)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._paused_until = 0.0
+        self._pruned_at = 0.0
+        self._worker = None
+        self.sent = 0
+        self.retried = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "sent": self.sent,
+            "retried": self.retried,
+            "wait_time_avg": self.wait_time_total / self.sent if self.sent else 0.0,
+            "wait_time_max": self.wait_time_max,
+        }
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        priority = _priority.get()
+        if priority is None:
+            priority = INTERACTIVE if isinstance(method, _INTERACTIVE_METHODS) else NORMAL
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            await self._acquire(priority, chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == SEND_MAX_RETRIES:
+                    raise
+                self.retried += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                logging.warning(f"Флуд-контроль Telegram для чата {chat_id}: пауза {e.retry_after} с")
+
+    async def _acquire(self, priority: int, chat_id):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        enqueued_at = time.monotonic()
+        heapq.heappush(self._queue, (priority, next(self._seq), chat_id, future))
+        self._wakeup.set()
+        await future
+        waited = time.monotonic() - enqueued_at
+        self.sent += 1
+        self.wait_time_total += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _grant_next(self, now: float) -> float:
+        """Выдаёт слот первому по приоритету запросу, чей чат не исчерпал лимит; иначе возвращает паузу"""
+        skipped = []
+        wait = float("inf")
+        try:
+            while self._queue:
+                item = heapq.heappop(self._queue)
+                if item[3].cancelled():
+                    continue
+                bucket = self._chat_bucket(item[2])
+                delay = bucket.delay(now)
+                if delay:
+                    skipped.append(item)
+                    wait = min(wait, delay)
+                    continue
+                bucket.take()
+                self.global_bucket.take()
+                item[3].set_result(None)
+                return 0.0
+        finally:
+            for item in skipped:
+                heapq.heappush(self._queue, item)
+        return wait if skipped else 0.0
+
+    def _prune_chat_buckets(self, now: float):
+        # Полные корзины ничем не отличаются от новых, их можно забыть
+        if now - self._pruned_at > 60:
+            self._pruned_at = now
+            self.chat_buckets = {chat_id: bucket for chat_id, bucket in self.chat_buckets.items()
+                                 if not bucket.is_full(now)}
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            delay = max(self._paused_until - now, self.global_bucket.delay(now))
+            if delay <= 0:
+                delay = self._grant_next(now)
+                self._prune_chat_buckets(now)
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+
+
+send_scheduler = SendScheduler()
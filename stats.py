@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from database import get_db_connection, count_route_rides
+from migrations import STATS_RECOMPUTE
+from routes import route_catalog
+
+STATS_RECONCILE_INTERVAL = int(os.getenv("STATS_RECONCILE_INTERVAL", "3600"))  # секунд
+STATS_DAYS = 7  # дней в сводке поездок /stats
+
+
+async def fetch_stats(days: int = STATS_DAYS):
+    """Сводка для /stats из таблиц route_stats, booking_days и stats_counters.
+
+    Читаются сами сводки (строка на маршрут и на день) и поездки действующих маршрутов
+    за период по индексу bookings(route_id, created_at), поэтому время ответа
+    не зависит от числа пользователей.
+    """
+    since = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    async with get_db_connection() as conn:
+        async with conn.execute(
+                "SELECT route_id, active_drivers, priced_drivers, price_sum FROM route_stats "
+                "WHERE active_drivers > 0 ORDER BY route_id") as cursor:
+            routes = await cursor.fetchall()
+        async with conn.execute(
+                "SELECT day, bookings FROM booking_days WHERE day >= ? ORDER BY day", (since,)) as cursor:
+            bookings = await cursor.fetchall()
+        async with conn.execute("SELECT value FROM stats_counters WHERE name='pending_drivers'") as cursor:
+            row = await cursor.fetchone()
+        route_rides = {route.route_id: await count_route_rides(route.route_id, since, conn)
+                       for route in route_catalog.active()}
+    return {
+        # route_id -> (работающих водителей, средняя цена или None)
+        "routes": {route_id: (active, price_sum // priced if priced else None)
+                   for route_id, active, priced, price_sum in routes},
+        "bookings": bookings,
+        "route_rides": route_rides,  # route_id -> поездок за период
+        "pending_drivers": row[0] if row else 0,
+    }
+
+
+class StatsReconciler:
+    """Периодическая сверка сводок /stats с исходными таблицами.
+
+    Сводки ведут триггеры (миграция 9) в тех же транзакциях, что и записи в users и bookings.
+    Раз в STATS_RECONCILE_INTERVAL секунд сводки пересчитываются целиком (STATS_RECOMPUTE)
+    в одной транзакции; если результат разошёлся с накопленным, это пишется в лог.
+    """
+
+    def __init__(self):
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run_forever(self):
+        while True:
+            await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logging.error(f"Ошибка при пересчёте статистики: {e}")
+
+    @staticmethod
+    async def _snapshot(conn):
+        snapshot = {}
+        for table in ("route_stats", "booking_days", "stats_counters"):
+            async with conn.execute(f"SELECT * FROM {table}") as cursor:
+                snapshot[table] = set(await cursor.fetchall())
+        return snapshot
+
+    async def reconcile(self) -> list:
+        """Пересчитывает сводки; возвращает имена таблиц, в которых нашлось расхождение"""
+        async with get_db_connection() as conn:
+            await conn.execute("BEGIN IMMEDIATE;")  # Писатели ждут, пока идёт пересчёт
+            try:
+                before = await self._snapshot(conn)
+                for statement in STATS_RECOMPUTE:
+                    await conn.execute(statement)
+                after = await self._snapshot(conn)
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+        # Строки с нулями остаются после ухода последнего водителя, пересчёт их не создаёт
+        drift = [table for table in before
+                 if {row for row in before[table] if any(row[1:])} != {row for row in after[table] if any(row[1:])}]
+        if drift:
+            logging.warning(f"Сводки статистики расходились с данными и пересчитаны: {', '.join(drift)}")
+        return drift
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from copy import copy
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from database import DB_PATH, open_connection
+
+FSM_DB_PATH = os.getenv("FSM_DB_PATH", DB_PATH)
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1"))
+FSM_TTL = int(os.getenv("FSM_TTL", str(24 * 3600)))
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в SQLite с отложенной пакетной записью.
+
+    Все состояния и данные живут в памяти, как в MemoryStorage. Изменённые ключи
+    раз в FSM_FLUSH_INTERVAL секунд сбрасываются на диск одной транзакцией, записи без
+    активности дольше FSM_TTL удаляются, а при старте всё незавершённое загружается обратно.
+    """
+
+    def __init__(self, path: str = FSM_DB_PATH, flush_interval: float = FSM_FLUSH_INTERVAL, ttl: int = FSM_TTL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.records = {}  # StorageKey -> [state, data, время последнего изменения]
+        self._dirty = set()
+        self._conn = None
+        self._flusher = None
+
+    async def open(self):
+        self._conn = await open_connection(self.path)
+        await self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_storage (
+                bot_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                thread_id INTEGER NOT NULL DEFAULT 0,
+                business_connection_id TEXT NOT NULL DEFAULT '',
+                destiny TEXT NOT NULL,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}',
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (bot_id, chat_id, user_id, thread_id, business_connection_id, destiny)
+            ) WITHOUT ROWID;
+        """)
+        await self._conn.execute("DELETE FROM fsm_storage WHERE updated_at < ?", (time.time() - self.ttl,))
+        await self._conn.commit()
+        async with self._conn.execute("SELECT * FROM fsm_storage") as cursor:
+            async for row in cursor:
+                key = StorageKey(
+                    bot_id=row[0], chat_id=row[1], user_id=row[2],
+                    thread_id=row[3] or None, business_connection_id=row[4] or None, destiny=row[5]
+                )
+                self.records[key] = [row[6], json.loads(row[7]), row[8]]
+        logging.info(f"FSM-хранилище загружено: {len(self.records)} записей")
+        self._flusher = asyncio.create_task(self._flush_forever())
+
+    def sessions(self):
+        """Ключи с активным состоянием и время последнего изменения их записи"""
+        return [(key, record[2]) for key, record in self.records.items() if record[0]]
+
+    def _record(self, key: StorageKey):
+        record = self.records.get(key)
+        if record is None:
+            record = self.records[key] = [None, {}, time.time()]
+        return record
+
+    def _touch(self, key: StorageKey, record):
+        record[2] = time.time()
+        self._dirty.add(key)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._record(key)
+        record[0] = state.state if isinstance(state, State) else state
+        self._touch(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self.records.get(key)
+        return record[0] if record else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = self._record(key)
+        record[1] = data.copy()
+        self._touch(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = self.records.get(key)
+        return record[1].copy() if record else {}
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default: Optional[Any] = None) -> Optional[Any]:
+        record = self.records.get(storage_key)
+        return copy(record[1].get(dict_key, default)) if record else default
+
+    def _expire(self):
+        deadline = time.time() - self.ttl
+        for key in [key for key, record in self.records.items() if record[2] < deadline]:
+            del self.records[key]
+            self._dirty.add(key)
+
+    async def flush(self):
+        """Записывает все изменённые ключи одной транзакцией"""
+        self._expire()
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        upserts, deletes = [], []
+        for key in dirty:
+            key_columns = (key.bot_id, key.chat_id, key.user_id, key.thread_id or 0,
+                           key.business_connection_id or "", key.destiny)
+            record = self.records.get(key)
+            if record is None or (record[0] is None and not record[1]):
+                # Пустая запись ничем не отличается от отсутствующей
+                self.records.pop(key, None)
+                deletes.append(key_columns)
+            else:
+                upserts.append(key_columns + (record[0], json.dumps(record[1], ensure_ascii=False), record[2]))
+        try:
+            await self._conn.executemany("""
+                INSERT INTO fsm_storage (bot_id, chat_id, user_id, thread_id, business_connection_id, destiny,
+                                         state, data, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT DO UPDATE SET
+                    state=excluded.state, data=excluded.data, updated_at=excluded.updated_at;
+            """, upserts)
+            await self._conn.executemany("""
+                DELETE FROM fsm_storage WHERE bot_id=? AND chat_id=? AND user_id=? AND thread_id=?
+                    AND business_connection_id=? AND destiny=?
+            """, deletes)
+            await self._conn.commit()
+        except Exception:
+            await self._conn.rollback()
+            self._dirty |= dirty  # Повторим при следующем сбросе
+            raise
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Ошибка при сохранении FSM-хранилища: {e}")
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        if self._conn is not None:
+            await self.flush()
+            await self._conn.close()
+            self._conn = None
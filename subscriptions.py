@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+
+from database import get_db_connection, user_changed
+from send_scheduler import background
+
+SUBSCRIPTION_CHECK_INTERVAL = int(os.getenv("SUBSCRIPTION_CHECK_INTERVAL", "60"))  # секунд
+SUBSCRIPTION_REMIND_BEFORE = timedelta(hours=int(os.getenv("SUBSCRIPTION_REMIND_HOURS", "24")))
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class SubscriptionEnforcer:
+    """Фоновая проверка подписок водителей.
+
+    Раз в SUBSCRIPTION_CHECK_INTERVAL секунд снимает с работы водителей с истёкшей подпиской
+    (диапазонный проход по idx_users_expiring_drivers, пачка — одна транзакция) и напоминает
+    тем, у кого подписка заканчивается в ближайшие SUBSCRIPTION_REMIND_BEFORE. Сообщения идут
+    через очередь отправки с фоновым приоритетом.
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run_forever(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logging.error(f"Ошибка при проверке подписок: {e}")
+            await asyncio.sleep(SUBSCRIPTION_CHECK_INTERVAL)
+
+    async def run_once(self, now: datetime = None):
+        now = now or datetime.now()
+        expired = await self.expire(now)
+        reminded = await self.remind(now)
+        if expired or reminded:
+            logging.info(f"Подписки: снято с работы {expired}, отправлено напоминаний {reminded}")
+        return expired, reminded
+
+    async def expire(self, now: datetime) -> int:
+        """Снимает с работы водителей с истёкшей подпиской; возвращает их число"""
+        total = 0
+        while True:
+            async with get_db_connection() as conn:
+                async with conn.execute("""
+                    UPDATE users SET available=0
+                    WHERE user_id IN (
+                        SELECT user_id FROM users
+                        WHERE role='driver' AND available=1 AND subscription_end <= ?
+                        LIMIT ?
+                    )
+                    RETURNING user_id
+                """, (now.strftime(TIME_FORMAT), self.BATCH_SIZE)) as cursor:
+                    user_ids = [row[0] for row in await cursor.fetchall()]
+                await conn.commit()
+                for user_id in user_ids:
+                    await user_changed(user_id, conn)
+            await self._notify(user_ids, "⌛ Ваша подписка истекла, вы скрыты из списка водителей.\n"
+                                         "Для продления обратитесь к администратору.")
+            total += len(user_ids)
+            if len(user_ids) < self.BATCH_SIZE:
+                return total
+
+    async def remind(self, now: datetime) -> int:
+        """Напоминает об окончании подписки один раз на каждый её срок"""
+        total = 0
+        while True:
+            async with get_db_connection() as conn:
+                async with conn.execute("""
+                    SELECT user_id, subscription_end FROM users
+                    WHERE role='driver' AND subscription_end > ? AND subscription_end <= ?
+                      AND subscription_reminded IS NOT subscription_end
+                    LIMIT ?
+                """, (now.strftime(TIME_FORMAT), (now + SUBSCRIPTION_REMIND_BEFORE).strftime(TIME_FORMAT),
+                      self.BATCH_SIZE)) as cursor:
+                    rows = await cursor.fetchall()
+            if not rows:
+                return total
+
+            async def send(user_id, subscription_end):
+                await self._send(user_id, f"⏳ Ваша подписка заканчивается {subscription_end}.\n"
+                                          f"Продлите её, чтобы оставаться в списке водителей.")
+
+            # Отмечаем даже недоставленные (например, бот заблокирован), чтобы не повторять их каждый проход
+            await asyncio.gather(*(send(*row) for row in rows))
+            async with get_db_connection() as conn:
+                await conn.executemany("UPDATE users SET subscription_reminded=? WHERE user_id=?",
+                                       [(subscription_end, user_id) for user_id, subscription_end in rows])
+                await conn.commit()
+            total += len(rows)
+            if len(rows) < self.BATCH_SIZE:
+                return total
+
+    async def _notify(self, user_ids, text: str):
+        await asyncio.gather(*(self._send(user_id, text) for user_id in user_ids))
+
+    async def _send(self, user_id: int, text: str):
+        try:
+            with background():
+                await self.bot.send_message(user_id, text)
+        except Exception as e:
+            logging.error(f"Не удалось отправить уведомление о подписке водителю {user_id}: {e}")
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+
+# Модули бота лежат в корне репозитория и читают настройки из окружения при импорте
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("ADMIN_ID", "1")
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Пустая база во временном каталоге; общие объекты модуля database сброшены.
+
+    Схему создаёт сам тест (setup_database), пул соединений тест открывает и закрывает
+    внутри своего asyncio.run: соединения aiosqlite привязаны к циклу событий.
+    """
+    import database
+    from routes import route_catalog
+    path = str(tmp_path / "database.db")
+    monkeypatch.setattr(database, "DB_PATH", path)
+    database.driver_index.__init__()
+    database.user_cache.__init__(database.user_cache.size, database.user_cache.ttl)
+    database.banned_users.clear()
+    route_catalog.__init__()
+    yield path
+    database.banned_users.clear()
+
+
+@pytest.fixture(autouse=True)
+def detach_handlers_router():
+    """main.create_dispatcher подключает общий router из handlers.py; после теста отключаем его,
+    чтобы следующий тест мог собрать свой Dispatcher"""
+    yield
+    from handlers import router
+    if router.parent_router is not None:
+        router.parent_router.sub_routers.remove(router)
+        router._parent_router = None
@@ -0,0 +1,191 @@
+import asyncio
+import json
+
+import pytest
+from aiogram import Bot
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.types import Update
+
+fakeredis = pytest.importorskip("fakeredis")
+
+import cluster
+from cluster import Front, Worker, SharedTimeouts, QUEUE_PREFIX
+
+
+def make_update(update_id: int, user_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "U"},
+            "text": str(update_id),
+        },
+    }
+
+
+class FakePollingBot:
+    """Отдаёт обновления с update_id >= offset и запоминает offset каждого GetUpdates"""
+
+    def __init__(self, updates):
+        self.updates = [Update.model_validate(data) for data in updates]
+        self.offsets = []
+
+    async def __call__(self, method):
+        self.offsets.append(method.offset)
+        await asyncio.sleep(0)
+        return [update for update in self.updates if method.offset is None or update.update_id >= method.offset]
+
+
+async def queued(redis, workers: int):
+    items = []
+    for index in range(workers):
+        items += [json.loads(item)["update_id"] for item in await redis.lrange(f"{QUEUE_PREFIX}{index}", 0, -1)]
+    return sorted(items)
+
+
+def test_poll_survives_redis_error_without_losing_updates(monkeypatch):
+    sleep = asyncio.sleep
+    monkeypatch.setattr(asyncio, "sleep", lambda delay: sleep(0))  # Паузы перед повтором не ждём
+
+    async def scenario():
+        redis = fakeredis.FakeAsyncRedis()
+        front = Front(redis, workers=2)
+        bot = FakePollingBot([make_update(1, 10), make_update(2, 11)])
+        dispatch, failures = front._dispatch, []
+
+        async def flaky_dispatch(updates):
+            if not failures:
+                failures.append(updates)
+                raise ConnectionError("Connection reset by peer")
+            await dispatch(updates)
+
+        front._dispatch = flaky_dispatch
+        task = asyncio.create_task(front._poll(bot, ["message"]))
+        while len(bot.offsets) < 4 and not task.done():
+            await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return bot.offsets, await queued(redis, 2)
+
+    offsets, items = asyncio.run(scenario())
+    # После сбоя offset не сдвинулся, обновления взяты повторно и попали в очереди ровно один раз
+    assert offsets[:3] == [None, None, 3]
+    assert items == [1, 2]
+
+
+class RecordingDispatcher:
+    """Вместо Dispatcher: запоминает порядок и параллельность; события blocked_user ждут release"""
+
+    def __init__(self, blocked_user: int = None):
+        self.blocked_user = blocked_user
+        self.release = asyncio.Event()
+        self.handled = []
+        self.running = 0
+        self.max_running = 0
+
+    async def feed_update(self, bot, update: Update):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            if update.message.from_user.id == self.blocked_user:
+                await self.release.wait()
+            else:
+                await asyncio.sleep(0.01)
+            self.handled.append((update.message.from_user.id, update.update_id))
+        finally:
+            self.running -= 1
+
+
+async def wait_for(condition, timeout: float = 5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("условие не выполнилось за отведённое время")
+        await asyncio.sleep(0.01)
+
+
+async def run_worker(redis, dp, updates, until, teardown=None):
+    """Запускает воркер над очередью 0 до выполнения until; teardown отпускает зависшие обработчики"""
+    await redis.rpush(f"{QUEUE_PREFIX}0", *[json.dumps(update) for update in updates])
+    worker = Worker(0, 1)
+    task = asyncio.create_task(worker._consume(dp, Bot("123456:TEST"), redis))
+    try:
+        await wait_for(until)
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        if teardown is not None:
+            teardown()
+        await asyncio.gather(*worker._tasks, return_exceptions=True)
+    return worker
+
+
+def test_worker_keeps_user_order_without_blocking_other_users(monkeypatch):
+    monkeypatch.setattr(cluster, "WORKER_CONCURRENCY", 4)
+
+    async def scenario():
+        redis = fakeredis.FakeAsyncRedis()
+        dp = RecordingDispatcher(blocked_user=10)
+        # Пользователь 10 присылает больше событий, чем слотов; его первое событие зависло
+        updates = [make_update(update_id, 10) for update_id in range(1, 21)] + [make_update(100, 20)]
+        snapshot = {}
+
+        def release():
+            snapshot["handled"], snapshot["running"] = list(dp.handled), dp.running
+            dp.release.set()
+
+        await run_worker(redis, dp, updates, lambda: (20, 100) in dp.handled, teardown=release)
+        return dp, snapshot
+
+    dp, snapshot = asyncio.run(scenario())
+    assert snapshot["handled"] == [(20, 100)]  # Другой пользователь обслужен, пока очередь пользователя 10 стоит
+    assert snapshot["running"] == 1  # Ждущие события пользователя 10 слотов не заняли
+    assert [update_id for user_id, update_id in dp.handled if user_id == 10] == list(range(1, 21))
+    assert dp.max_running <= 4
+
+
+def test_worker_limits_concurrency_across_users(monkeypatch):
+    monkeypatch.setattr(cluster, "WORKER_CONCURRENCY", 4)
+
+    async def scenario():
+        redis = fakeredis.FakeAsyncRedis()
+        dp = RecordingDispatcher()
+        updates = [make_update(update_id, 1000 + update_id) for update_id in range(1, 31)]
+        await run_worker(redis, dp, updates, lambda: len(dp.handled) == 30)
+        return dp
+
+    dp = asyncio.run(scenario())
+    assert dp.max_running == 4
+
+
+def test_shared_timeouts_pop_only_due_sessions():
+    async def scenario():
+        redis = fakeredis.FakeAsyncRedis()
+        timeouts = SharedTimeouts(redis)
+        due, later = StorageKey(bot_id=1, chat_id=5, user_id=5), StorageKey(bot_id=1, chat_id=6, user_id=6)
+        await timeouts.touch(due, 100)
+        await timeouts.touch(later, 300)
+        first = await timeouts.pop_due(200, 10)
+        second = await timeouts.pop_due(200, 10)
+        third = await timeouts.pop_due(400, 10)
+        return first, second, third
+
+    first, second, third = asyncio.run(scenario())
+    assert [key.chat_id for key in first] == [5]
+    assert second == []  # Неистёкший срок вернулся в множество
+    assert [key.chat_id for key in third] == [6]
+
+
+def test_shared_timeouts_report_sessions_touched_after_pop():
+    async def scenario():
+        timeouts = SharedTimeouts(fakeredis.FakeAsyncRedis())
+        key = StorageKey(bot_id=1, chat_id=5, user_id=5)
+        await timeouts.touch(key, 100)
+        [due] = await timeouts.pop_due(200, 10)
+        popped = await timeouts.pending(due)
+        await timeouts.touch(key, 900)  # Пользователь ответил, пока сессия ждала своей пачки
+        return popped, await timeouts.pending(due)
+
+    assert asyncio.run(scenario()) == (False, True)
@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+from database import setup_database, init_db_pool, close_db_pool, get_db_connection
+from delayed import DelayedActions, DELAYED_LEASE
+
+
+def make_actions(executed: list) -> DelayedActions:
+    actions = DelayedActions()
+
+    @actions.action("note")
+    async def note(bot, value: int):
+        executed.append(value)
+
+    return actions
+
+
+def run_with_db(scenario):
+    async def wrapper():
+        await setup_database()
+        await init_db_pool()
+        try:
+            return await scenario()
+        finally:
+            await close_db_pool()
+
+    return asyncio.run(wrapper())
+
+
+async def rows() -> list:
+    async with get_db_connection() as conn:
+        async with conn.execute("SELECT action_id, owner FROM delayed_actions ORDER BY action_id") as cursor:
+            return await cursor.fetchall()
+
+
+def test_orphaned_actions_are_reclaimed_and_run_once(db):
+    executed = []
+
+    async def scenario():
+        crashed, survivor = make_actions(executed), make_actions(executed)
+        crashed.owner = "упавший воркер"
+        await survivor.start(bot=None, restore=False)
+        try:
+            first = await crashed.schedule("note", 0, value=1)
+            await crashed.schedule("note", 0, value=2)
+            claimed_alive = await survivor.renew()  # Аренда ещё действует: чужие строки не трогаем
+            async with get_db_connection() as conn:
+                await conn.execute("UPDATE delayed_actions SET lease_until=? WHERE owner=?",
+                                   (time.time() - 1, crashed.owner))
+                await conn.commit()
+            await crashed.cancel(first)  # Отмена из другого процесса всё равно удаляет строку
+            claimed = await survivor.renew()
+            owners = await rows()
+            await survivor._run_due()
+            await crashed._run_due()  # Воркер «ожил»: его строки уже забраны, повторно не выполняются
+            return claimed_alive, claimed, owners, await rows()
+        finally:
+            await survivor.stop()
+
+    claimed_alive, claimed, owners, left = run_with_db(scenario)
+    assert claimed_alive == 0 and claimed == 1
+    assert [owner for _, owner in owners] == [owners[0][1]] and owners[0][1] != "упавший воркер"
+    assert executed == [2]
+    assert left == []
+
+
+def test_cancel_records_only_local_actions(db):
+    executed = []
+
+    async def scenario():
+        actions, other = make_actions(executed), make_actions(executed)
+        actions.owner, other.owner = "фронт", "воркер"
+        local = await actions.schedule("note", 0, value=1)
+        foreign = await other.schedule("note", DELAYED_LEASE, value=2)
+        await actions.cancel(local)
+        await actions.cancel(foreign)
+        await actions.cancel(10 ** 6)  # Несуществующее действие
+        cancelled = set(actions._cancelled)
+        await actions._run_due()
+        return local, cancelled, actions._cancelled, actions._queued, await rows()
+
+    local, cancelled, cancelled_after, queued, left = run_with_db(scenario)
+    assert cancelled == {local}
+    assert executed == []
+    assert not cancelled_after and not queued
+    assert left == []
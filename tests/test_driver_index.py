@@ -0,0 +1,163 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Chat, Message, Update
+
+import main
+from callbacks import ApproveDriver, BookDriver, DriverRoute
+from outbox import ADMIN_ID
+from database import (setup_database, init_db_pool, close_db_pool, get_db_connection, save_user, register_driver,
+                      driver_index, user_changed)
+from route_watch import route_notifier
+from routes import route_catalog
+
+
+def run_with_db(scenario):
+    async def wrapper():
+        await setup_database()
+        await init_db_pool()
+        try:
+            return await scenario()
+        finally:
+            await close_db_pool()
+
+    return asyncio.run(wrapper())
+
+
+async def add_driver(user_id: int, route_id: int, price: int, subscription_end: datetime = None):
+    await save_user(user_id, "driver", f"Водитель {user_id}", f"+{user_id}", "Cobalt", route_id=route_id)
+    async with get_db_connection() as conn:
+        await conn.execute("UPDATE users SET price=?, subscription_end=COALESCE(?, subscription_end) WHERE user_id=?",
+                           (price, subscription_end and subscription_end.strftime("%Y-%m-%d %H:%M:%S"), user_id))
+        await conn.commit()
+        await user_changed(user_id, conn)
+
+
+def test_lapsed_subscription_leaves_index_before_enforcer_runs(db):
+    async def scenario():
+        await add_driver(10, 1, 100000, datetime.now() + timedelta(seconds=1))
+        await add_driver(20, 1, 120000)
+        before = driver_index.page(1, "price", 0, 10)
+        version = driver_index.version(1)
+        await asyncio.sleep(1.1)
+        # В таблице водитель 10 по-прежнему available=1: SubscriptionEnforcer ещё не проходил
+        return before, version, driver_index.version(1), driver_index.page(1, "price", 0, 10), \
+            await driver_index.check_consistency()
+
+    before, version, version_after, after, drift = run_with_db(scenario)
+    assert [driver.user_id for driver in before[0]] == [10, 20]
+    assert version_after > version  # Закэшированная страница поиска пересоберётся
+    assert [driver.user_id for driver in after[0]] == [20] and after[1] == 1
+    assert drift == []
+
+
+class FakeSession(BaseSession):
+    """Сессия без сети: запоминает вызовы API и отвечает сообщением или True"""
+
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests.append(method)
+        if method.__returning__ is Message:
+            chat_id = getattr(method, "chat_id", None) or 1
+            return Message(message_id=len(self.requests), date=datetime.now(), chat=Chat(id=chat_id, type="private"))
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class Chatting:
+    """Отправляет в Dispatcher сообщения и нажатия кнопок от имени пользователей"""
+
+    def __init__(self, dp, bot):
+        self.dp, self.bot = dp, bot
+        self.update_id = 0
+
+    async def _feed(self, **event):
+        self.update_id += 1
+        update = Update.model_validate({"update_id": self.update_id, **event}, context={"bot": self.bot})
+        await self.dp.feed_update(self.bot, update)
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+
+    async def message(self, user_id: int, text: str):
+        await self._feed(message={"message_id": self.update_id, "date": 0, "chat": {"id": user_id, "type": "private"},
+                                  "from": self._user(user_id), "text": text})
+
+    async def press(self, user_id: int, data: str):
+        await self._feed(callback_query={
+            "id": str(self.update_id), "from": self._user(user_id), "chat_instance": "1", "data": data,
+            "message": {"message_id": 1, "date": 0, "chat": {"id": user_id, "type": "private"}, "text": "…"}})
+
+
+def test_index_matches_table_after_every_write_path(db):
+    driver, passenger, admin = 10, 30, ADMIN_ID
+    checks = []
+
+    async def check(step: str):
+        checks.append((step, driver_index.route_of(driver), await driver_index.check_consistency()))
+
+    async def scenario():
+        await route_catalog.load()
+        await driver_index.load()
+        session = FakeSession()
+        bot = Bot("123456:TEST", session=session)
+        chat = Chatting(main.create_dispatcher(MemoryStorage(), main.TimeoutMiddleware()), bot)
+        try:
+            await register_driver(driver, "Водитель", "+998", "Cobalt", "passport", "payment")
+            await save_user(passenger, "passenger", "Пассажир", "+997", route_id=1)
+            await check("заявка")
+            await chat.press(admin, ApproveDriver(driver_id=driver).pack())
+            await check("одобрение")
+            await chat.press(driver, DriverRoute(route=1).pack())
+            await check("маршрут")
+            await chat.message(driver, "150000")
+            await check("цена")
+            await chat.press(driver, DriverRoute(route=2).pack())
+            await check("смена маршрута")
+            await chat.press(driver, "driver_busy")
+            await check("не работаю")
+            await chat.press(driver, "driver_available")
+            await check("вернулся на работу")
+            await chat.press(admin, "update_driver_status")
+            await chat.message(admin, str(driver))
+            await check("статус от админа")
+            await chat.press(admin, "update_driver_status")
+            await chat.message(admin, str(driver))
+            await check("статус от админа обратно")
+            await chat.press(passenger, BookDriver(driver_id=driver).pack())
+            await check("поездка")
+            booked = driver_index.page(2, "rides", 0, 1)[0][0].rides_count
+            await chat.press(admin, "ban_user")
+            await chat.message(admin, str(driver))
+            await check("бан")
+            await chat.press(admin, "unban_user")
+            await chat.message(admin, str(driver))
+            await check("разбан")
+            await chat.message(driver, "/cancel")
+            await check("/cancel")
+        finally:
+            await route_notifier.close()
+        return session, booked
+
+    session, booked = run_with_db(scenario)
+    assert not [request for request in session.requests if "Произошла ошибка" in str(getattr(request, "text", ""))]
+    assert [(step, route) for step, route, _ in checks] == [
+        ("заявка", None), ("одобрение", None), ("маршрут", 1), ("цена", 1), ("смена маршрута", 2),
+        ("не работаю", None), ("вернулся на работу", 2), ("статус от админа", None),
+        ("статус от админа обратно", 2), ("поездка", 2), ("бан", None), ("разбан", 2), ("/cancel", None),
+    ]
+    assert [(step, drift) for step, _, drift in checks if drift] == []
+    assert booked == 1
+    assert driver_index.page(2, "price", 0, 10) == ([], 0)
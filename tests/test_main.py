@@ -0,0 +1,196 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+from aiogram import Bot
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseEventIsolation, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Update
+
+import main
+from storage import SQLiteStorage
+
+
+class RecordingStorage(MemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.reads = []
+
+    async def get_state(self, key):
+        self.reads.append(key.user_id)
+        return await super().get_state(key)
+
+
+class RecordingIsolation(BaseEventIsolation):
+    def __init__(self):
+        self.locked = []
+
+    @asynccontextmanager
+    async def lock(self, key):
+        self.locked.append(key.user_id)
+        yield
+
+    async def close(self):
+        pass
+
+
+def make_update(update_id: int, user_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+            "text": "привет",  # Без состояния этот текст не ловит ни один обработчик
+        },
+    }
+
+
+def test_banned_user_is_dropped_before_fsm(monkeypatch):
+    monkeypatch.setattr(main, "banned_users", {777})
+
+    async def scenario():
+        storage, isolation = RecordingStorage(), RecordingIsolation()
+        dp = main.create_dispatcher(storage, main.TimeoutMiddleware(), isolation)
+        bot = Bot("123456:TEST")
+        for update_id, user_id in ((1, 777), (2, 42)):
+            await dp.feed_update(bot, Update.model_validate(make_update(update_id, user_id), context={"bot": bot}))
+        return storage.reads, isolation.locked
+
+    reads, locked = asyncio.run(scenario())
+    assert 777 not in reads and 777 not in locked  # Ни блокировки, ни чтения состояния
+    assert 42 in reads and 42 in locked
+
+
+class FakeBot:
+    """Записывает отправленные сообщения; hold задерживает ответ для выбранных чатов"""
+
+    def __init__(self):
+        self.sent = []
+        self.hold = {}  # chat_id -> asyncio.Event
+        self.running = 0
+        self.max_running = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            if chat_id in self.hold:
+                await self.hold[chat_id].wait()
+            else:
+                await asyncio.sleep(0)
+            self.sent.append(chat_id)
+        finally:
+            self.running -= 1
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+async def in_state(storage, chat_id: int) -> FSMContext:
+    state = FSMContext(storage, StorageKey(bot_id=1, chat_id=chat_id, user_id=chat_id))
+    await state.set_state("Form:step")
+    return state
+
+
+def make_event(chat_id: int, bot):
+    return SimpleNamespace(from_user=SimpleNamespace(id=chat_id), bot=bot)
+
+
+def test_timeout_wheel_keeps_one_task_under_load():
+    sessions, touches = 500, 10
+
+    async def scenario():
+        storage, bot, clock = MemoryStorage(), FakeBot(), FakeClock()
+        middleware = main.TimeoutMiddleware()
+        middleware._now = clock
+        states = {chat_id: await in_state(storage, chat_id) for chat_id in range(1, sessions + 1)}
+
+        async def handler(event, data):
+            return None
+
+        baseline = len(asyncio.all_tasks())
+        middleware.start()
+        for _ in range(touches):  # Каждый пользователь шлёт по несколько событий
+            for chat_id, state in states.items():
+                await middleware(handler, make_event(chat_id, bot), {"state": state})
+            clock.now += 1
+        tasks_under_load = len(asyncio.all_tasks()) - baseline
+        buckets_under_load = len(middleware.buckets)
+
+        clock.now += middleware.TIMEOUT + middleware.TICK
+        await middleware.sweep()
+        await middleware.stop()
+        left = [chat_id for chat_id, state in states.items() if await state.get_state()]
+        return tasks_under_load, buckets_under_load, bot, middleware, left
+
+    tasks_under_load, buckets_under_load, bot, middleware, left = asyncio.run(scenario())
+    assert tasks_under_load == 1  # Только sweeper, сколько бы событий ни пришло
+    assert buckets_under_load <= 2  # Корзины по TICK секунд, а не задача на событие
+    assert sorted(bot.sent) == list(range(1, sessions + 1))  # Каждая сессия завершена ровно один раз
+    assert bot.max_running <= main.TimeoutMiddleware.BATCH_SIZE
+    assert not middleware.active_states and not middleware.buckets and not left
+
+
+def test_session_touched_during_sweep_is_not_expired():
+    async def scenario():
+        storage, bot, clock = MemoryStorage(), FakeBot(), FakeClock()
+        middleware = main.TimeoutMiddleware()
+        middleware._now = clock
+        middleware.BATCH_SIZE = 1
+        first, second = await in_state(storage, 1), await in_state(storage, 2)
+        middleware.touch(1, first, bot)
+        clock.now += middleware.TICK * 2
+        middleware.touch(2, second, bot)  # Более поздняя корзина: завершается после пачки с чатом 1
+        bot.hold[1] = asyncio.Event()
+
+        clock.now += middleware.TIMEOUT + middleware.TICK * 2
+        sweep = asyncio.create_task(middleware.sweep())
+        while not bot.running:  # Первая пачка (чат 1) ждёт отправки
+            await asyncio.sleep(0)
+        middleware.touch(2, second, bot)  # Пользователь 2 ответил, пока отправлялась первая пачка
+        bot.hold[1].set()
+        await sweep
+        return bot.sent, await first.get_state(), await second.get_state(), middleware.active_states
+
+    sent, first_state, second_state, active_states = asyncio.run(scenario())
+    assert sent == [1]
+    assert first_state is None
+    assert second_state == "Form:step" and 2 in active_states
+
+
+def test_sessions_restored_from_sqlite_storage_get_deadlines(tmp_path):
+    path = str(tmp_path / "fsm.db")
+
+    async def scenario():
+        storage = SQLiteStorage(path)
+        await storage.open()
+        stale, fresh = await in_state(storage, 1), await in_state(storage, 2)
+        storage.records[stale.key][2] -= main.TimeoutMiddleware.TIMEOUT + 1  # Сессия старше тайм-аута
+        await storage.close()
+
+        storage, bot, clock = SQLiteStorage(path), FakeBot(), FakeClock()
+        await storage.open()
+        try:
+            middleware = main.TimeoutMiddleware()
+            middleware._now = clock
+            middleware.restore(storage, bot)
+            restored = set(middleware.active_states)
+            clock.now += middleware.TICK * 2
+            await middleware.sweep()
+            states = [await FSMContext(storage, key).get_state() for key in (stale.key, fresh.key)]
+            return restored, bot.sent, states
+        finally:
+            await storage.close()
+
+    restored, sent, states = asyncio.run(scenario())
+    assert restored == {1, 2}
+    assert sent == [1]
+    assert states == [None, "Form:step"]
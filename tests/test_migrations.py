@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import sqlite3
+import time
+
+from database import setup_database
+from migrations import SCHEMA_VERSION
+
+USERS = 50_000
+
+# Схема базы до появления миграций (setup_database первой версии бота)
+BASELINE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        role TEXT,
+        name TEXT,
+        phone TEXT,
+        car_info TEXT,
+        route TEXT DEFAULT NULL,
+        available INTEGER DEFAULT 0,
+        rides_count INTEGER DEFAULT 0,
+        subscribed INTEGER DEFAULT 0,
+        banned INTEGER DEFAULT 0,
+        last_route_change TIMESTAMP DEFAULT NULL,
+        subscription_end TIMESTAMP DEFAULT NULL,
+        passport TEXT DEFAULT NULL,
+        payment TEXT DEFAULT NULL,
+        price INTEGER DEFAULT NULL,
+        last_arrival_time TIMESTAMP DEFAULT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_users_route ON users(route);
+"""
+TASHKENT_NUKUS = "🛫 Ташкент ➡️ Нукус 🛬"
+NUKUS_TASHKENT = "🛫 Нукус ➡️ Ташкент 🛬"
+
+
+def build_baseline(path: str):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany(
+        "INSERT INTO users (user_id, role, name, phone, car_info, route, available, price, passport)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+            (1, "driver", "A", "1", "Cobalt", TASHKENT_NUKUS, 1, 100000, "p"),
+            (2, "driver", "B", "2", "Nexia", NUKUS_TASHKENT, 1, None, "p"),
+            (3, "passenger", "C", "3", None, NUKUS_TASHKENT, 0, None, None),
+            (4, "driver", "D", "4", "Spark", "Самарканд", 1, 50000, "p"),  # Маршрут, которого нет в справочнике
+            (5, "driver", "E", "5", "Damas", None, 0, None, "p"),  # Заявка на одобрении
+        ])
+    conn.executemany("INSERT INTO users (user_id, role, name, phone, route) VALUES (?, 'passenger', ?, ?, ?)",
+                     [(user_id, f"P{user_id}", str(user_id), (TASHKENT_NUKUS, NUKUS_TASHKENT)[user_id % 2])
+                      for user_id in range(100, 100 + USERS)])
+    conn.commit()
+    conn.close()
+
+
+def schema(path: str):
+    conn = sqlite3.connect(path)
+    try:
+        return (conn.execute("PRAGMA user_version").fetchone()[0],
+                sorted(conn.execute("SELECT type, name, sql FROM sqlite_master").fetchall()))
+    finally:
+        conn.close()
+
+
+def test_baseline_database_migrates_once_and_restarts_without_work(db, caplog, record_property):
+    build_baseline(db)
+    caplog.set_level(logging.INFO)
+
+    started = time.perf_counter()
+    asyncio.run(setup_database())
+    first_run = time.perf_counter() - started
+    applied = [record.getMessage() for record in caplog.records if "Применена миграция" in record.getMessage()]
+    migrated = schema(db)
+
+    caplog.clear()
+    started = time.perf_counter()
+    asyncio.run(setup_database())
+    restart = time.perf_counter() - started
+    record_property("migrate_ms", round(first_run * 1000, 1))
+    record_property("restart_ms", round(restart * 1000, 1))
+
+    assert len(applied) == SCHEMA_VERSION and migrated[0] == SCHEMA_VERSION
+    assert not [record for record in caplog.records if "Применена миграция" in record.getMessage()]
+    assert schema(db) == migrated  # Повторный запуск ничего не меняет
+    assert restart < min(first_run, 0.5)  # Актуальная схема: один PRAGMA user_version
+
+    conn = sqlite3.connect(db)
+    try:
+        routes = {label: (route_id, active) for route_id, label, active in
+                  conn.execute("SELECT route_id, label, active FROM routes")}
+        users = dict(conn.execute("SELECT user_id, route_id FROM users WHERE user_id < 100"))
+        passengers = dict(conn.execute("SELECT route_id, COUNT(*) FROM users WHERE user_id >= 100 GROUP BY route_id"))
+        route_stats = conn.execute("SELECT route_id, active_drivers FROM route_stats ORDER BY route_id").fetchall()
+        pending = conn.execute("SELECT value FROM stats_counters WHERE name='pending_drivers'").fetchone()[0]
+    finally:
+        conn.close()
+    assert routes[TASHKENT_NUKUS] == (1, 1) and routes[NUKUS_TASHKENT] == (2, 1)
+    unknown, active = routes["Самарканд"]
+    assert active == 0  # Незнакомый текст стал отключённым маршрутом, ссылка на него сохранилась
+    assert users == {1: 1, 2: 2, 3: 2, 4: unknown, 5: None}
+    assert passengers == {1: USERS // 2, 2: USERS // 2}
+    assert route_stats == [(1, 1), (2, 1), (unknown, 1)]
+    assert pending == 1
@@ -0,0 +1,155 @@
+"""Регрессия планов горячих запросов на базе со 120 тысячами пользователей.
+
+Каждый случай вызывает настоящую функцию бота, собирает выполненные ею SQL-запросы
+(trace callback соединения) и проверяет EXPLAIN QUERY PLAN: ни одного полного прохода
+по таблице. Время вызова записывается в свойства теста (record_property, видно в --junitxml).
+"""
+import asyncio
+import random
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+
+import pytest
+
+import database
+from database import (setup_database, init_db_pool, close_db_pool, get_db_connection, fetch_user, fetch_users_page,
+                      set_driver_availability, book_ride, count_route_rides, DriverIndex,
+                      _INDEXED_DRIVER_COLUMNS, _INDEXED_DRIVER_FILTER)
+from handlers import DRIVER_FILTERS, PASSENGER_FILTERS
+from outbox import AdminOutbox
+from route_watch import RouteNotifier
+from stats import fetch_stats
+from subscriptions import SubscriptionEnforcer
+
+USERS = 120_000
+BOOKINGS = 50_000
+WATCHERS = 10_000
+DRIVER = 10  # Каждый десятый пользователь — водитель
+PASSENGER = 11
+# Таблицы из строки на маршрут: полный проход по ним дешевле любого индекса
+SMALL_TABLES = {"routes", "route_stats"}
+
+
+@pytest.fixture(scope="module", params=[False, True], ids=["no-analyze", "analyze"])
+def template(request, tmp_path_factory):
+    """Заполненная база, общая для всех случаев; каждый тест работает с её копией"""
+    path = str(tmp_path_factory.mktemp("plans") / "template.db")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(database, "DB_PATH", path)
+        asyncio.run(setup_database())
+    rng = random.Random(12)
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "INSERT INTO users (user_id, role, name, phone, car_info, route_id, available, price, banned,"
+        " subscription_end, last_arrival_time, rides_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [(user_id, "driver" if user_id % 10 == 0 else "passenger", f"Пользователь {user_id}", f"+{user_id}",
+          "Cobalt", rng.choice((1, 2)), rng.randint(0, 1), rng.randint(1, 9) * 10000, int(rng.random() < 0.01),
+          f"2099-01-{rng.randint(1, 28):02d} 00:00:00", None, rng.randint(0, 50))
+         for user_id in range(1, USERS + 1)])
+    conn.executemany(
+        "INSERT INTO bookings (idempotency_key, passenger_id, driver_id, route_id, price, created_at)"
+        " VALUES (?, ?, ?, ?, ?, ?)",
+        [(f"seed:{i}", rng.randrange(1, USERS), rng.randrange(10, USERS, 10), rng.choice((1, 2)), 100000,
+          f"2026-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 12:00:00") for i in range(BOOKINGS)])
+    conn.executemany("INSERT INTO route_watchers (passenger_id, route_id, expires_at) VALUES (?, ?, ?)",
+                     [(user_id, rng.choice((1, 2)), "2000-01-01 00:00:00") for user_id in range(1, WATCHERS * 10, 10)])
+    if request.param:
+        conn.execute("ANALYZE;")
+    else:
+        conn.execute("DROP TABLE IF EXISTS sqlite_stat1;")  # Миграции делают ANALYZE на пустой базе
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def seeded(template, db):
+    shutil.copyfile(template, db)
+    return db
+
+
+def admin_pages(role: str, filters: dict):
+    filters = {**filters, "rt1": ("маршрут", "route_id=?", (1,))}
+    return {f"fetch_users_page {role} {code} {direction}": (
+        lambda where=where, params=params, direction=direction: fetch_users_page(
+            role, where, params, **({"before": USERS // 2} if direction == "prev" else {"after": USERS // 2})))
+        for code, (_, where, params) in filters.items() for direction in ("next", "prev")}
+
+
+async def handler_queries():
+    """Запросы, написанные прямо в обработчиках (по первичному ключу)"""
+    async with get_db_connection() as conn:
+        # handlers.update_driver_status
+        await conn.execute("SELECT available FROM users WHERE user_id=? AND role='driver'", (DRIVER,))
+        # driver_handlers.choose_driver_route
+        await conn.execute("SELECT route_id FROM users WHERE user_id=?", (DRIVER,))
+
+
+HOT_CALLS = {
+    "driver_index.load": lambda: DriverIndex().load(),
+    "driver_index.refresh": lambda: DriverIndex().refresh(DRIVER),
+    "fetch_user": lambda: fetch_user(PASSENGER),
+    "set_driver_availability": lambda: set_driver_availability(DRIVER, True),
+    "book_ride": lambda: book_ride(PASSENGER, DRIVER, "plans"),
+    "count_route_rides": lambda: count_route_rides(1, "2026-06-01"),
+    "fetch_stats": lambda: fetch_stats(),
+    **admin_pages("driver", DRIVER_FILTERS),
+    **admin_pages("passenger", PASSENGER_FILTERS),
+    # Прошедший момент: никого не снимает и не напоминает, но запросы те же
+    "subscriptions.run_once": lambda: SubscriptionEnforcer(bot=None).run_once(datetime(2000, 1, 1)),
+    "route_watch.fan_out": lambda: RouteNotifier().fan_out(None, 1),
+    "outbox.drain": lambda: AdminOutbox().drain(),
+    "handlers": handler_queries,
+}
+
+
+def full_scans(path: str, statements: list) -> list:
+    conn = sqlite3.connect(path)
+    try:
+        scans = []
+        for sql in statements:
+            for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}"):
+                detail = row[3]
+                if detail.startswith("SCAN") and detail.split()[1] not in SMALL_TABLES:
+                    scans.append(f"{detail}: {' '.join(sql.split())}")
+        return scans
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("name", list(HOT_CALLS))
+def test_hot_query_uses_index(name, seeded, monkeypatch, record_property):
+    monkeypatch.setattr(database, "DB_POOL_SIZE", 1)
+    statements = []
+
+    def trace(sql):
+        if sql.lstrip().split(None, 1)[0].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE"):
+            statements.append(sql)
+
+    async def scenario():
+        await init_db_pool()
+        try:
+            async with get_db_connection() as conn:
+                await conn.set_trace_callback(trace)
+            started = time.perf_counter()
+            await HOT_CALLS[name]()
+            return time.perf_counter() - started
+        finally:
+            await close_db_pool()
+
+    elapsed = asyncio.run(scenario())
+    record_property("elapsed_ms", round(elapsed * 1000, 2))
+    assert statements
+    assert full_scans(seeded, statements) == []
+
+
+def test_driver_index_load_uses_available_drivers_index(template):
+    conn = sqlite3.connect(template)
+    try:
+        plan = [row[3] for row in conn.execute(
+            f"EXPLAIN QUERY PLAN SELECT {_INDEXED_DRIVER_COLUMNS} FROM users WHERE {_INDEXED_DRIVER_FILTER}")]
+    finally:
+        conn.close()
+    assert any("idx_users_available_drivers" in detail for detail in plan), plan
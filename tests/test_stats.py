@@ -0,0 +1,32 @@
+import asyncio
+
+from database import setup_database, init_db_pool, close_db_pool, get_db_connection, save_user, book_ride
+from routes import route_catalog
+from stats import fetch_stats, StatsReconciler
+
+
+def test_stats_count_rides_per_route_within_period(db):
+    async def scenario():
+        await setup_database()
+        await init_db_pool()
+        try:
+            await route_catalog.load()
+            await save_user(10, "driver", "Водитель 1", "+1", "Cobalt", route_id=1)
+            await save_user(20, "driver", "Водитель 2", "+2", "Nexia", route_id=2)
+            await save_user(30, "passenger", "Пассажир", "+3", route_id=1)
+            for key in ("a", "b", "a"):  # Повтор ключа поездку не добавляет
+                await book_ride(30, 10, key)
+            await book_ride(30, 20, "c")
+            async with get_db_connection() as conn:
+                # Поездка раньше периода /stats
+                await conn.execute("INSERT INTO bookings (idempotency_key, passenger_id, driver_id, route_id, price,"
+                                   " created_at) VALUES ('old', 30, 10, 1, NULL, '2020-01-01 00:00:00')")
+                await conn.commit()
+            return await fetch_stats(), await StatsReconciler().reconcile()
+        finally:
+            await close_db_pool()
+
+    stats, drift = asyncio.run(scenario())
+    assert stats["route_rides"] == {1: 2, 2: 1}
+    assert sum(count for _, count in stats["bookings"]) == 3
+    assert drift == []
@@ -0,0 +1,32 @@
+from database import User, UserCache
+
+
+def make_user(user_id: int, name: str = "Пассажир") -> User:
+    return User(user_id, "passenger", name, "+1", None, 1, 0, 0, 0, 0, None, None, None, None, None, None)
+
+
+def test_writes_to_other_users_do_not_discard_a_read_in_flight():
+    cache = UserCache(size=3, ttl=60)
+    since = cache.clock  # Чтение пользователя 1 началось
+    for user_id in range(2, 4):  # Тем временем пишут другие пользователи
+        cache.invalidate(user_id)
+    cache.put(make_user(1), since)
+    assert cache.get(1) == make_user(1)
+
+
+def test_read_that_raced_with_a_write_is_not_cached():
+    cache = UserCache(size=3, ttl=60)
+    since = cache.clock
+    cache.invalidate(1)  # Запись в пользователя 1 во время чтения: прочитанное устарело
+    cache.put(make_user(1, "Старое имя"), since)
+    assert cache.get(1) is None
+
+    since = cache.clock
+    for user_id in range(2, 6):  # Сброс пользователя 1 вытеснен из ограниченной истории
+        cache.invalidate(user_id)
+    cache.invalidate(1)
+    for user_id in range(6, 10):
+        cache.invalidate(user_id)
+    cache.put(make_user(1, "Старое имя"), since)
+    assert cache.get(1) is None
+    assert len(cache._written) == 3
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import os
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес; без него сервер только слушает локально
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "64"))
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Сразу отвечает Telegram 200 OK и обрабатывает обновление в фоне, не более max_concurrency одновременно"""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_concurrency: int, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _background_feed_update(self, bot: Bot, update):
+        async with self._semaphore:
+            await super()._background_feed_update(bot, update)
+
+
+def build_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    app = web.Application()
+    handler = BoundedRequestHandler(dp, bot, WEBHOOK_MAX_CONCURRENCY, secret_token=WEBHOOK_SECRET)
+    # Регистрируем маршрут без on_shutdown обработчика: жизненным циклом бота управляет run_webhook
+    app.router.add_route("POST", WEBHOOK_PATH, handler.handle)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, allowed_updates):
+    """Запускает бота через вебхук; при ошибке запуска возвращается к long polling"""
+    app = build_app(dp, bot)
+    runner = web.AppRunner(app)
+    try:
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=allowed_updates,
+            )
+    except Exception as e:
+        logging.error(f"Не удалось запустить вебхук, переключаемся на polling: {e}")
+        await runner.cleanup()
+        try:
+            await bot.delete_webhook()
+        except Exception as e:
+            logging.error(f"Не удалось удалить вебхук: {e}")
+        await dp.start_polling(bot, allowed_updates=allowed_updates)
+        return
+
+    workflow_data = {"app": app, "dispatcher": dp, "bot": bot, **dp.workflow_data}
+    await dp.emit_startup(**workflow_data)
+    logging.info(f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await dp.emit_shutdown(**workflow_data)
+        await bot.session.close()